@@ -1,3 +1,37 @@
-from . import keythleyAPI
-from . import tests_
-from . import utils
+"""
+WearS: Keithley 4200-SCS acquisition (keithleyAPI), test protocols (tests_) and post-processing (utils and
+the analysis modules). Submodules are imported lazily on first access, so importing the package for an
+acquisition script doesn't load the post-processing and plotting stack.
+"""
+import importlib
+import os
+import sys
+
+# the submodules import each other by their flat names (they are also used as scripts from this folder)
+_folder = os.path.dirname(os.path.abspath(__file__))
+
+_submodules = {
+    'keithleyAPI', 'tests_', 'utils', 'sweep_grid', 'tracing', 'simulator', 'synthetic',
+    'pcb_calibration', 'pcb_frames', 'pcb_stream', 'checkpoint', 'sweep_status', 'features', 'catalog', 'rundirs',
+    'similarity', 'squarelaw', 'kinetics', 'downsample', 'trace_codec',
+}
+
+# old misspelled name of keithleyAPI
+_aliases = {'keythleyAPI': 'keithleyAPI'}
+
+__all__ = sorted(_submodules)
+
+
+def __getattr__(name):
+    module = _aliases.get(name, name)
+    if module in _submodules:
+        if _folder not in sys.path:
+            sys.path.insert(0, _folder)
+        value = importlib.import_module(module)
+        globals()[name] = value
+        return value
+    raise AttributeError("module "+repr(__name__)+" has no attribute "+repr(name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _submodules | set(_aliases))
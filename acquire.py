@@ -0,0 +1,225 @@
+"""
+Command line runner of the acquisition protocols (tests_.stability_test, tests_.sensing_test) without a
+Jupyter kernel. A run spec (JSON) describes the instrument, the channels, the sweep, the resting time and
+the tolerances; every sweep and the state (the variables the notebook passed back and forth) are recorded
+in an incremental checkpoint (checkpoint.RunCheckpoint), so that an interrupted run resumed with --resume
+continues from the next sweep.
+
+Usage:
+    python acquire.py spec.json                 # run the spec (or the list of specs in the file)
+    python acquire.py spec.json --resume        # continue from the last checkpoint
+    python acquire.py --watch queue/            # daemon: run the specs dropped in queue/ one after the other
+    python acquire.py spec.json --simulate      # dry run against simulator.SimulatedKeithley
+
+Spec example:
+    {
+        "resource": "TCPIP0::169.254.181.21::1225::SOCKET",
+        "termination": "\\u0000",
+        "DUT": "d030824-II",
+        "couple": "r3c1",
+        "channels": {"left": "CH1", "right": "CH3", "common": "CH2"},
+        "sweep": {"start": "0", "stop": "300E-09", "step": "5E-09"},
+        "resting_time": 10,
+        "retries": 1,
+        "output": "results",
+        "stability": {"TOT": "DiodeConnected_Stability", "mode": "sensing", "max_steps": 80,
+                      "tol_std": 0.0005, "tol_mean": 0.002},
+        "sensing": {"TOT": "DiodeConnected_SensingTest-Na", "concentrations": ["10mM", "20mM", "40mM"],
+                    "runs": 20, "between": 600, "adaptive": false}
+    }
+"between" is what happens before each concentration after the first one: a number waits that many seconds
+(e.g. with an automated fluidic system), "prompt" waits for Enter (solution change by hand). Default is 0
+(no wait). "prompt" needs a terminal: specs with it are rejected in --watch mode and when stdin is not a TTY.
+"adaptive" (with optional "coarse_factor") selects the adaptive acquisition of tests_.sensing_test.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+
+# plots of the protocols are saved, never shown
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import tests_
+import tracing
+from checkpoint import RunCheckpoint
+from keithleyAPI import Communications
+
+
+def load_specs(path):
+    """
+    Read a spec file. The file contains one spec (dict) or a list of specs run back to back.
+    """
+    with open(path) as f:
+        specs = json.load(f)
+    return specs if isinstance(specs, list) else [specs]
+
+
+def checkpoint_path(spec):
+    return spec.get('checkpoint') or os.path.join(spec.get('output', '.'), spec['DUT']+spec['couple']+'.ckpt')
+
+
+def open_checkpoint(path, resume = False):
+    """
+    Open the checkpoint of a run; without resume an existing checkpoint is moved to path.old and a new one is started.
+    """
+    if not resume and os.path.exists(path):
+        os.replace(path, path+'.old')
+    if resume and os.path.exists(path):
+        print('Resuming from', path)
+    return RunCheckpoint(path)
+
+
+def restore_state(ckpt, conc = ()):
+    """
+    Return the state (the variables of the DiodeSensingTest notebook) restored from the checkpoint.
+    """
+    diode_df, mean_diff, stability_done = ckpt.stability_state()
+    state = {'stability_done': stability_done, 'diode_df': diode_df, 'mean_diff': mean_diff}
+    (state['k'], state['diode_df_dict'], state['diode_dict_list'], state['mean_std'], state['mean_std_L'],
+     state['mean_std_R'], state['folder'], state['baseline']) = ckpt.sensing_state(list(conc))
+    return state
+
+
+def check_spec(spec, interactive = True):
+    """
+    Raise ValueError if the spec cannot run unattended: "between": "prompt" without a terminal would block on
+    input() (or fail with EOFError) in the middle of the run.
+    """
+    between = (spec.get('sensing') or {}).get('between', 0)
+    if between == 'prompt' and not interactive:
+        raise ValueError('"between": "prompt" needs a terminal; give the seconds to wait instead')
+    if between != 'prompt':
+        float(between or 0)
+
+
+def connect(spec, simulate = False):
+    """
+    Open the instrument described by the spec ('resource', optional 'termination').
+    """
+    if simulate or spec.get('simulate'):
+        import simulator
+        return simulator.simulated_smu()
+    smu = Communications(spec['resource'])
+    smu.connect()
+    if 'termination' in spec:
+        smu._instrument_object.write_termination = spec['termination']
+        smu._instrument_object.read_termination = spec['termination']
+    smu.query("BC") # clears all readings from buffer
+    return smu
+
+
+def run_spec(spec, resume = False, simulate = False, interactive = None):
+    """
+    Run one spec: stability test (if 'stability' is given) then the sensing test over the concentrations
+    (if 'sensing' is given), checkpointing every sweep.
+
+    Parameters:
+    - interactive (bool, optional): a user can answer the prompts ("between": "prompt"). Default is None (stdin is a TTY).
+
+    Returns:
+    - state (dict): final state (same variables as the DiodeSensingTest notebook).
+    """
+    check_spec(spec, sys.stdin.isatty() if interactive is None else interactive)
+    output = spec.get('output', '.')
+    os.makedirs(output, exist_ok=True)
+    ckpt = open_checkpoint(os.path.abspath(checkpoint_path(spec)), resume)
+    sensing = spec.get('sensing')
+    conc = sensing['concentrations'] if sensing else []
+    state = restore_state(ckpt, conc)
+
+    L, R, C = spec['channels']['left'], spec['channels']['right'], spec['channels']['common']
+    sweep = spec.get('sweep', {})
+    resting_time = spec.get('resting_time', 10)
+    smu = connect(spec, simulate)
+    cwd = os.getcwd()
+    os.chdir(output) # utils.save_xls writes in the working directory
+    try:
+        stability = spec.get('stability')
+        if stability and not state['stability_done']:
+            tests_.stability_test(L, R, C, smu, state['diode_df'], state['mean_diff'], stability.get('mode', 'sensing'),
+                                  spec['couple'], spec['DUT'], stability['TOT'], stability.get('max_steps', 80), resting_time,
+                                  stability.get('tol_std', 0.0005), stability.get('tol_mean', 0.002), checkpoint = ckpt,
+                                  retries = spec.get('retries', 1))
+            state['stability_done'] = True
+
+        if sensing:
+            while state['k'] < len(conc):
+                if state['k'] > 0 and not ckpt.sweeps('sensing', conc[state['k']]):
+                    _wait_between(sensing.get('between', 0), conc[state['k']])
+                (state['k'], state['diode_df_dict'], state['diode_dict_list'], state['mean_std'], state['mean_std_L'],
+                 state['mean_std_R'], state['folder'], state['baseline']) = tests_.sensing_test(
+                    L, R, C, smu, state['k'], conc, state['diode_df_dict'], state['diode_dict_list'], state['mean_std'],
+                    state['mean_std_L'], state['mean_std_R'], spec['DUT'], sensing['TOT'], spec['couple'], state['baseline'],
+                    sweep.get('start', '0'), sweep.get('stop', '300E-09'), sweep.get('step', '5E-09'),
+                    sensing.get('runs', 20), resting_time, checkpoint = ckpt,
+                    adaptive = sensing.get('adaptive', False), coarse_factor = sensing.get('coarse_factor', 4),
+                    retries = spec.get('retries', 1))
+    finally:
+        os.chdir(cwd)
+        smu.disconnect()
+    return state
+
+
+def _wait_between(between, conc):
+    if between == 'prompt':
+        input('Change the solution to '+conc+' and press Enter to continue...')
+    elif between:
+        print('Waiting', between, 's before', conc)
+        time.sleep(float(between))
+
+
+def watch(folder, simulate = False, poll = 10):
+    """
+    Daemon mode: run the spec files (*.json) dropped in folder in alphabetical order, moving each one to
+    folder/done or folder/failed when it ends. Runs until interrupted.
+    """
+    for sub in ['done', 'failed']:
+        os.makedirs(os.path.join(folder, sub), exist_ok=True)
+    while True:
+        for path in sorted(glob.glob(os.path.join(folder, '*.json'))):
+            destination = 'done'
+            for spec in load_specs(path):
+                try:
+                    run_spec(spec, resume = True, simulate = simulate, interactive = False)
+                except Exception:
+                    traceback.print_exc()
+                    destination = 'failed'
+            shutil.move(path, os.path.join(folder, destination, os.path.basename(path)))
+        time.sleep(poll)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Run acquisition protocols from a run spec, without Jupyter')
+    parser.add_argument('spec', nargs='?', help='JSON run spec (one spec or a list)')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint of each spec')
+    parser.add_argument('--watch', metavar='FOLDER', help='daemon mode: run the specs dropped in FOLDER')
+    parser.add_argument('--simulate', action='store_true', help='use the simulated instrument')
+    parser.add_argument('--trace', metavar='JSONL', help='record timing spans in JSONL')
+    args = parser.parse_args(argv)
+    if not args.spec and not args.watch:
+        parser.error('a spec or --watch is required')
+
+    if args.trace:
+        tracing.enable(args.trace)
+    if args.watch:
+        watch(args.watch, args.simulate)
+        return 0
+    failed = 0
+    for spec in load_specs(args.spec):
+        try:
+            run_spec(spec, args.resume, args.simulate)
+        except Exception:
+            traceback.print_exc()
+            failed += 1
+    if args.trace:
+        print(tracing.summary())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
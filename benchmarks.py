@@ -0,0 +1,402 @@
+"""
+Benchmarks of the acquisition-to-result path, run against the simulated instrument (simulator.py)
+and synthetic data, so they need neither the 4200-SCS nor the lab folders.
+
+Usage:
+    python benchmarks.py                      # run all, save .benchmarks/<commit>.json
+    python benchmarks.py -k parse save         # run the benchmarks whose name contains 'parse' or 'save'
+    python benchmarks.py --compare <commit>   # compare with the results of another commit
+
+Every benchmark is a function bench_<name>(state) timed with timeit; setup_<name>() (optional)
+builds the state outside the timed region. The folders made with _folder() are removed after the benchmark.
+"""
+import argparse
+import contextlib
+import itertools
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import simulator
+import utils
+from keithleyAPI import parse_trace
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.benchmarks')
+
+# temporary folders of the running benchmark, removed when it ends
+_folders = contextlib.ExitStack()
+
+
+def _folder():
+    return _folders.enter_context(tempfile.TemporaryDirectory())
+
+
+def _diode_sweeps(n_sweeps, n_points = 61, seed = 0):
+    rng = np.random.default_rng(seed)
+    current = np.linspace(0, 300e-9, n_points)
+    sweeps = []
+    for i in range(n_sweeps):
+        sweeps.append(pd.DataFrame({'VDL': simulator.diode_voltage(current, 0.85) + rng.normal(0, 1e-4, n_points) + 1e-4*i,
+                                    'VDR': simulator.diode_voltage(current, 0.90) + rng.normal(0, 1e-4, n_points),
+                                    'IDL': current, 'IDR': current}))
+    return sweeps
+
+
+@contextlib.contextmanager
+def _quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+# trace parsing
+
+def setup_parse_trace():
+    values = np.linspace(0, 300e-9, 61)
+    return ",".join("N%+.6E" % value for value in values) + "\n"
+
+def bench_parse_trace(raw):
+    parse_trace(raw)
+
+
+def setup_parse_trace_long():
+    values = np.linspace(0, 1e-6, 5000)
+    return ",".join("N%+.6E" % value for value in values) + "\n"
+
+def bench_parse_trace_long(raw):
+    parse_trace(raw)
+
+
+# sweep assembly (setup commands, polling, DO and parsing of the 4 traces)
+
+def setup_diode_connection_sweep():
+    return simulator.simulated_smu()
+
+def bench_diode_connection_sweep(smu):
+    smu.diode_connection('CH1', 'CH3', 'CH2', '0', '300E-09', '5E-09')
+
+
+def setup_diode_connection_cold():
+    return simulator.simulated_smu()
+
+def bench_diode_connection_cold(smu):
+    # full setup sent every time (no configuration cache), as before the cache
+    smu.invalidate_setup()
+    smu.diode_connection('CH1', 'CH3', 'CH2', '0', '300E-09', '5E-09')
+
+
+def setup_vgsids_sweep():
+    return simulator.simulated_smu()
+
+def bench_vgsids_sweep(smu):
+    smu.VgsIds('CH1', 'CH3', 'CH2', '-0.5', '0.1', '0', '-1', '-0.01', '0.1', '2')
+
+
+# statistics
+
+def setup_calculate_mean_std():
+    return _diode_sweeps(20)
+
+def bench_calculate_mean_std(sweeps):
+    utils.calculate_mean_std(5, 6, sweeps, 'VDL')
+    utils.calculate_mean_std(5, 6, sweeps, 'VDR')
+
+
+def setup_calculate_vth_batch():
+    vgs = np.linspace(0, -1, 101)
+    return [(vgs, np.abs(simulator.transfer_current(vgs, vth = -0.3 - 0.001*i))) for i in range(50)]
+
+def bench_calculate_vth_batch(curves):
+    with _quiet():
+        for vgs, ids in curves:
+            utils.calculate_vth(vgs, ids)
+
+def setup_square_law_batch():
+    return setup_calculate_vth_batch()
+
+def bench_square_law_batch(curves):
+    import squarelaw
+    squarelaw.fit_square_law(*squarelaw.stack_curves(curves))
+
+
+# settling fits of 1000 segments of 30 readings (sensing time series)
+
+def setup_kinetics_fit():
+    rng = np.random.default_rng(0)
+    t = 2.0*np.arange(30)
+    tau = rng.uniform(5, 20, (1000, 1))
+    return t, 0.25 + 0.01*np.exp(-t/tau) + rng.normal(0, 1e-4, (1000, 30))
+
+def bench_kinetics_fit(state):
+    import kinetics
+    kinetics.fit_settling(*state)
+
+
+# curve-similarity query on a library of 20000 sweeps
+
+def setup_similarity_query():
+    import similarity
+    library = _folder()
+    index = similarity.SimilarityIndex(library)
+    sweeps = _diode_sweeps(2000)
+    for i in range(10):
+        index.add(sweeps, file = 'w'+str(i)+'.xlsx', step = np.arange(len(sweeps)))
+    # round trip: the sweeps are stored once and a stored sweep is its own nearest neighbour
+    if len(similarity.SimilarityIndex(library)) != 20000 or index.add(sweeps, file = 'w0.xlsx', step = np.arange(len(sweeps))):
+        raise RuntimeError('similarity index round trip: wrong number of sweeps')
+    probe = sweeps[0].copy()
+    probe['VDR'] = probe['VDR'].to_numpy()[::-1]
+    index.add([probe], file = 'probe.xlsx')
+    neighbours = index.query(probe, k = 10)
+    if neighbours['file'].iloc[0] != 'probe.xlsx' or neighbours['distance'].iloc[0] > 1e-4:
+        raise RuntimeError('similarity index round trip: the query does not find the stored sweep')
+    return index, sweeps[0]
+
+def bench_similarity_query(state):
+    index, sweep = state
+    index.query(sweep, k = 10)
+
+
+# plotting
+
+def setup_plot_max_values():
+    import matplotlib
+    matplotlib.use('Agg')
+    conc = ['c'+str(i) for i in range(5)]
+    return {c: pd.concat(_diode_sweeps(20, seed = i)) for i, c in enumerate(conc)}, conc
+
+def bench_plot_max_values(state):
+    import matplotlib.pyplot as plt
+    data, conc = state
+    with _quiet():
+        utils.plot_max_values(data, conc, 'r1c1', 1, 'DUT', 'TOT', mode = 3)
+    plt.close('all')
+
+
+# downsampling of a trace of 10^6 points for plotting
+
+def setup_downsample_view():
+    import downsample
+    rng = np.random.default_rng(0)
+    y = np.cumsum(rng.normal(0, 1e-4, 1000000))
+    return downsample.Pyramid(np.arange(len(y)), y), y
+
+def bench_downsample_view(state):
+    pyramid, _ = state
+    pyramid.view(250000, 750000, 3000)
+
+def setup_downsample_lttb():
+    return setup_downsample_view()[1]
+
+def bench_downsample_lttb(y):
+    import downsample
+    downsample.lttb(np.arange(len(y)), y, 3000)
+
+
+# saving: Excel workbook vs columnar file of the same sweeps (the hooks of save_xls are timed separately)
+
+def setup_save_xls():
+    folder = _folder()
+    return folder, {'c'+str(i): pd.concat(_diode_sweeps(20, seed = i)) for i in range(3)}
+
+def bench_save_xls(state):
+    folder, data = state
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        with _quiet():
+            utils.save_xls(data, 'DUT', 'bench', features = False, catalog = False, similarity = False)
+    finally:
+        os.chdir(cwd)
+
+
+# hooks of save_xls on the workbook of setup_save_xls
+
+def setup_save_hooks():
+    folder, data = setup_save_xls()
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        with _quiet():
+            directory = utils.save_xls(data, 'DUT', 'bench', features = False, catalog = False, similarity = False)
+    finally:
+        os.chdir(cwd)
+    return folder, os.path.join(folder, directory, directory+'.xlsx'), data
+
+def setup_save_features():
+    return setup_save_hooks()
+
+def bench_save_features(state):
+    import features
+    _, workbook, data = state
+    features.save_features(workbook, data, DUT = 'DUT', TOT = 'bench')
+
+def setup_catalog_register():
+    folder, workbook, data = setup_save_hooks()
+    import features
+    features.save_features(workbook, data, DUT = 'DUT', TOT = 'bench')
+    return folder, workbook, data
+
+def bench_catalog_register(state):
+    import catalog
+    folder, workbook, data = state
+    catalog.register_saved(workbook, data, catalog_path = os.path.join(folder, 'catalog.sqlite'))
+
+def setup_similarity_add():
+    return setup_save_hooks() + (itertools.count(),)
+
+def bench_similarity_add(state):
+    # into a new library every call (the sweeps already stored are skipped)
+    import similarity
+    folder, workbook, data, libraries = state
+    similarity.add_saved(workbook, data, root = os.path.join(folder, 'library%d' % next(libraries)), DUT = 'DUT', TOT = 'bench')
+
+
+def setup_save_columnar():
+    return setup_save_xls()
+
+def bench_save_columnar(state):
+    folder, data = state
+    table = pd.concat(data, names=['step', 'point']).reset_index()
+    np.savez(os.path.join(folder, 'bench.npz'), **{column: table[column].to_numpy() for column in table.columns if column != 'step'},
+             step=table['step'].to_numpy().astype(str))
+
+
+def setup_save_archive():
+    return setup_save_xls()
+
+def bench_save_archive(state):
+    import trace_codec
+    folder, data = state
+    trace_codec.save_archive(os.path.join(folder, 'bench-traces.npz'), data)
+
+
+def setup_load_archive():
+    import trace_codec
+    folder, data = setup_save_xls()
+    return trace_codec.save_archive(os.path.join(folder, 'bench-traces.npz'), data)
+
+def bench_load_archive(path):
+    import trace_codec
+    with trace_codec.TraceArchive(path) as archive:
+        archive.sheets()
+
+
+# notebook style folder loading (listdir + filename filter + read every sheet)
+
+def setup_folder_loading():
+    folder = _folder()
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        with _quiet():
+            for i in range(5):
+                utils.save_xls({'c0': pd.concat(_diode_sweeps(20, seed = i))}, 'DUT', 'load', 'T'+str(i))
+    finally:
+        os.chdir(cwd)
+    return folder
+
+def bench_folder_loading(folder):
+    for directory in os.listdir(folder):
+        if not os.path.isdir(os.path.join(folder, directory)): # catalog.sqlite, the similarity library
+            continue
+        for excelfile in os.listdir(os.path.join(folder, directory)):
+            if excelfile.endswith('.xlsx') and 'T' in excelfile:
+                pd.read_excel(os.path.join(folder, directory, excelfile), sheet_name=None)
+
+
+def benchmarks(keywords = None):
+    """
+    Return {name: (setup, bench)} of the benchmarks defined in this module, filtered by keywords.
+    """
+    names = [name[6:] for name in globals() if name.startswith('bench_')]
+    if keywords:
+        names = [name for name in names if any(keyword in name for keyword in keywords)]
+    return {name: (globals().get('setup_'+name), globals()['bench_'+name]) for name in names}
+
+
+def run(keywords = None, repeat = 5, min_time = 0.2):
+    """
+    Run the benchmarks.
+
+    Parameters:
+    - keywords (list, optional): run only the benchmarks whose name contains one of these. Default is all.
+    - repeat (int, optional): number of timing repetitions. Default is 5.
+    - min_time (float, optional): minimum seconds of each repetition (the number of calls is calibrated on it). Default is 0.2.
+
+    Returns:
+    - results (dict): name -> {'min', 'median', 'mean', 'std', 'number'} seconds per call.
+    """
+    results = {}
+    for name, (setup, bench) in benchmarks(keywords).items():
+        with _folders:
+            state = setup() if setup else None
+            timer = timeit.Timer(lambda: bench(state))
+            number, elapsed = timer.autorange()
+            number = max(1, int(number*min_time/max(elapsed, 1e-9)))
+            times = np.array(timer.repeat(repeat = repeat, number = number))/number
+        results[name] = {'min': times.min(), 'median': float(np.median(times)), 'mean': times.mean(),
+                         'std': times.std(), 'number': number}
+        print('%-28s %12.3f ms  (+- %.3f ms, %d calls x %d)' % (name, results[name]['median']*1e3, results[name]['std']*1e3, number, repeat))
+    return results
+
+
+def commit_id():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save(results, commit = None):
+    """
+    Save the results in .benchmarks/<commit>.json and return the path.
+    """
+    commit = commit or commit_id()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, commit+'.json')
+    with open(path, 'w') as f:
+        json.dump({'commit': commit, 'date': datetime.now().isoformat(), 'python': sys.version.split()[0],
+                   'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.platform(),
+                   'results': results}, f, indent=1)
+    return path
+
+
+def compare(results, commit, threshold = 0.1):
+    """
+    Print the change of the median time of each benchmark with respect to the results saved for commit.
+    Changes slower than threshold (relative) are flagged as regressions.
+    """
+    with open(os.path.join(RESULTS_DIR, commit+'.json')) as f:
+        reference = json.load(f)['results']
+    for name, result in results.items():
+        if name not in reference:
+            continue
+        change = result['median']/reference[name]['median'] - 1
+        flag = 'REGRESSION' if change > threshold else ''
+        print('%-28s %+7.1f %%  %s' % (name, change*100, flag))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Acquisition-to-result benchmarks (simulated instrument)')
+    parser.add_argument('-k', nargs='*', dest='keywords', help='run only the benchmarks containing these names')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--compare', help='commit to compare with')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    results = run(args.keywords, args.repeat, args.min_time)
+    if not args.no_save:
+        print('saved', save(results))
+    if args.compare:
+        compare(results, args.compare)
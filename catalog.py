@@ -0,0 +1,403 @@
+"""
+Embedded SQLite catalog of the results: runs (mmddyyyy-device-TOT folders), devices, couples, set-points
+(concentration, temperature, strain), file locations and the summary features of features.py.
+It is filled by utils.save_xls when a workbook is saved and by scan() for the folders written before.
+
+Usage:
+    python catalog.py results/                       # back-fill the catalog of the folder results/
+    with catalog.Catalog('results/catalog.sqlite') as cat:
+        cat.find(device='d030824-II', setpoint='temperature', value=40, stabilized=True)
+
+The catalog is results/catalog.sqlite next to the folders (utils.save_xls writes in the working directory),
+or the file in the WEARS_CATALOG environment variable.
+"""
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+
+import pandas as pd
+
+CATALOG_NAME = 'catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS couples (id INTEGER PRIMARY KEY, device_id INTEGER NOT NULL REFERENCES devices(id),
+                                    name TEXT NOT NULL, UNIQUE(device_id, name));
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, folder TEXT NOT NULL UNIQUE, date TEXT,
+                                 device_id INTEGER REFERENCES devices(id), tot TEXT, kind TEXT);
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, run_id INTEGER REFERENCES runs(id),
+                                  couple_id INTEGER REFERENCES couples(id), path TEXT NOT NULL UNIQUE,
+                                  comment TEXT, size INTEGER, mtime REAL, sweeps INTEGER, added REAL);
+CREATE TABLE IF NOT EXISTS setpoints (file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                                      kind TEXT NOT NULL, label TEXT, value REAL);
+CREATE TABLE IF NOT EXISTS stabilizations (device_id INTEGER NOT NULL REFERENCES devices(id),
+                                           couple_id INTEGER REFERENCES couples(id), date TEXT NOT NULL, time REAL,
+                                           UNIQUE(device_id, couple_id, date));
+CREATE TABLE IF NOT EXISTS features (file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+                                     sheet TEXT, step INTEGER, points INTEGER, max_L REAL, max_R REAL,
+                                     last_mean_L REAL, last_mean_R REAL, diff_last REAL, diff_last_mean REAL,
+                                     vth REAL, vth_secondder REAL, response REAL);
+CREATE INDEX IF NOT EXISTS runs_device_date ON runs(device_id, date);
+CREATE INDEX IF NOT EXISTS runs_kind ON runs(kind, date);
+CREATE INDEX IF NOT EXISTS files_run ON files(run_id);
+CREATE INDEX IF NOT EXISTS files_couple ON files(couple_id);
+CREATE INDEX IF NOT EXISTS setpoints_kind_value ON setpoints(kind, value, file_id);
+CREATE INDEX IF NOT EXISTS setpoints_file ON setpoints(file_id);
+CREATE INDEX IF NOT EXISTS features_file ON features(file_id, sheet, step);
+"""
+
+FEATURE_COLUMNS = ('sheet', 'step', 'points', 'max_L', 'max_R', 'last_mean_L', 'last_mean_R', 'diff_last', 'diff_last_mean',
+                   'vth', 'vth_secondder', 'response')
+
+# first word of the types of test, used to find where the device name ends in a folder name
+TOT_PREFIXES = ('DiodeConnected', 'Diode', 'VgsIds', 'VGS', 'Egofet', 'EGOFET', 'Stability', 'Sensing', 'Strain',
+                'Temperature', 'Conductivity', 'Calibration')
+
+_FOLDER = re.compile(r'^(\d{2})(\d{2})(\d{4})-(.+)$')
+_COUPLE = re.compile(r'r\d+c\d+')
+# couple followed by an optional concentration label (the lazy column number leaves its digits to the label)
+_COUPLE_CONCENTRATION = re.compile(r'(r\d+c\d+?)(?:\d+(?:\.\d+)?(?:fM|pM|nM|uM|mM|M)|baseline)?$')
+_TEMPERATURE = re.compile(r'(-?\d+(?:\.\d+)?)\s*(?:C|degC)$')
+_STRAIN = re.compile(r'(-?\d+(?:\.\d+)?)\s*%$')
+
+
+def default_path(root = None):
+    """
+    Path of the catalog: the WEARS_CATALOG environment variable, or catalog.sqlite in root (default: working directory).
+    """
+    return os.environ.get('WEARS_CATALOG') or os.path.join(root or os.getcwd(), CATALOG_NAME)
+
+
+def concentration_value(conc):
+    """
+    Numeric value of a concentration label ('10mM', '1pM', 'baseline' -> 0) in M.
+    """
+    units = {'fM': 1e-15, 'pM': 1e-12, 'nM': 1e-9, 'uM': 1e-6, 'mM': 1e-3, 'M': 1}
+    for unit in sorted(units, key=len, reverse=True):
+        if conc.endswith(unit):
+            try:
+                return float(conc[:-len(unit)])*units[unit]
+            except ValueError:
+                break
+    return 0.0
+
+
+def couple_of(comment, concentrations = ()):
+    """
+    Couple (rXcY) in the comment of a file name (tests_ saves couple+concentration, e.g. 'r1c11nM' -> 'r1c1').
+
+    Parameters:
+    - comment (str): file name after the folder name, without extension.
+    - concentrations (list, optional): concentration labels of the file (its sheets), stripped from the end first.
+
+    Returns:
+    - couple (str): the couple, or None.
+    """
+    for label in sorted(map(str, concentrations), key=len, reverse=True):
+        if label and comment.endswith(label) and _COUPLE.fullmatch(comment[:-len(label)]):
+            return comment[:-len(label)]
+    match = _COUPLE_CONCENTRATION.search(comment)
+    if match:
+        return match.group(1)
+    match = _COUPLE.search(comment)
+    return match.group(0) if match else None
+
+
+def parse_folder(name):
+    """
+    Split a folder name built by utils.create_folder (mmddyyyy-device-TOT[-comment]).
+
+    Returns:
+    - run (dict): 'date' (yyyy-mm-dd), 'device', 'tot', 'kind' and 'setpoints' (list of (kind, label, value)),
+      or None if the name is not a run folder.
+    """
+    match = _FOLDER.match(name)
+    if not match:
+        return None
+    month, day, year, rest = match.groups()
+    try:
+        date = datetime(int(year), int(month), int(day)).strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+    parts = rest.split('-')
+    start = next((i for i, part in enumerate(parts) if i > 0 and part.startswith(TOT_PREFIXES)), 1 if len(parts) > 1 else None)
+    if start is None:
+        return None
+    device, tot = '-'.join(parts[:start]), '-'.join(parts[start:])
+    setpoints = []
+    for part in parts[start:]:
+        temperature, strain = _TEMPERATURE.search(part), _STRAIN.search(part)
+        if temperature:
+            setpoints.append(('temperature', part, float(temperature.group(1))))
+        elif strain:
+            setpoints.append(('strain', part, float(strain.group(1))))
+    lower = tot.lower()
+    kind = next((kind for kind in ('stability', 'sensing', 'strain', 'temperature', 'vgsids', 'egofet') if kind in lower), 'other')
+    return {'date': date, 'device': device, 'tot': tot, 'kind': kind, 'setpoints': setpoints}
+
+
+class Catalog:
+
+    def __init__(self, path = None):
+        """
+        Open (creating it if needed) the catalog at path (default: default_path()).
+        """
+        self.path = path or default_path()
+        self.connection = sqlite3.connect(self.path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL') # readers don't block the acquisitions writing
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript(SCHEMA)
+        if 'time' not in [row[1] for row in self.connection.execute('PRAGMA table_info(stabilizations)')]:
+            with self.connection: # catalogs created before the stabilization times
+                self.connection.execute('ALTER TABLE stabilizations ADD COLUMN time REAL')
+        if 'diff_max' in [row[1] for row in self.connection.execute('PRAGMA table_info(features)')]:
+            with self.connection: # catalogs created before features.RENAMED
+                self.connection.execute('ALTER TABLE features RENAME COLUMN diff_max TO diff_last')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get_or_create(self, table, **values):
+        # values are the UNIQUE columns of the table: a row created by another writer meanwhile is ignored, not an error
+        self.connection.execute('INSERT OR IGNORE INTO '+table+' ('+', '.join(values)+') VALUES ('+', '.join('?'*len(values))+')',
+                                tuple(values.values()))
+        where = ' AND '.join(column+' IS ?' for column in values)
+        return self.connection.execute('SELECT id FROM '+table+' WHERE '+where, tuple(values.values())).fetchone()[0]
+
+    def add_file(self, path, sheets = None, features = None, sweeps = None, comment = None, stabilized = None, couple = None):
+        """
+        Add (or update) a file and its run, device, couple and set-points.
+
+        Parameters:
+        - path (str): path of the file, in a mmddyyyy-device-TOT folder.
+        - sheets (list, optional): sheet names of the workbook; the ones that are concentrations become set-points.
+        - features (pd.DataFrame, optional): feature table of the file (features.feature_table).
+        - sweeps (int, optional): number of sweeps in the file. Default: rows of features.
+        - comment (str, optional): comment of the file (save_xls additional_comment).
+        - stabilized (bool, optional): for the stability runs, whether the couple reached stability. Default is None: assumed
+          True (back-fill of the folders, where the outcome isn't recorded).
+        - couple (str, optional): couple of the file. Default is None: parsed from the file name (couple_of, with the
+          concentrations in sheets).
+
+        Returns:
+        - file_id (int): ID of the file, or None if its folder is not a run folder.
+        """
+        path = os.path.abspath(path)
+        folder = os.path.basename(os.path.dirname(path))
+        run = parse_folder(folder)
+        if run is None:
+            return None
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE') # one writer at a time (other rigs, threads)
+            device_id = self._get_or_create('devices', name=run['device'])
+            run_id = self._get_or_create('runs', folder=os.path.dirname(path))
+            self.connection.execute('UPDATE runs SET date = ?, device_id = ?, tot = ?, kind = ? WHERE id = ?',
+                                    (run['date'], device_id, run['tot'], run['kind'], run_id))
+            if couple is None:
+                couple = couple_of(os.path.splitext(os.path.basename(path))[0][len(folder):], sheets or ())
+            couple_id = self._get_or_create('couples', device_id=device_id, name=couple) if couple else None
+            stat = os.stat(path)
+            if sweeps is None and features is not None:
+                sweeps = len(features)
+            self.connection.execute('INSERT OR IGNORE INTO files (path, added) VALUES (?, ?)', (path, time.time()))
+            file_id = self.connection.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchone()[0]
+            self.connection.execute('UPDATE files SET run_id = ?, couple_id = ?, comment = ?, size = ?, mtime = ?, sweeps = ? WHERE id = ?',
+                                    (run_id, couple_id, comment, stat.st_size, stat.st_mtime, sweeps, file_id))
+            self.connection.execute('DELETE FROM setpoints WHERE file_id = ?', (file_id,))
+            self.connection.execute('DELETE FROM features WHERE file_id = ?', (file_id,))
+            setpoints = list(run['setpoints'])
+            for sheet in sheets or []:
+                sheet = str(sheet)
+                if sheet == 'baseline' or concentration_value(sheet):
+                    setpoints.append(('concentration', sheet, concentration_value(sheet)))
+            self.connection.executemany('INSERT INTO setpoints (file_id, kind, label, value) VALUES (?, ?, ?, ?)',
+                                        [(file_id,) + tuple(setpoint) for setpoint in setpoints])
+            if features is not None and len(features):
+                table = features.reindex(columns=list(FEATURE_COLUMNS))
+                table = table.astype(object).where(table.notna(), None)
+                self.connection.executemany('INSERT INTO features (file_id, '+', '.join(FEATURE_COLUMNS)+') VALUES (?'+', ?'*len(FEATURE_COLUMNS)+')',
+                                            [(file_id,) + tuple(row) for row in table.itertuples(index=False)])
+            if run['kind'] == 'stability' and stabilized is not False:
+                self._mark_stabilized(device_id, couple_id, stat.st_mtime) # the end of the stability run
+        return file_id
+
+    def _mark_stabilized(self, device_id, couple_id, timestamp):
+        # the earliest stabilization of the day is kept
+        date = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+        self.connection.execute('INSERT INTO stabilizations (device_id, couple_id, date, time) VALUES (?, ?, ?, ?) '
+                                'ON CONFLICT (device_id, couple_id, date) DO UPDATE SET time = min(coalesce(time, excluded.time), excluded.time)',
+                                (device_id, couple_id, date, timestamp))
+
+    def mark_stabilized(self, device, couple = None, date = None):
+        """
+        Record that the couple of device reached stability at date (datetime or 'yyyy-mm-dd[ HH:MM[:SS]]', default now):
+        its files modified later count as after stabilization.
+        """
+        if date is None:
+            date = datetime.now()
+        elif isinstance(date, str):
+            date = datetime.fromisoformat(date)
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            device_id = self._get_or_create('devices', name=device)
+            couple_id = self._get_or_create('couples', device_id=device_id, name=couple) if couple else None
+            self._mark_stabilized(device_id, couple_id, date.timestamp())
+
+    def is_current(self, path):
+        """
+        True if path is in the catalog with its current size and modification time.
+        """
+        row = self.connection.execute('SELECT size, mtime FROM files WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(path)
+        return row[0] == stat.st_size and row[1] == stat.st_mtime
+
+    def query(self, sql, params = ()):
+        """
+        Run a SQL query on the catalog and return the result as a DataFrame.
+        """
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def find(self, device = None, couple = None, kind = None, tot = None, setpoint = None, value = None, label = None,
+             date_from = None, date_to = None, stabilized = None, with_features = False):
+        """
+        Find files.
+
+        Parameters:
+        - device, couple (str, optional): names.
+        - kind (str, optional): kind of run ('stability', 'sensing', 'strain', 'temperature', 'vgsids', 'egofet', 'other').
+        - tot (str, optional): substring of the TOT.
+        - setpoint (str, optional): kind of set-point ('concentration', 'temperature', 'strain'), with value and/or label.
+        - value (float, optional): value of the set-point (temperature in C, strain in %, concentration in M).
+        - label (str, optional): label of the set-point (e.g. '10mM').
+        - date_from, date_to (str, optional): yyyy-mm-dd bounds (included).
+        - stabilized (bool, optional): only files measured (modified) after (True) / without (False) a stabilization of their couple.
+        - with_features (bool, optional): return one row per sweep with the features instead of one row per file.
+
+        Returns:
+        - files (pd.DataFrame): 'path', 'folder' (path of the run folder), 'date', 'device', 'tot', 'kind', 'couple', 'comment', 'sweeps' (and the features).
+        """
+        where, params = [], []
+        for column, parameter in (('d.name', device), ('c.name', couple), ('r.kind', kind)):
+            if parameter is not None:
+                where.append(column+' = ?')
+                params.append(parameter)
+        if tot is not None:
+            where.append("r.tot LIKE ?")
+            params.append('%'+tot+'%')
+        if date_from is not None:
+            where.append('r.date >= ?')
+            params.append(date_from)
+        if date_to is not None:
+            where.append('r.date <= ?')
+            params.append(date_to)
+        if setpoint is not None or value is not None or label is not None:
+            condition = ['s.file_id = f.id']
+            for column, parameter in (('s.kind', setpoint), ('s.label', label)):
+                if parameter is not None:
+                    condition.append(column+' = ?')
+                    params.append(parameter)
+            if value is not None:
+                condition.append('abs(s.value - ?) <= 1e-9*max(abs(?), 1e-30)')
+                params += [value, value]
+            where.append('EXISTS (SELECT 1 FROM setpoints s WHERE '+' AND '.join(condition)+')')
+        if stabilized is not None:
+            where.append(('' if stabilized else 'NOT ')+'EXISTS (SELECT 1 FROM stabilizations z WHERE z.device_id = r.device_id '
+                         'AND (z.couple_id = f.couple_id OR z.couple_id IS NULL) '
+                         'AND (z.time <= f.mtime OR (z.time IS NULL AND z.date <= r.date))) AND r.kind != ?')
+            params.append('stability')
+        columns = 'f.path, r.folder, r.date, d.name AS device, r.tot, r.kind, c.name AS couple, f.comment, f.sweeps'
+        joins = ('FROM files f JOIN runs r ON f.run_id = r.id JOIN devices d ON r.device_id = d.id '
+                 'LEFT JOIN couples c ON f.couple_id = c.id')
+        if with_features:
+            columns += ', ' + ', '.join('x.'+column for column in FEATURE_COLUMNS)
+            joins += ' JOIN features x ON x.file_id = f.id'
+        sql = 'SELECT '+columns+' '+joins + (' WHERE '+' AND '.join(where) if where else '') + ' ORDER BY r.date, f.path'
+        return self.query(sql, params)
+
+
+def _features_of(path, compute = False):
+    import features
+    csv = features.features_path(path)
+    if os.path.exists(csv) and os.path.getmtime(csv) >= os.path.getmtime(path):
+        return pd.read_csv(csv, dtype={'sheet': str}).rename(columns=features.RENAMED)
+    if compute and path.endswith('.xlsx'):
+        return features.load_features(path)
+    return None
+
+
+def register_saved(path, list_df, comment = None, catalog_path = None, couple = None):
+    """
+    Add a workbook just written by utils.save_xls to the catalog (with its feature table, if saved).
+
+    Parameters:
+    - path (str): path of the workbook.
+    - list_df (list or dict): sheets of the workbook.
+    - comment (str, optional): additional comment of the workbook.
+    - catalog_path (str, optional): catalog file. Default is default_path() (the working directory, where save_xls writes).
+    - couple (str, optional): couple of the workbook. Default is None (parsed from the file name).
+    """
+    sheets = list(list_df.keys()) if isinstance(list_df, dict) else None
+    sweeps = None if isinstance(list_df, dict) else len(list_df)
+    with Catalog(catalog_path) as cat:
+        return cat.add_file(path, sheets, _features_of(path), sweeps, comment, stabilized = False, couple = couple)
+
+
+def scan(root, catalog_path = None, compute_features = False, extensions = ('.xlsx', '.xls', '.txt')):
+    """
+    Back-fill the catalog with the files of the run folders (mmddyyyy-device-TOT) under root. Files already
+    catalogued with the same size and modification time are skipped.
+
+    Parameters:
+    - root (str): folder to scan.
+    - catalog_path (str, optional): catalog file. Default is default_path(root).
+    - compute_features (bool, optional): compute the feature tables missing (features.load_features). Default is False.
+    - extensions (tuple, optional): extensions of the files to catalog.
+
+    Returns:
+    - added (int): number of files added or updated.
+    """
+    added = 0
+    with Catalog(catalog_path or default_path(root)) as cat:
+        for directory, _, files in os.walk(root):
+            if parse_folder(os.path.basename(directory)) is None:
+                continue
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                if not name.endswith(extensions) or name.startswith(('~$', '.')) or cat.is_current(path):
+                    continue
+                table = _features_of(path, compute_features) if name.endswith(('.xlsx', '.xls')) else None
+                sheets = None
+                if table is not None:
+                    sheets = list(dict.fromkeys(table['sheet']))
+                elif name.endswith(('.xlsx', '.xls')):
+                    try:
+                        sheets = [sheet[len('step #'):] if sheet.startswith('step #') else sheet for sheet in pd.ExcelFile(path).sheet_names]
+                    except Exception:
+                        sheets = None
+                if sheets is not None and all(sheet.isdigit() for sheet in sheets):
+                    sweeps, sheets = len(sheets), None # mode 2 workbook: one sweep per sheet
+                else:
+                    sweeps = None
+                if cat.add_file(path, sheets, table, sweeps) is not None:
+                    added += 1
+    return added
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Back-fill the catalog of a results folder')
+    parser.add_argument('root')
+    parser.add_argument('--catalog', help='catalog file (default: <root>/catalog.sqlite)')
+    parser.add_argument('--features', action='store_true', help='compute the missing feature tables')
+    args = parser.parse_args()
+    print(scan(args.root, args.catalog, args.features), 'files added to', args.catalog or default_path(args.root))
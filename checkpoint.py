@@ -0,0 +1,162 @@
+"""
+Incremental checkpoint of the long acquisition protocols (tests_.stability_test, tests_.sensing_test).
+
+The checkpoint is an append-only log: every completed sweep and every update of the running state is
+appended as one record (4 bytes length + pickle) and flushed to disk, so a crash loses at most the sweep
+being measured and writing a record costs the size of that record only (the workbooks are rewritten as a
+whole instead). Loading reads the log once, in O(checkpoint size); a record truncated by a crash while
+writing is ignored.
+
+Usage:
+    ckpt = checkpoint.RunCheckpoint('d030824-IIr3c1.ckpt')
+    diode_df, mean_diff = tests_.stability_test(..., checkpoint = ckpt)      # resumes at the next sweep
+    k, diode_df_dict, ... = tests_.sensing_test(..., checkpoint = ckpt)    # resumes at the next run
+"""
+import os
+import pickle
+import struct
+
+_HEADER = struct.Struct('<I')
+
+
+class RunCheckpoint:
+
+    def __init__(self, path, sync = True):
+        """
+        Open the checkpoint at path, loading the records already written (if any).
+
+        Parameters:
+        - path (str): file of the checkpoint.
+        - sync (bool, optional): fsync after every record (survives a power loss, not only a kernel crash). Default is True.
+        """
+        self.path = path
+        self.sync = sync
+        self.state = {}
+        self._sweeps = {}   # (phase, key) -> list of DataFrames
+        self._meta = {}     # (phase, key) -> list of dicts
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        valid = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                payload = f.read(_HEADER.unpack(header)[0])
+                try:
+                    record = pickle.loads(payload)
+                except Exception: # truncated by a crash while writing
+                    break
+                self._apply(record)
+                valid = f.tell()
+        if valid < os.path.getsize(self.path):
+            # drop the torn tail, so the next records are appended after the last valid one
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid)
+
+    def _apply(self, record):
+        kind = record[0]
+        if kind == 'sweep':
+            _, phase, key, data, meta = record
+            self._sweeps.setdefault((phase, key), []).append(data)
+            self._meta.setdefault((phase, key), []).append(meta)
+        elif kind == 'state':
+            self.state.update(record[1])
+        elif kind == 'clear':
+            _, phase = record
+            for store in (self._sweeps, self._meta):
+                for stored in [stored for stored in store if stored[0] == phase]:
+                    del store[stored]
+
+    def _append(self, record):
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self.path, 'ab') as f:
+            f.write(_HEADER.pack(len(payload)) + payload)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        self._apply(record)
+
+    def add_sweep(self, phase, key, data, **meta):
+        """
+        Record a completed sweep.
+
+        Parameters:
+        - phase (str): protocol of the sweep ('stability', 'sensing').
+        - key: group of the sweep inside the phase (e.g. the concentration).
+        - data (pd.DataFrame): the sweep.
+        - meta: running values computed with this sweep (e.g. diff=..., VDL_VDR=...).
+        """
+        self._append(('sweep', phase, key, data, meta))
+
+    def set_state(self, **values):
+        """
+        Record the running state (the values given replace the previous ones).
+        """
+        self._append(('state', values))
+
+    def clear(self, phase):
+        """
+        Forget the sweeps of a phase (e.g. a stability test restarted from scratch).
+        """
+        self._append(('clear', phase))
+
+    def sweeps(self, phase, key = None):
+        """
+        Return the list of the sweeps recorded for (phase, key), in order of acquisition.
+        """
+        return list(self._sweeps.get((phase, key), []))
+
+    def meta(self, phase, key = None, name = None):
+        """
+        Return the meta dicts recorded with the sweeps of (phase, key), or the list of the values of name.
+        """
+        meta = self._meta.get((phase, key), [])
+        return [m.get(name) for m in meta] if name else list(meta)
+
+    def keys(self, phase):
+        """
+        Return the keys of the phase with recorded sweeps, in order of first acquisition.
+        """
+        return [key for stored_phase, key in self._sweeps if stored_phase == phase]
+
+    def stability_state(self):
+        """
+        Return the variables of tests_.stability_test restored from the checkpoint.
+
+        Returns:
+        - diode_df (list): recorded sweeps.
+        - mean_diff (list): mean differences computed at each step.
+        - done (bool): True if the test reached stability.
+        """
+        return self.sweeps('stability'), self.meta('stability', name='diff')[1:], bool(self.state.get('stability_done'))
+
+    def sensing_state(self, conc):
+        """
+        Return the variables passed between the calls of tests_.sensing_test, restored from the checkpoint
+        (the concentrations before conc[k] are complete; the runs of conc[k] are picked up by sensing_test itself).
+
+        Parameters:
+        - conc (list of str): concentrations of the test.
+
+        Returns:
+        - k, diode_df_dict, diode_dict_list, mean_std, mean_std_L, mean_std_R, folder, baseline: as returned by tests_.sensing_test.
+        """
+        import pandas as pd
+        k = self.state.get('k', 0)
+        diode_df_dict, diode_dict_list = {}, {}
+        for c in conc[:k]:
+            diode_dict_list[c] = self.sweeps('sensing', c)
+            data_save = pd.concat(diode_dict_list[c])
+            data_save['DIFFV'] = abs(data_save['VDL'] - data_save['VDR'])
+            diode_df_dict[c] = data_save
+        return (k, diode_df_dict, diode_dict_list, self.state.get('mean_std', []), self.state.get('mean_std_L', []),
+                self.state.get('mean_std_R', []), self.state.get('folder'), self.state.get('baseline', 0))
+
+    def __repr__(self):
+        counts = {}
+        for (phase, key), sweeps in self._sweeps.items():
+            counts[phase] = counts.get(phase, 0) + len(sweeps)
+        return 'RunCheckpoint(%r, sweeps=%r, state=%r)' % (self.path, counts, sorted(self.state))
@@ -0,0 +1,183 @@
+"""
+Downsampling of long traces for plotting (stability_test histories, concatenated data_save frames, PCB
+captures): the figures only draw what the viewport can show.
+
+- lttb(): Largest-Triangle-Three-Buckets, a fixed number of points keeping the visual shape of the trace
+  (static figures, saved images).
+- Pyramid: min/max decimation pyramid built once per trace (levels of buckets of factor**k points, each
+  level built from the previous one in O(n) overall). view(x0, x1, points) serves the min and max of the
+  buckets of the finest level with at most `points` points in the range, so spikes are never dropped,
+  and the raw points once the range is small enough.
+- scatter() and plotly_figure() draw a trace through a pyramid and refine it on zoom (matplotlib
+  xlim_changed callback, plotly FigureWidget relayout).
+
+Usage:
+    idx = downsample.lttb(x, y, 2000)
+    downsample.scatter(ax, x, y, max_points = 10000, color = 'C0')
+"""
+import numpy as np
+
+
+def lttb(x, y, n_out):
+    """
+    Select n_out points of a trace with Largest-Triangle-Three-Buckets.
+
+    Parameters:
+    - x, y (np.array): trace (x increasing).
+    - n_out (int): number of points to keep (first and last included).
+
+    Returns:
+    - indices (np.array): indices of the points kept, increasing.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # n_out - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    finite = np.isfinite(x) & np.isfinite(y)
+    counts = np.add.reduceat(finite.astype(int), edges)[:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = np.add.reduceat(np.where(finite, x, 0), edges)[:-1]/counts
+        mean_y = np.add.reduceat(np.where(finite, y, 0), edges)[:-1]/counts
+    # the third point of the triangle of bucket i is the mean of bucket i + 1 (the last point for the last bucket)
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        low, high = edges[i], edges[i + 1]
+        area = np.abs((x[a] - next_x[i])*(y[low:high] - y[a]) - (x[a] - x[low:high])*(next_y[i] - y[a]))
+        a = low + int(np.argmax(np.where(np.isfinite(area), area, -1)))
+        indices[i + 1] = a
+    return indices
+
+
+def _extremes(values, indices, factor):
+    # min and max of groups of factor buckets: values/indices of the buckets of the previous level
+    low, high = values
+    pad = -len(indices[0]) % factor
+    low = np.append(low, np.full(pad, np.inf)).reshape(-1, factor)
+    high = np.append(high, np.full(pad, -np.inf)).reshape(-1, factor)
+    i_low = np.append(indices[0], np.full(pad, indices[0][-1])).reshape(-1, factor)
+    i_high = np.append(indices[1], np.full(pad, indices[1][-1])).reshape(-1, factor)
+    rows = np.arange(len(low))
+    arg_low, arg_high = np.argmin(low, axis=1), np.argmax(high, axis=1)
+    return (low[rows, arg_low], high[rows, arg_high]), (i_low[rows, arg_low], i_high[rows, arg_high])
+
+
+class Pyramid:
+
+    def __init__(self, x, y, factor = 4):
+        """
+        Build the min/max pyramid of a trace.
+
+        Parameters:
+        - x, y (array like): trace; sorted by x if x is not increasing (e.g. a scatter).
+        - factor (int, optional): buckets of a level per bucket of the next level. Default is 4.
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        if len(x) > 1 and np.any(np.diff(x) < 0):
+            order = np.argsort(x, kind='stable')
+            x, y = x[order], y[order]
+        self.x, self.y = x, y
+        self.factor = factor
+        # level k (k >= 1): indices of the min and of the max of every bucket of factor**k points
+        self.levels = []
+        values = (np.where(np.isnan(y), np.inf, y), np.where(np.isnan(y), -np.inf, y))
+        indices = (np.arange(len(y)), np.arange(len(y)))
+        while len(indices[0]) > 1:
+            values, indices = _extremes(values, indices, factor)
+            self.levels.append(indices)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __repr__(self):
+        return 'Pyramid(points=%d, levels=%d, factor=%d)' % (len(self.x), len(self.levels), self.factor)
+
+    def view(self, x0 = None, x1 = None, points = 2000):
+        """
+        Return the points of the trace to draw for the range x0 <= x <= x1.
+
+        Parameters:
+        - x0, x1 (float, optional): range of x (e.g. the limits of the axis). Default is the whole trace.
+        - points (int, optional): about the number of points to return (e.g. twice the width of the axis in pixels). Default is 2000.
+
+        Returns:
+        - x, y (np.array): raw points if the range has at most `points` points, otherwise the min and max of the
+          buckets of the level matching the resolution (with the first and last point of the range).
+        """
+        low = 0 if x0 is None else int(np.searchsorted(self.x, x0, side='left'))
+        high = len(self.x) if x1 is None else int(np.searchsorted(self.x, x1, side='right'))
+        count = high - low
+        if count <= points:
+            return self.x[low:high], self.y[low:high]
+        # finest level with at most `points` points (2 per bucket) in the range
+        level = min(int(np.ceil(np.log(2*count/points)/np.log(self.factor))), len(self.levels))
+        size = self.factor**level
+        i_low, i_high = self.levels[level - 1]
+        buckets = slice(low//size, (high - 1)//size + 1)
+        indices = np.concatenate(([low, high - 1], i_low[buckets], i_high[buckets]))
+        indices = np.unique(indices[(indices >= low) & (indices < high)])
+        return self.x[indices], self.y[indices]
+
+
+def scatter(ax, x, y, max_points = 10000, **kwargs):
+    """
+    ax.scatter of a trace of any length: above max_points the points come from a Pyramid and are refined
+    when the x range of the axis changes (zoom, pan).
+
+    Parameters:
+    - ax (matplotlib Axes): axis to draw on.
+    - x, y (array like): trace.
+    - max_points (int, optional): max points drawn (None: all the points, plain ax.scatter). Default is 10000.
+    - kwargs: passed to ax.scatter (a single color, label, ...).
+
+    Returns:
+    - artist (PathCollection): the scatter.
+    """
+    if max_points is None or np.size(y) <= max_points:
+        return ax.scatter(x, y, **kwargs)
+    pyramid = Pyramid(x, y)
+    artist = ax.scatter(*pyramid.view(points = max_points), **kwargs)
+
+    def refine(ax):
+        x0, x1 = ax.get_xlim()
+        artist.set_offsets(np.column_stack(pyramid.view(x0, x1, max_points)))
+
+    ax.callbacks.connect('xlim_changed', refine)
+    return artist
+
+
+def plotly_figure(traces, max_points = 10000, mode = 'markers', **layout):
+    """
+    Plotly FigureWidget of traces of any length, served from their pyramids and refined on zoom (in Jupyter).
+
+    Parameters:
+    - traces (dict): name -> (x, y).
+    - max_points (int, optional): max points drawn per trace. Default is 10000.
+    - mode (str, optional): mode of the go.Scattergl traces. Default is 'markers'.
+    - layout: layout of the figure (title, xaxis_title, ...).
+
+    Returns:
+    - fig (go.FigureWidget): the figure.
+    """
+    import plotly.graph_objects as go
+    pyramids = {name: Pyramid(x, y) for name, (x, y) in traces.items()}
+    fig = go.FigureWidget(layout = layout)
+    for name, pyramid in pyramids.items():
+        x, y = pyramid.view(points = max_points)
+        fig.add_scattergl(x = x, y = y, mode = mode, name = name)
+
+    def refine(layout, x_range):
+        x0, x1 = x_range if x_range else (None, None)
+        with fig.batch_update():
+            for trace, pyramid in zip(fig.data, pyramids.values()):
+                trace.x, trace.y = pyramid.view(x0, x1, max_points)
+
+    fig.layout.on_change(refine, 'xaxis.range')
+    return fig
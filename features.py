@@ -0,0 +1,194 @@
+"""
+Per-sweep feature table. The features the post-processing notebooks compute from the raw curves (max of the
+left/right drain voltages, mean of the last Nlastvalues points, |VL-VR|, Vth with both methods, EGOFET calibrated
+response) are computed once, when a workbook is saved by utils.save_xls (or the first time it is loaded), and
+stored next to it as <workbook>-features.csv: one row per sweep, keyed by file, sheet, step and tags.
+
+Usage:
+    table = features.load_features('03082024-d030824-II-DiodeConnected_SensingTest-Na/...r3c110mM.xlsx')
+    table = features.load_folder_features('results/')   # all the workbooks under a folder
+"""
+import contextlib
+import glob
+import io
+import os
+import numpy as np
+import pandas as pd
+
+# column names of the left and right drain voltages (Keithley sweeps, calibrated PCB captures)
+LEFT = ('VDL', 'DrainVLeft')
+RIGHT = ('VDR', 'DrainVRight')
+
+SHEET_PREFIX = "step #"
+
+# features renamed since the first feature tables were saved: old name -> new name
+RENAMED = {'diff_max': 'diff_last'}
+
+
+def _column(df, names):
+    for name in names:
+        if name in df.columns:
+            return name
+    return None
+
+
+def split_sweeps(df):
+    """
+    Split a sheet with consecutive sweeps (pd.concat of the sweeps of a step, as saved by sensing_test) into the
+    single sweeps: a new sweep starts where the index stops increasing.
+
+    Parameters:
+    - df (pd.DataFrame): concatenated sweeps.
+
+    Returns:
+    - sweeps (list): list of DataFrames.
+    """
+    index = np.asarray(df.index)
+    if len(index) < 2 or not np.issubdtype(index.dtype, np.number):
+        return [df]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(index) <= 0) + 1, [len(index)]))
+    return [df.iloc[start:stop] for start, stop in zip(starts[:-1], starts[1:])]
+
+
+def _vth(function, vgs, ids):
+    # utils' Vth functions print and need enough points for their low-pass filter
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return float(function(vgs, ids))
+    except Exception:
+        return np.nan
+
+
+def sweep_features(df, Nlastvalues = 5, slope_point = None, vth = True):
+    """
+    Compute the features of one sweep.
+
+    Parameters:
+    - df (pd.DataFrame): diode connection sweep ('VDL'/'VDR' or 'DrainVLeft'/'DrainVRight') or VgsIds sweep ('Vgs', 'Ids').
+    - Nlastvalues (int, optional): number of last points of the mean. Default is 5.
+    - slope_point (float, optional): Vgs of the EGOFET calibrated response. Default is None (point of max Ids).
+    - vth (bool, optional): compute Vth of the VgsIds sweeps (linear extrapolation and second derivative). Default is True.
+
+    Returns:
+    - features (dict): 'points' and, depending on the columns, 'max_L', 'max_R', 'last_mean_L', 'last_mean_R',
+      'diff_last' (|VL-VR| at the last point), 'diff_last_mean' (mean |VL-VR| of the last points), 'vth', 'vth_secondder', 'response'.
+    """
+    import utils
+    features = {'points': len(df)}
+    left, right = _column(df, LEFT), _column(df, RIGHT)
+    if left:
+        values = df[left].to_numpy(dtype=float)
+        features['max_L'] = np.max(values) if len(values) else np.nan
+        features['last_mean_L'] = np.mean(values[-Nlastvalues:]) if len(values) else np.nan
+    if right:
+        values = df[right].to_numpy(dtype=float)
+        features['max_R'] = np.max(values) if len(values) else np.nan
+        features['last_mean_R'] = np.mean(values[-Nlastvalues:]) if len(values) else np.nan
+    if left and right and len(df):
+        diff = np.abs(df[left].to_numpy(dtype=float) - df[right].to_numpy(dtype=float))
+        features['diff_last'] = diff[-1]
+        features['diff_last_mean'] = np.mean(diff[-Nlastvalues:])
+    if 'Vgs' in df.columns and 'Ids' in df.columns and len(df) > 1:
+        vgs, ids = df['Vgs'].to_numpy(dtype=float), np.abs(df['Ids'].to_numpy(dtype=float))
+        if vth:
+            features['vth'] = _vth(utils.calculate_vth, vgs, ids)
+            features['vth_secondder'] = _vth(utils.calculate_vth_secondder, vgs, ids)
+        try:
+            features['response'] = float(utils.calibrated_response_egofet(df, slope_point = slope_point))
+        except ValueError:
+            features['response'] = np.nan
+    return features
+
+
+def feature_table(list_df, Nlastvalues = 5, slope_point = None, vth = True, **tags):
+    """
+    Compute the feature table of the sheets of a workbook.
+
+    Parameters:
+    - list_df (list or dict): sheets as passed to utils.save_xls (dict key -> DataFrame, or list); every sheet may hold
+      several consecutive sweeps (split with split_sweeps).
+    - Nlastvalues, slope_point, vth: as in sweep_features.
+    - tags: columns added to every row (e.g. DUT='d030824-II', TOT='DiodeConnected_SensingTest-Na', couple='r3c1').
+
+    Returns:
+    - table (pd.DataFrame): one row per sweep with the tags, 'sheet', 'step' (sweep number in the sheet) and the features.
+    """
+    items = list_df.items() if isinstance(list_df, dict) else enumerate(list_df)
+    rows = []
+    for sheet, df in items:
+        for step, sweep in enumerate(split_sweeps(df)):
+            row = dict(tags)
+            row['sheet'] = str(sheet)
+            row['step'] = step
+            row.update(sweep_features(sweep, Nlastvalues, slope_point, vth))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def features_path(workbook):
+    """
+    Path of the feature table of a workbook (<workbook>-features.csv).
+    """
+    return os.path.splitext(workbook)[0] + '-features.csv'
+
+
+def save_features(workbook, list_df, **kwargs):
+    """
+    Compute the feature table of the sheets saved in workbook and write it next to it.
+
+    Parameters:
+    - workbook (str): path of the xlsx file.
+    - list_df (list or dict): sheets of the workbook.
+    - kwargs: passed to feature_table (Nlastvalues, slope_point, vth, tags).
+
+    Returns:
+    - path (str): path of the csv file.
+    """
+    table = feature_table(list_df, file = os.path.basename(workbook), **kwargs)
+    path = features_path(workbook)
+    table.to_csv(path, index=False)
+    return path
+
+
+def load_features(workbook, compute = True, **kwargs):
+    """
+    Return the feature table of a workbook, reading <workbook>-features.csv if it is up to date, otherwise
+    computing it from the workbook (and saving it, if compute is True).
+
+    Parameters:
+    - workbook (str): path of the xlsx file.
+    - compute (bool, optional): save the table computed from the workbook. Default is True.
+    - kwargs: passed to feature_table.
+
+    Returns:
+    - table (pd.DataFrame): feature table.
+    """
+    path = features_path(workbook)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(workbook):
+        return pd.read_csv(path, dtype={'sheet': str}).rename(columns=RENAMED)
+    sheets = pd.read_excel(workbook, sheet_name=None, index_col=0)
+    sheets = {name[len(SHEET_PREFIX):] if name.startswith(SHEET_PREFIX) else name: df for name, df in sheets.items()}
+    table = feature_table(sheets, file = os.path.basename(workbook), **kwargs)
+    if compute:
+        table.to_csv(path, index=False)
+    return table
+
+
+def load_folder_features(root, pattern = '*.xlsx', **kwargs):
+    """
+    Return the feature tables of all the workbooks under root (recursively) in one table, with a 'folder' column
+    (name of the mmddyyyy-DUT-TOT folder of the workbook).
+
+    Parameters:
+    - root (str): folder to scan.
+    - pattern (str, optional): file name pattern of the workbooks. Default is '*.xlsx'.
+    - kwargs: passed to load_features.
+    """
+    tables = []
+    for workbook in sorted(glob.glob(os.path.join(root, '**', pattern), recursive=True)):
+        if os.path.basename(workbook).startswith('~$'): # Excel lock files
+            continue
+        table = load_features(workbook, **kwargs)
+        table.insert(0, 'folder', os.path.basename(os.path.dirname(workbook)))
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
@@ -1,10 +1,176 @@
+import pyvisa as visa
 from pyvisa.highlevel import ResourceManager
 import pyvisa.constants as pyconst
+import numpy as np
 import pandas as pd
 import time
 import re
 from functools import reduce
+from itertools import accumulate
+from bisect import bisect_left
 from datetime import datetime
+import sweep_grid
+import sweep_status
+import tracing
+
+# one point of a DO trace: status letter and value; the separators, the
+# terminator (line feed, NUL, ...) and empty tokens are skipped
+_POINT = re.compile(r"([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[Ee][-+]?\d+)?)")
+
+def parse_trace_status(raw):
+    """
+    Parse the output of a DO command (status letter + value for each point,
+    comma separated) into a pandas Series of floats and the status flags of
+    the points (bytes, one per point, see sweep_status).
+    """
+    with tracing.span('parse') as span:
+        points = _POINT.findall(raw)
+        values = pd.Series(np.array([value for _, value in points], dtype=float))
+        status = sweep_status.decode(''.join(letter for letter, _ in points))
+        span.tag(points=len(values))
+    return values, status
+
+def parse_trace(raw):
+    """
+    Parse the output of a DO command (status letter + value for each point,
+    comma separated) into a pandas Series of floats.
+    """
+    return parse_trace_status(raw)[0]
+
+# SMU channels of a fully populated 4200-SCS chassis
+SMU_CHANNELS = tuple('CH'+str(n) for n in range(1, 9))
+
+def assign_couples(couples, channels=SMU_CHANNELS, common=None):
+    """
+    Map FET couples to the SMU channels of the chassis for
+    Communications.diode_connection_couples: one channel is the common shared
+    by all the couples, each couple takes the next two channels as Left and
+    Right. Couples that don't fit are put in the next group.
+
+    Args:
+        couples (list): Names of the couples.
+        channels (tuple): Available SMU channels. Default is CH1-CH8.
+        common (str): Common channel. Default is the first available.
+
+    Returns:
+        (list): Groups to measure one after the other, each a dict couple
+        name -> (Left, Right, Common).
+    """
+    common = common or channels[0]
+    sources = [channel for channel in channels if channel != common]
+    per_group = len(sources)//2
+    if per_group == 0:
+        raise ValueError("At least three channels are needed: "+str(channels))
+    groups = []
+    for start in range(0, len(couples), per_group):
+        groups.append({couple: (sources[2*i], sources[2*i + 1], common)
+                       for i, couple in enumerate(couples[start:start + per_group])})
+    return groups
+
+class CommandMetrics:
+    """
+    Per-command-type counters of the traffic with the instrument: number of
+    commands, bytes sent/received, errors and a latency histogram. The type
+    of a command is its leading mnemonic (DE, SS, SM, ME, SP, DO, ..., CH
+    for the channel definitions).
+    """
+
+    # upper bounds of the latency histogram buckets in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._types = {}
+
+    @staticmethod
+    def command_type(command: str):
+        match = re.match(r"\s*([A-Za-z]{1,2})", command)
+        return match.group(1).upper() if match else "other"
+
+    def record(self, command: str, latency: float, response=None, error=False):
+        """
+        Add one command to the counters.
+
+        Args:
+            command (str): The command sent to the instrument.
+            latency (float): Seconds between sending the command and the end
+                of the response.
+            response (str): The response of the instrument, if any.
+            error (bool): True if the command raised an error.
+        """
+        kind = self.command_type(command)
+        entry = self._types.get(kind)
+        if entry is None:
+            entry = self._types[kind] = {
+                "count": 0, "errors": 0, "bytes_sent": 0, "bytes_received": 0,
+                "latency_sum": 0.0, "latency_max": 0.0,
+                "buckets": [0]*(len(self.BUCKETS) + 1),
+            }
+        entry["count"] += 1
+        entry["errors"] += bool(error)
+        entry["bytes_sent"] += len(command)
+        if response is not None:
+            entry["bytes_received"] += len(response)
+        entry["latency_sum"] += latency
+        entry["latency_max"] = max(entry["latency_max"], latency)
+        entry["buckets"][bisect_left(self.BUCKETS, latency)] += 1
+
+    def to_dict(self):
+        """
+        Returns:
+            (dict): command type -> counters, with the mean latency and the
+            cumulative histogram as {upper bound: count}.
+        """
+        result = {}
+        for kind, entry in self._types.items():
+            cumulative = list(accumulate(entry["buckets"]))
+            result[kind] = {
+                key: value for key, value in entry.items() if key != "buckets"
+            }
+            result[kind]["latency_mean"] = entry["latency_sum"]/entry["count"]
+            result[kind]["histogram"] = dict(
+                zip([str(bound) for bound in self.BUCKETS] + ["+Inf"], cumulative)
+            )
+        return result
+
+    def to_prometheus(self, path=None, prefix="keithley"):
+        """
+        Export the counters in the Prometheus text format.
+
+        Args:
+            path (str): File to write (e.g. for the node exporter textfile
+                collector). If None the text is only returned.
+            prefix (str): Prefix of the metric names.
+
+        Returns:
+            (str): The metrics in the Prometheus text format.
+        """
+        lines = []
+        metrics = self.to_dict()
+        for name, key, kind in [
+            ("commands_total", "count", "counter"),
+            ("command_errors_total", "errors", "counter"),
+            ("command_bytes_sent_total", "bytes_sent", "counter"),
+            ("command_bytes_received_total", "bytes_received", "counter"),
+        ]:
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for command, entry in metrics.items():
+                lines.append(f'{prefix}_{name}{{command="{command}"}} {entry[key]}')
+        lines.append(f"# TYPE {prefix}_command_latency_seconds histogram")
+        for command, entry in metrics.items():
+            for bound, count in entry["histogram"].items():
+                lines.append(
+                    f'{prefix}_command_latency_seconds_bucket{{command="{command}",le="{bound}"}} {count}'
+                )
+            lines.append(f'{prefix}_command_latency_seconds_sum{{command="{command}"}} {entry["latency_sum"]}')
+            lines.append(f'{prefix}_command_latency_seconds_count{{command="{command}"}} {entry["count"]}')
+        text = "\n".join(lines) + "\n"
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
 
 class Communications:
     """
@@ -14,13 +180,17 @@ class Communications:
     terminal if the appropriate internal attribute is set to True. 
     """
 
-    def __init__(self, instrument_resource_string=None):
+    def __init__(self, instrument_resource_string=None, resource_manager=None):
         self._instrument_resource_string = instrument_resource_string
-        self._resource_manager = None
+        self._resource_manager = resource_manager
         self._instrument_object = None
         self._timeout = 20000
         self._echo_cmds = False
         self._version = 1.1
+        self.metrics = CommandMetrics()
+        self._loaded_setup = None # setup commands the instrument is known to hold (None: unknown)
+        self.setup_hits = 0
+        self.setup_misses = 0
 
         try:
             if self._resource_manager is None:
@@ -42,6 +212,7 @@ class Communications:
         Returns:
             None
         """
+        self.invalidate_setup()
         try:
             if instrument_resource_string != None:
                 self._instrument_resource_string = instrument_resource_string
@@ -77,6 +248,7 @@ class Communications:
         Returns:
             None
         """
+        self.invalidate_setup()
         try:
             self._instrument_object.close()
         except visa.VisaIOError as visaerr:
@@ -94,10 +266,18 @@ class Communications:
         Returns:
             None
         """
+        self._track_external(command)
         try:
             if self._echo_cmds is True:
                 print(command)
-            self._instrument_object.write(command)
+            with tracing.span('visa.write', command=command[:2]):
+                start = time.perf_counter()
+                try:
+                    self._instrument_object.write(command)
+                except Exception:
+                    self.metrics.record(command, time.perf_counter() - start, error=True)
+                    raise
+                self.metrics.record(command, time.perf_counter() - start)
         except visa.VisaIOError as visaerr:
             print(f"{visaerr}")
         return
@@ -130,127 +310,250 @@ class Communications:
             instrument.
         """
         response = ""
+        self._track_external(command)
         try:
-            if self._echo_cmds is True:
-                print(command)
-            response = self._instrument_object.query(command).rstrip()
+            response = self._ask(command).rstrip()
         except visa.VisaIOError as visaerr:
             print(f"{visaerr}")
 
         return response
+
+    def _ask(self, command: str):
+        """
+        Send a command and return the raw response. Every query of the
+        measurement routines goes through here so it can be echoed, traced
+        and counted in self.metrics.
+
+        Args:
+            command (str): The command issued to the instrument.
+
+        Returns:
+            (str): The raw response of the instrument.
+        """
+        if self._echo_cmds is True:
+            print(command)
+        with tracing.span('visa.query', command=command[:2]):
+            start = time.perf_counter()
+            try:
+                response = self._instrument_object.query(command)
+            except Exception:
+                self.metrics.record(command, time.perf_counter() - start, error=True)
+                self.invalidate_setup() # the instrument may hold a partial setup
+                raise
+            self.metrics.record(command, time.perf_counter() - start, response)
+            return response
+
+    # commands sent through write/query that don't change the configuration
+    _STATELESS_COMMANDS = ("SP", "DO", "BC")
+
+    def invalidate_setup(self):
+        """
+        Forget the configuration mirrored by _configure, so that the next
+        measurement sends its full setup. Called on connect, disconnect and
+        errors; call it after changing the configuration by other means (e.g.
+        the front panel).
+        """
+        self._loaded_setup = None
+
+    def _track_external(self, command: str):
+        # a command sent from outside the measurement routines may change the configuration
+        if CommandMetrics.command_type(command) not in self._STATELESS_COMMANDS:
+            self.invalidate_setup()
+
+    def _configure(self, setup):
+        """
+        Load a measurement setup (the DE/SS/SM page commands), skipping it if
+        it is the setup the instrument already holds.
+
+        Args:
+            setup (tuple): The setup commands, in order.
+
+        Returns:
+            (bool): True if the commands were sent.
+        """
+        setup = tuple(setup)
+        if setup == self._loaded_setup:
+            self.setup_hits += 1
+            return False
+        self.setup_misses += 1
+        self._loaded_setup = None
+        with tracing.span('setup', commands=len(setup)):
+            for command in setup:
+                self._ask(command)
+        self._loaded_setup = setup
+        return True
+
+    def _trigger(self):
+        """
+        Go to the measurement control page and trigger the loaded setup.
+        """
+        self._ask("MD")
+        self._ask("ME1")
+
+    def _wait_measurement(self, poll = 1):
+        """
+        Poll the status (SP) until the measurement triggered by ME is complete.
+
+        Args:
+            poll (float): Seconds between two status requests.
+        """
+        with tracing.span('wait.measurement'):
+            status = self._ask("SP")
+            while int(status) != 1:
+                status = self._ask("SP")
+                time.sleep(poll)
+
+    def _fetch(self, columns, order=None):
+        """
+        Read the traces of the last measurement (one DO per trace) into a
+        DataFrame, keeping the decoded status of every point in
+        DataFrame.attrs['status'] (see sweep_status).
+
+        Args:
+            columns (dict): Column of the DataFrame -> name of the trace, as
+                in the channel definitions.
+            order (list): Names of the traces in the order they are read.
+                Default is the order of columns.
+
+        Returns:
+            (pd.DataFrame): One column per trace.
+        """
+        traces, status = {}, {}
+        for name in order or columns.values():
+            traces[name], status[name] = parse_trace_status(self._ask("DO '"+name+"'"))
+        data = pd.DataFrame({column: traces[name] for column, name in columns.items()})
+        data.attrs['status'] = {column: status[name] for column, name in columns.items()}
+        return data
     
+    @tracing.traced('sweep')
     def VgsIds(self, gate, source, drain, vds, compliance_vds, vg_start,vg_stop,vg_step, compliance_vg, speed):
         """
         VgsIds program
         gate, source, drain: str of the channel ['CH1','CH2','CH3']
         """
         
-        self._instrument_object.query("DE") # channel definition page
-        self._instrument_object.query(gate+", 'VG', 'IG', 1, 1")
-        self._instrument_object.query(drain+", 'VD', 'ID', 1, 3")
-        self._instrument_object.query(source+", 'VS', 'IS', 1, 3")
-        self._instrument_object.query("SS")
-        self._instrument_object.query("VR"+gate[2]+", "+vg_start+", "+vg_stop+", "+vg_step+", "+compliance_vg)
-        self._instrument_object.query("VC"+drain[2]+", "+vds+", "+compliance_vds)
-        self._instrument_object.query("VC"+source[2]+", 0, 0.1")
-        self._instrument_object.query("HT 0")
-        self._instrument_object.query("DT 0.001")
-        self._instrument_object.query("IT"+speed)
-        self._instrument_object.query("RS 5")
-        self._instrument_object.query("RG 1, 1e-9")
-        self._instrument_object.query("RG 2, 1e-9")
-        #self._instrument_object.query("RG 3, 1e-9")
-        self._instrument_object.query("SM")
-        self._instrument_object.query("DM1")
-        self._instrument_object.query("XN 'VG', 1,"+vg_start+", "+vg_stop)
-        self._instrument_object.query("YA 'ID', 1, 0, 0.04")
-        self._instrument_object.query("YB 'IG', 1, 0, 0.04")
-        self._instrument_object.query("MD")
-        self._instrument_object.query("ME1")
+        self._configure((
+            "DE", # channel definition page
+            gate+", 'VG', 'IG', 1, 1",
+            drain+", 'VD', 'ID', 1, 3",
+            source+", 'VS', 'IS', 1, 3",
+            "SS",
+            "VR"+gate[2]+", "+vg_start+", "+vg_stop+", "+vg_step+", "+compliance_vg,
+            "VC"+drain[2]+", "+vds+", "+compliance_vds,
+            "VC"+source[2]+", 0, 0.1",
+            "HT 0",
+            "DT 0.001",
+            "IT"+speed,
+            "RS 5",
+            "RG 1, 1e-9",
+            "RG 2, 1e-9",
+            #"RG 3, 1e-9",
+            "SM",
+            "DM1",
+            "XN 'VG', 1,"+vg_start+", "+vg_stop,
+            "YA 'ID', 1, 0, 0.04",
+            "YB 'IG', 1, 0, 0.04",
+        ))
+        self._trigger()
         # wait for measurement to complete
+        self._wait_measurement()
+        data = self._fetch({'Ids': 'ID', 'Igs': 'IG', 'Vgs': 'VG', 'Vds': 'VD'}, ['ID', 'VG', 'IG', 'VD'])
+        data.attrs['grid_id'] = sweep_grid.registry.register(vg_start, vg_stop, vg_step)
 
-        status = self._instrument_object.query("SP")
-        while int(status) != 1:
-            status = self._instrument_object.query("SP")
-            time.sleep(1)
+        return data   
+    
+    def _setup_constantbias(self, Left, Right, Common, bias, compliance, interval, samples, wait, speed = '2'):
+        """
+        Channel definitions and sampling mode setup of diode_connection_constantbias/constantbias_stream.
+        """
+        self._configure((
+            "DE",
+            Left+", 'VDL', 'IDL', 2, 3",
+            Right+", 'VDR', 'IDR', 2, 3",
+            Common+", 'VG', 'IG', 3, 3",
+            "SS",
+            "IC"+Left[2]+", "+bias+", "+compliance, # bias current
+            "IC"+Right[2]+", "+bias+", "+compliance,
+
+            "HT 0",
+            "DT 0.001",
+            "IT"+speed,
+            "RS 5",
+
+            "SM",
+            "DM2",
+            "WT "+str(wait),
+            "IN "+str(interval),
+            "NR "+str(int(samples)),
+        ))
+
+    def _sample_block(self, interval, samples, wait, poll):
+        """
+        Trigger one block of samples of the sampling mode set up by _setup_constantbias and fetch it.
+        """
+        trigger = time.time() + wait
+        self._trigger()
+        self._wait_measurement(poll if poll is not None else min(1, max(0.01, interval*samples/20)))
+        diode_df = self._fetch({'VDL': 'VDL', 'VDR': 'VDR', 'IDL': 'IDL', 'IDR': 'IDR'})
+        diode_df.insert(0, "t", trigger + interval*np.arange(len(diode_df)))
+        return diode_df
 
-        dataID1 = self._instrument_object.query("DO 'ID'")
-        dataVG1 = self._instrument_object.query("DO 'VG'")
-        dataIG1 = self._instrument_object.query("DO 'IG'")
-        dataVD1 = self._instrument_object.query("DO 'VD'")
-        
+    @tracing.traced('sweep')
+    def diode_connection_constantbias(self, Left = 'CH1', Right = 'CH3', Common = 'CH2', bias = '300E-09', interval = 0.1,
+                                      samples = 100, compliance = '10', wait = 0, poll = None, speed = '2', mode = None):
+        """
+        Sources a constant current to two diode connected transistors and samples the voltages between
+        Common-Left and Common-Right in time (sampling mode), instead of sweeping the current.
 
-        data = pd.DataFrame()
-        data['Ids'] = pd.Series(str(dataID1).split(dataID1[0])[1:]).apply(lambda x: float(x[:-1]))       
-        data['Igs'] = pd.Series(str(dataIG1).split(dataIG1[0])[1:]).apply(lambda x: float(x[:-1]))        
-        data['Vgs'] = pd.Series(str(dataVG1).split(dataVG1[0])[1:]).apply(lambda x: float(x[:-1]))
-        data['Vds'] = pd.Series(str(dataVD1).split(dataVD1[0])[1:]).apply(lambda x: float(x[:-1]))
-        
+        Args:
+            Left, Right, Common (str): Channels ('CH1','CH2','CH3').
+            bias (str): Bias current in [A].
+            interval (float): Seconds between two samples.
+            samples (int): Number of samples.
+            compliance (str): Voltage compliance in [V].
+            wait (float): Seconds of bias before the first sample.
+            poll (float): Seconds between the status requests while sampling
+                (default: 1/20 of the duration, between 0.01 and 1 s).
+            speed (str): Integration time ('1' short, '2' normal, '3' long). Default is '2', as in the sweeps.
+            mode: Unused, kept for the calls written for the previous version of this method.
 
-        return data   
-    
-    def diode_connection_constantbias(self, mode = None):
+        Returns:
+            (pd.DataFrame): "t" (epoch seconds of each sample), "VDL", "VDR", "IDL", "IDR" columns.
         """
-        Ch3 and Ch1 are biasing, Ch2 is in common  mode
-        
+        self._setup_constantbias(Left, Right, Common, bias, compliance, interval, samples, wait, speed)
+        return self._sample_block(interval, samples, wait, poll)
+
+    def constantbias_stream(self, Left = 'CH1', Right = 'CH3', Common = 'CH2', bias = '300E-09', interval = 0.1,
+                            block = 100, blocks = None, compliance = '10', wait = 0, poll = None, speed = '2'):
         """
-        self._instrument_object.query("DE")
-        self._instrument_object.query("CH3, 'VDR', 'IDR', 2, 3")
-        self._instrument_object.query("CH2, 'VG', 'IG', 3, 3")
-        self._instrument_object.query("SS")
-        self._instrument_object.query("IC1, 0.1, +10") # bias current 0.1
-
-        self._instrument_object.query("HT 0.001")
-        self._instrument_object.query("DT 0.001")
-        self._instrument_object.query("IT2")
-        self._instrument_object.query("RS 5")
-
-        self._instrument_object.query("DE")
-        self._instrument_object.query("CH1, 'VDL', 'IDL', 2, 3")
-        self._instrument_object.query("SS")
-        self._instrument_object.query("IC1, 0.1, +10") # bias current
-
-        self._instrument_object.query("HT 0")
-        self._instrument_object.query("DT 0.001")
-        self._instrument_object.query("IT2")
-        self._instrument_object.query("RS 5")
-
-        self._instrument_object.query("SM")
-        self._instrument_object.query("DM1")
-        self._instrument_object.query("XN 'IDL', 1, 0, 1E-06")
-        self._instrument_object.query("YA 'VDL', 1, 0, 20")
-        self._instrument_object.query("YB 'VDR', 1, 0, 20")
-        self._instrument_object.query("NR 10")
-        self._instrument_object.query("MD")
-        self._instrument_object.query("ME1")
-        start_time = time.time()
-        elapsed_time = time.time() - start_time
-        # wait for measurement to complete
+        Generator streaming the constant bias samples of diode_connection_constantbias in blocks: the setup is
+        sent once, then every block is one trigger (ME1) of block samples fetched with one DO per trace.
+        The wait (WT) applies to the first block only. No samples are taken between two blocks (while a block
+        is fetched and the next one triggered): "t" starts at the trigger of every block, so it shows the gap,
+        and "block" marks the boundaries.
 
-        status = smu.query("SP")
-        #print(status)
-        while elapsed_time < 10  :
-            print(elapsed_time)
-            elapsed_time = time.time() - start_time
-            status = self._instrument_object.query("SP")
-            #print(status)
-            time.sleep(1)
-
-        dataVDL = self._instrument_object.query("DO 'VDL'")
-        dataVDR = self._instrument_object.query("DO 'VDR'")
-        dataIDL = self._instrument_object.query("DO 'IDL'")
-        dataIDR = self._instrument_object.query("DO 'IDR'")
-
-        diode_df = pd.DataFrame()
-        diode_df["VDL"] = pd.Series(re.split(r'[NC]', dataVDL)[1:]).apply(lambda x: float(x[:-1]))
-        diode_df["VDR"] = pd.Series(re.split(r'[NC]', dataVDR)[1:]).apply(lambda x: float(x[:-1]))
-        diode_df["IDL"] = pd.Series(re.split(r'[NC]', dataIDL)[1:]).apply(lambda x: float(x[:-1]))
-        diode_df["IDR"] = pd.Series(re.split(r'[NC]', dataIDR)[1:]).apply(lambda x: float(x[:-1]))
+        Args:
+            Left, Right, Common, bias, interval, compliance, wait, poll, speed: as in diode_connection_constantbias.
+            block (int): Number of samples per block.
+            blocks (int): Number of blocks; None streams until the generator is closed.
+
+        Yields:
+            (pd.DataFrame): One block with "t", "block" (number of the block), "VDL", "VDR", "IDL", "IDR" columns.
+        """
+        self._setup_constantbias(Left, Right, Common, bias, compliance, interval, block, wait, speed)
+        n = 0
+        while blocks is None or n < blocks:
+            if n == 1 and wait:
+                self._setup_constantbias(Left, Right, Common, bias, compliance, interval, block, 0, speed)
+            with tracing.span('sweep.constantbias_block', block=n):
+                data_block = self._sample_block(interval, block, wait if n == 0 else 0, poll)
+            data_block.insert(1, "block", n)
+            yield data_block
+            n += 1
 
-        return diode_df
-    
     ## Diode connections
 
+    @tracing.traced('sweep')
     def diode_connection(self, Left, Right, Common, current_start, current_stop, step):
         """
         Performs a diode connection test. Sources current to two diode connected transistors and measures the voltage between Common-Left and Common Right
@@ -265,52 +568,131 @@ class Communications:
         
         """
 
-        self._instrument_object.query("DE")
-        self._instrument_object.query(Right+", 'VDR', 'IDR', 2, 1")
-        self._instrument_object.query(Common+", 'VG', 'IG', 3, 3")
-        self._instrument_object.query("SS")
-        self._instrument_object.query("IR1, "+current_start+", "+current_stop+", "+step+", 10")
-
-        self._instrument_object.query("HT 0.001")
-        self._instrument_object.query("DT 0.001")
-        self._instrument_object.query("IT2")
-        self._instrument_object.query("RS 5")
-
-        self._instrument_object.query("DE")
-        self._instrument_object.query(Left+", 'VDL', 'IDL', 2, 1")
-        self._instrument_object.query("SS")
-        self._instrument_object.query("IR1, "+current_start+", "+current_stop+", "+step+", 10")
-
-        self._instrument_object.query("HT 0.001")
-        self._instrument_object.query("DT 0.001")
-        self._instrument_object.query("IT2")
-        self._instrument_object.query("RS 5")
-
-        self._instrument_object.query("SM")
-        self._instrument_object.query("DM1")
-        self._instrument_object.query("XN 'IDL', 1, "+current_start+", "+current_stop)
-        self._instrument_object.query("YA 'VDL', 1, 0, 20")
-        self._instrument_object.query("YB 'VDR', 1, 0, 20")
-        self._instrument_object.query("MD")
-        self._instrument_object.query("ME1")
+        self._configure((
+            "DE",
+            Right+", 'VDR', 'IDR', 2, 1",
+            Common+", 'VG', 'IG', 3, 3",
+            "SS",
+            "IR1, "+current_start+", "+current_stop+", "+step+", 10",
+
+            "HT 0.001",
+            "DT 0.001",
+            "IT2",
+            "RS 5",
+
+            "DE",
+            Left+", 'VDL', 'IDL', 2, 1",
+            "SS",
+            "IR1, "+current_start+", "+current_stop+", "+step+", 10",
+
+            "HT 0.001",
+            "DT 0.001",
+            "IT2",
+            "RS 5",
+
+            "SM",
+            "DM1",
+            "XN 'IDL', 1, "+current_start+", "+current_stop,
+            "YA 'VDL', 1, 0, 20",
+            "YB 'VDR', 1, 0, 20",
+        ))
+        self._trigger()
         # wait for measurement to complete
+        self._wait_measurement()
+        diode_df = self._fetch({'VDL': 'VDL', 'VDR': 'VDR', 'IDL': 'IDL', 'IDR': 'IDR'})
+        diode_df.attrs['grid_id'] = sweep_grid.registry.register(current_start, current_stop, step)
 
-        status = self._instrument_object.query("SP")
-        #print(status)
-        while int(status) != 1:
-            status = self._instrument_object.query("SP")
-            #print(status)
-            time.sleep(1)
+        return diode_df
 
-        dataVDL = self._instrument_object.query("DO 'VDL'")
-        dataVDR = self._instrument_object.query("DO 'VDR'")
-        dataIDL = self._instrument_object.query("DO 'IDL'")
-        dataIDR = self._instrument_object.query("DO 'IDR'")
+    @tracing.traced('sweep')
+    def diode_connection_couples(self, couples, current_start, current_stop, step):
+        """
+        Performs the diode connection test of several FET couples in one
+        measurement: all the channels are defined in one channel definition
+        page, the Left channel of the first couple is the VAR1 current sweep
+        and the other current sources follow it as VAR1' (ratio 1, offset 0),
+        so every couple sees the same sweep as with diode_connection.
 
-        diode_df = pd.DataFrame()
-        diode_df["VDL"] = pd.Series(re.split(r'[NC]', dataVDL)[1:]).apply(lambda x: float(x[:-1]))
-        diode_df["VDR"] = pd.Series(re.split(r'[NC]', dataVDR)[1:]).apply(lambda x: float(x[:-1]))
-        diode_df["IDL"] = pd.Series(re.split(r'[NC]', dataIDL)[1:]).apply(lambda x: float(x[:-1]))
-        diode_df["IDR"] = pd.Series(re.split(r'[NC]', dataIDR)[1:]).apply(lambda x: float(x[:-1]))
+        Args:
+            couples (dict): Couple name -> (Left, Right, Common) channels,
+                e.g. from assign_couples. Commons may be shared.
+            current_start, current_stop, step (str): Current sweep in [A].
 
-        return diode_df
+        Returns:
+            (dict): Couple name -> pandas dataframe with "VDL","VDR","IDL",
+            "IDR" columns, as returned by diode_connection.
+        """
+        sources, commons = [], []
+        for Left, Right, Common in couples.values():
+            sources += [Left, Right]
+            if Common not in commons:
+                commons.append(Common)
+        if len(set(sources)) != len(sources) or set(sources) & set(commons):
+            raise ValueError("Each channel can source only one transistor: "+str(couples))
+
+        setup = ["DE"]
+        for i, (Left, Right, Common) in enumerate(couples.values(), 1):
+            setup.append(Left+", 'VDL"+str(i)+"', 'IDL"+str(i)+"', 2, "+("1" if i == 1 else "4"))
+            setup.append(Right+", 'VDR"+str(i)+"', 'IDR"+str(i)+"', 2, 4")
+        for i, Common in enumerate(commons, 1):
+            setup.append(Common+", 'VG"+str(i)+"', 'IG"+str(i)+"', 3, 3")
+        setup += [
+            "SS",
+            "IR1, "+current_start+", "+current_stop+", "+step+", 10",
+            "RT 1, 0", # VAR1' = VAR1
+            "HT 0.001",
+            "DT 0.001",
+            "IT2",
+            "RS 5",
+            "SM",
+            "DM1",
+            "XN 'IDL1', 1, "+current_start+", "+current_stop,
+            "YA 'VDL1', 1, 0, 20",
+            "YB 'VDR1', 1, 0, 20",
+        ]
+        self._configure(setup)
+        self._trigger()
+        # wait for measurement to complete
+        self._wait_measurement()
+        columns = {}
+        for i in range(1, len(couples) + 1):
+            for trace in ("VDL", "VDR", "IDL", "IDR"):
+                columns[trace+str(i)] = trace+str(i)
+        combined = self._fetch(columns)
+        grid_id = sweep_grid.registry.register(current_start, current_stop, step)
+
+        # split into one dataframe per couple
+        result = {}
+        for i, name in enumerate(couples, 1):
+            rename = {trace+str(i): trace for trace in ("VDL", "VDR", "IDL", "IDR")}
+            diode_df = combined[list(rename)].rename(columns=rename)
+            diode_df.attrs = {'grid_id': grid_id, 'couple': name,
+                              'status': {trace: combined.attrs['status'][column] for column, trace in rename.items()}}
+            result[name] = diode_df
+        return result
+
+    def diode_connection_groups(self, couples, current_start, current_stop, step, channels = SMU_CHANNELS, common = None):
+        """
+        Performs the diode connection test of any number of FET couples: the
+        couples are mapped to the channels with assign_couples and every group
+        is measured with diode_connection_couples, one after the other.
+
+        Args:
+            couples (list): Names of the couples.
+            current_start, current_stop, step (str): Current sweep in [A].
+            channels (tuple): Available SMU channels. Default is CH1-CH8.
+            common (str): Common channel. Default is the first available.
+
+        Returns:
+            (dict): Couple name -> pandas dataframe with "VDL","VDR","IDL",
+            "IDR" columns and attrs 'group' (number of the measurement), in
+            the order of couples.
+        """
+        result = {}
+        for number, group in enumerate(assign_couples(list(couples), channels, common)):
+            with tracing.span('sweep.couples_group', group=number, couples=len(group)):
+                measured = self.diode_connection_couples(group, current_start, current_stop, step)
+            for diode_df in measured.values():
+                diode_df.attrs['group'] = number
+            result.update(measured)
+        return result
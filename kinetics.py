@@ -0,0 +1,208 @@
+"""
+Sensor kinetics: first-order settling fits of the time series of a run, one fit per segment (concentration).
+
+Model of a segment starting at t0:
+
+    y(t) = y_inf + amplitude*exp(-(t - t0)/tau) + drift*(t - t0)
+
+For a fixed tau the model is linear in (y_inf, amplitude, drift), so every segment is fitted with a grid
+search on tau (log spaced, in units of the duration of the segment) and a linear least squares solve per
+grid point, refined with a parabola through the best three grid points. All the segments (of all the
+devices, concentrations, ...) are stacked in (segments x points) arrays padded with NaN and fitted at once
+with batched normal equations; there is no loop over the segments.
+
+The series come from the stored runs as long tables (one row per reading) with a value column, a segment
+column and optionally a time column:
+- feature tables (features.load_features / load_folder_features): 'sheet' is the concentration and 'step'
+  the sweep number, e.g. fit_segments(table, 'last_mean_L', by=['file', 'sheet'], interval=resting_time).
+- tests_.constantbias_test data ('t', 'VDL', 'VDR').
+- series typed in the notebooks: series_table({20: mM20, 40: mM40, ...}, interval=2).
+
+Usage:
+    fit = kinetics.fit_segments(table, 'values [mV]', time='time [s]', by='mM')
+"""
+import numpy as np
+import pandas as pd
+
+# flags of the fit of a segment (bit values)
+FIT_FEW_POINTS = 1
+FIT_TAU_AT_EDGE = 2
+FIT_NO_SETTLING = 4
+FLAGS = {FIT_FEW_POINTS: 'few points', FIT_TAU_AT_EDGE: 'tau at the edge of the grid',
+         FIT_NO_SETTLING: 'no settling (amplitude within the noise)'}
+
+# tau grid, in units of the duration of each segment
+TAUS = np.geomspace(0.01, 10, 61)
+
+
+def settling_curve(t, tau, y_inf, amplitude, drift = 0.0, t0 = 0.0):
+    """
+    Evaluate the first-order settling model at times t (e.g. to plot a fit row).
+    """
+    t = np.asarray(t, dtype=float) - t0
+    return y_inf + amplitude*np.exp(-t/tau) + drift*t
+
+
+def series_table(series, interval = 2.0, segment = 'mM', value = 'value', time = 'time [s]', continuous = True):
+    """
+    Build the long table of a time series from one sequence of readings per segment.
+
+    Parameters:
+    - series (dict): segment -> readings (list, np.array or pd.Series), in order of acquisition.
+    - interval (float, optional): time between two readings [s]. Default is 2.
+    - segment, value, time (str, optional): names of the columns. Defaults are 'mM', 'value', 'time [s]'.
+    - continuous (bool, optional): the segments follow each other (time keeps increasing); if False every segment starts at 0. Default is True.
+
+    Returns:
+    - table (pd.DataFrame): one row per reading.
+    """
+    tables, start = [], 0.0
+    for key, readings in series.items():
+        readings = np.asarray(readings, dtype=float)
+        times = start + interval*np.arange(len(readings))
+        tables.append(pd.DataFrame({segment: key, time: times, value: readings}))
+        if continuous:
+            start += interval*len(readings)
+    return pd.concat(tables, ignore_index=True)
+
+
+def stack_segments(table, value, time = None, by = 'mM', interval = 1.0):
+    """
+    Stack the segments of a long table in 2D arrays padded with NaN.
+
+    Parameters:
+    - table (pd.DataFrame): one row per reading.
+    - value (str): column of the readings.
+    - time (str, optional): column of the times. Default is None (readings every interval, from the order of the rows).
+    - by (str or list, optional): columns identifying a segment. Default is 'mM'.
+    - interval (float, optional): time between two readings when time is None. Default is 1.
+
+    Returns:
+    - keys (pd.DataFrame): the by columns of every segment, in order of acquisition.
+    - t, y (np.array): 2D arrays (segments x longest segment) of times and readings.
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    if time is not None:
+        table = table.sort_values(time, kind='stable')
+    groups = table.groupby(by, sort=False)
+    code = groups.ngroup().to_numpy()
+    position = groups.cumcount().to_numpy()
+    keys = groups.size().reset_index()[by]
+    shape = (len(keys), position.max() + 1 if len(position) else 0)
+    t, y = np.full(shape, np.nan), np.full(shape, np.nan)
+    t[code, position] = table[time].to_numpy(dtype=float) if time is not None else position*interval
+    y[code, position] = table[value].to_numpy(dtype=float)
+    return keys, t, y
+
+
+def _solve(u, y, mask, taus, drift):
+    # batched linear least squares for every (segment, tau): u, y, mask (S x P), taus (S x T)
+    weight = mask[:, None, :]
+    decay = np.exp(-u[:, None, :]/taus[:, :, None])
+    columns = [np.ones_like(decay), decay] + ([np.broadcast_to(u[:, None, :], decay.shape)] if drift else [])
+    design = np.stack(columns, axis=-1)*weight[..., None]
+    y = np.where(mask, y, 0)
+    normal = np.einsum('stpi,stpj->stij', design, design)
+    rhs = np.einsum('stpi,sp->sti', design, y)
+    coef = np.einsum('stij,stj->sti', np.linalg.pinv(normal), rhs)
+    residuals = (y[:, None, :] - np.einsum('stpi,sti->stp', design, coef))*weight
+    return coef, np.einsum('stp,stp->st', residuals, residuals)
+
+
+def fit_settling(t, y, taus = TAUS, drift = True, min_points = 5, chunk = 2000000):
+    """
+    Fit the first-order settling model to a batch of segments.
+
+    Parameters:
+    - t, y (np.array): times and readings, 2D (segments x points, NaN padded) or 1D for a single segment.
+    - taus (np.array, optional): tau grid in units of the duration of each segment (log spaced, at least 3 points). Default is TAUS (0.01 to 10).
+    - drift (bool, optional): fit a linear drift. Default is True.
+    - min_points (int, optional): minimum readings of a segment. Default is 5.
+    - chunk (int, optional): max elements of the (segments x taus x points x parameters) arrays computed at once. Default is 2e6.
+
+    Returns:
+    - fit (pd.DataFrame): one row per segment with 't0', 'tau', 'y_inf', 'amplitude', 'drift' (per unit of time),
+      'r2', 'rmse', 'points' and 'flags' (FIT_* bits).
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    t = np.broadcast_to(np.asarray(t, dtype=float), y.shape)
+    taus = np.asarray(taus, dtype=float)
+    if len(taus) < 3:
+        raise ValueError("The tau grid needs at least 3 points")
+    mask = np.isfinite(t) & np.isfinite(y)
+    points = mask.sum(axis=1)
+    t0 = np.min(np.where(mask, t, np.inf), axis=1, initial=np.inf)
+    duration = np.max(np.where(mask, t, -np.inf), axis=1, initial=-np.inf) - t0
+    duration = np.where(np.isfinite(duration) & (duration > 0), duration, 1.0)
+    u = np.where(mask, (t - t0[:, None])/duration[:, None], 0)
+
+    segments = len(y)
+    n_params = 3 if drift else 2
+    step = max(1, int(chunk//max(1, len(taus)*y.shape[1]*n_params)))
+    best = np.zeros(segments, dtype=int)
+    log_tau = np.zeros(segments)
+    log_taus = np.log(taus)
+    spacing = log_taus[1] - log_taus[0]
+    for start in range(0, segments, step):
+        rows = slice(start, start + step)
+        _, sse = _solve(u[rows], y[rows], mask[rows], np.broadcast_to(taus, (len(u[rows]), len(taus))), drift)
+        j = np.argmin(sse, axis=1)
+        best[rows] = j
+        # parabola through the best three grid points (in log tau) around the minimum
+        inner = np.clip(j, 1, len(taus) - 2)
+        index = np.arange(len(j))
+        left, centre, right = sse[index, inner - 1], sse[index, inner], sse[index, inner + 1]
+        curvature = left - 2*centre + right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(curvature > 0, 0.5*(left - right)/curvature, 0.0)
+        offset = np.where(np.isfinite(offset), np.clip(offset, -1, 1), 0.0)
+        log_tau[rows] = np.where(j == inner, log_taus[inner] + offset*spacing, log_taus[j])
+    tau_rel = np.exp(log_tau)
+    coef = np.zeros((segments, n_params))
+    sse = np.zeros(segments)
+    for start in range(0, segments, step*len(taus)):
+        rows = slice(start, start + step*len(taus))
+        c, s = _solve(u[rows], y[rows], mask[rows], tau_rel[rows, None], drift)
+        coef[rows], sse[rows] = c[:, 0], s[:, 0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(mask, y, 0).sum(axis=1)/points
+        sst = (np.where(mask, y - mean[:, None], 0)**2).sum(axis=1)
+        r2 = 1 - sse/sst
+        rmse = np.sqrt(sse/points)
+    fit = pd.DataFrame({'t0': t0, 'tau': tau_rel*duration, 'y_inf': coef[:, 0], 'amplitude': coef[:, 1],
+                        'drift': coef[:, 2]/duration if drift else 0.0, 'r2': r2, 'rmse': rmse, 'points': points})
+    flags = np.zeros(segments, dtype=np.uint8)
+    few = points < max(min_points, n_params + 1)
+    flags[few] |= FIT_FEW_POINTS
+    flags[~few & ((best == 0) | (best == len(taus) - 1))] |= FIT_TAU_AT_EDGE
+    flags[~few & ~(np.abs(fit['amplitude'].to_numpy()) > 2*rmse)] |= FIT_NO_SETTLING
+    fit.loc[few, ['t0', 'tau', 'y_inf', 'amplitude', 'drift', 'r2', 'rmse']] = np.nan
+    fit['flags'] = flags
+    return fit
+
+
+def describe(flags):
+    """
+    Return the names of the FIT_* bits set in flags.
+    """
+    return [name for bit, name in FLAGS.items() if flags & bit]
+
+
+def fit_segments(table, value, time = None, by = 'mM', interval = 1.0, **kwargs):
+    """
+    Fit the settling of every segment of a long table in one batch.
+
+    Parameters:
+    - table (pd.DataFrame): one row per reading (e.g. series_table, a feature table, constantbias_test data).
+    - value (str): column of the readings.
+    - time (str, optional): column of the times. Default is None (readings every interval).
+    - by (str or list, optional): columns identifying a segment (e.g. ['DUT', 'mM']). Default is 'mM'.
+    - interval (float, optional): time between two readings when time is None. Default is 1.
+    - kwargs: passed to fit_settling (taus, drift, min_points).
+
+    Returns:
+    - fit (pd.DataFrame): one row per segment with the by columns and the fit.
+    """
+    keys, t, y = stack_segments(table, value, time, by, interval)
+    return pd.concat([keys, fit_settling(t, y, **kwargs)], axis=1)
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+import utils
+import sweep_grid
+from pcb_frames import FrameIndex
+
+# PCB channel -> Keithley column it is compared with
+CHANNELS = {'Ch1': 'DrainVLeft', 'Ch2': 'DrainVRight'}
+
+
+def capture_frames(data, column, frame_length = None, index = None):
+    """
+    Reshape one column of a PCB capture into a (frames x samples) array.
+    The frames are segmented on the DAC ramp (see pcb_frames.FrameIndex) and only complete frames are kept.
+
+    Parameters:
+    - data (DataFrame): PCB capture (see utils.read_isens_txt).
+    - column (str): 'Ch1' or 'Ch2'.
+    - frame_length (int, optional): samples kept per frame. Default is the detected frame length.
+    - index (FrameIndex, optional): frame index of the capture, to avoid segmenting it again for every column.
+
+    Returns:
+    - frames (np.array): 2D array (frames x samples).
+    """
+    if index is None:
+        index = FrameIndex.from_capture(data)
+    return index.to_array(data[column], frame_length)
+
+
+def interpolation_weights(x, x_new):
+    """
+    Indices and weights of the linear interpolation from grid x onto x_new.
+    Computed once and applied to any number of frames with resample().
+
+    Returns:
+    - left (np.array): index of the left neighbour of each point of x_new.
+    - weight (np.array): weight of the right neighbour (NaN for points outside x).
+    """
+    x = np.asarray(x, dtype=float)
+    x_new = np.asarray(x_new, dtype=float)
+    left = np.clip(np.searchsorted(x, x_new, side='right') - 1, 0, len(x) - 2)
+    weight = (x_new - x[left])/(x[left + 1] - x[left])
+    weight[(x_new < x[0]) | (x_new > x[-1])] = np.nan
+    return left, weight
+
+
+def resample(frames, x, x_new):
+    """
+    Linearly interpolate every frame from grid x onto grid x_new at once.
+    Points of x_new outside x are NaN.
+
+    Parameters:
+    - frames (np.array): 2D array (frames x len(x)).
+    - x (np.array): grid of the frames (e.g. PCB current of each sample).
+    - x_new (np.array): target grid (e.g. Keithley 'DrainI').
+
+    Returns:
+    - resampled (np.array): 2D array (frames x len(x_new)).
+    """
+    left, weight = interpolation_weights(x, x_new)
+    return _interpolate(frames, left, weight)
+
+
+def _interpolate(frames, left, weight):
+    frames = np.atleast_2d(frames)
+    return frames[:, left]*(1 - weight) + frames[:, left + 1]*weight
+
+
+def fit_offset_gain(pcb, reference):
+    """
+    Least squares fit of reference = gain*pcb + offset, solved for all the frames at once.
+    NaN points (e.g. outside the resampling range) are ignored.
+
+    Parameters:
+    - pcb (np.array): 2D array (frames x points) of PCB values.
+    - reference (np.array): 1D array (points) or 2D array (frames x points) of Keithley values.
+
+    Returns:
+    - gain (np.array), offset (np.array), rmse (np.array): one value per frame.
+    """
+    pcb = np.atleast_2d(pcb)
+    reference = np.broadcast_to(reference, pcb.shape)
+    valid = ~(np.isnan(pcb) | np.isnan(reference))
+    x = np.where(valid, pcb, 0.0)
+    y = np.where(valid, reference, 0.0)
+    n = valid.sum(axis=1)
+    mean_x = x.sum(axis=1)/n
+    mean_y = y.sum(axis=1)/n
+    dx = np.where(valid, x - mean_x[:, None], 0.0)
+    dy = np.where(valid, y - mean_y[:, None], 0.0)
+    gain = (dx*dy).sum(axis=1)/(dx*dx).sum(axis=1)
+    offset = mean_y - gain*mean_x
+    residuals = np.where(valid, y - (gain[:, None]*x + offset[:, None]), 0.0)
+    rmse = np.sqrt((residuals**2).sum(axis=1)/n)
+    return gain, offset, rmse
+
+
+def keithley_reference(keithley, low, high, columns = None):
+    """
+    Select the Keithley points with low <= DrainI <= high. The mask is evaluated once for all the columns.
+
+    Parameters:
+    - keithley (DataFrame): Keithley sweep with 'DrainI' and the columns to compare.
+    - low, high (float): current range [A].
+    - columns (list, optional): columns to return. Default is the values of CHANNELS.
+
+    Returns:
+    - current (np.array): 'DrainI' in the range.
+    - reference (dict): column -> np.array of the values in the range.
+    """
+    if columns is None:
+        columns = list(CHANNELS.values())
+    current = np.asarray(keithley['DrainI'], dtype=float)
+    mask = (current >= low) & (current <= high)
+    return current[mask], {column: np.asarray(keithley[column], dtype=float)[mask] for column in columns}
+
+
+def calibrate_capture(data, keithley, pcb_range = (10e-9, 500e-9), keithley_range = (30e-9, 510e-9),
+                      channels = None, trim = 1):
+    """
+    Calibrate every frame of a PCB capture against a Keithley sweep of the same device.
+    The frames are resampled on the Keithley current grid and offset/gain are fitted per frame and channel.
+
+    Parameters:
+    - data (DataFrame): PCB capture (see utils.read_isens_txt).
+    - keithley (DataFrame): Keithley sweep with 'DrainI' and the columns in channels.
+    - pcb_range (tuple, optional): current sourced by the PCB at the first and last sample of a frame [A].
+    - keithley_range (tuple, optional): 'DrainI' range of the Keithley points used for the fit [A].
+    - channels (dict, optional): PCB channel -> Keithley column. Default is CHANNELS.
+    - trim (int, optional): samples dropped at the end of each frame (DAC reset). Default is 1.
+
+    Returns:
+    - calibration (DataFrame): 'frame', 'channel', 'gain', 'offset', 'rmse' columns, one row per frame and channel.
+    """
+    if channels is None:
+        channels = CHANNELS
+    current, reference = keithley_reference(keithley, keithley_range[0], keithley_range[1], list(channels.values()))
+    index = FrameIndex.from_capture(data)
+    n_samples = index.frame_length - trim
+    x_pcb = sweep_grid.get_grid(pcb_range[0], pcb_range[1], num = n_samples).x
+    left, weight = interpolation_weights(x_pcb, current)
+
+    results = []
+    for channel, column in channels.items():
+        frames = capture_frames(data, channel, n_samples, index)
+        resampled = _interpolate(frames, left, weight)
+        gain, offset, rmse = fit_offset_gain(resampled, reference[column])
+        results.append(pd.DataFrame({'frame': index.complete(), 'channel': channel,
+                                     'gain': gain, 'offset': offset, 'rmse': rmse}))
+    return pd.concat(results, ignore_index=True)
+
+
+def calibrate_batch(paths, keithley, **kwargs):
+    """
+    Calibrate a batch of PCB captures (iSENS .txt files) against the same Keithley sweep.
+
+    Parameters:
+    - paths (list): paths of the iSENS txt files.
+    - keithley (DataFrame): Keithley sweep (see calibrate_capture).
+    - kwargs: passed to calibrate_capture.
+
+    Returns:
+    - calibration (DataFrame): calibrate_capture results with an additional 'file' column.
+    """
+    results = []
+    for path in paths:
+        calibration = calibrate_capture(utils.read_isens_txt(path), keithley, **kwargs)
+        calibration.insert(0, 'file', path)
+        results.append(calibration)
+    return pd.concat(results, ignore_index=True)
+
+
+def apply_calibration(frames, gain, offset):
+    """
+    Map PCB frames onto the Keithley scale with the fitted gain and offset (one per frame or one for all).
+    """
+    return np.atleast_2d(frames)*np.reshape(gain, (-1, 1)) + np.reshape(offset, (-1, 1))
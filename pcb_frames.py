@@ -0,0 +1,142 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+class FrameIndex:
+    """
+    Index of the sweep frames of a PCB capture. The frame boundaries are detected once from the
+    DAC ramp (a new frame starts where the DAC value drops) and stored as start/stop offsets, so any
+    column of the capture can then be split into frames without copying it.
+
+    Usage:
+        index = FrameIndex.from_capture(data)
+        step3 = index.frame(data['Ch2'], 3)   # view of the 4th sweep
+        ch2 = index.to_array(data['Ch2'])     # (frames x samples) array
+    """
+
+    def __init__(self, dac, min_length = 2):
+        """
+        Parameters:
+        - dac (array-like): DAC column of the capture.
+        - min_length (int, optional): frames shorter than this (glitches of the ramp) are merged in the previous one. Default is 2.
+        """
+        dac = np.asarray(dac, dtype=float)
+        starts = np.concatenate(([0], ramp_starts(dac))) if len(dac) else np.array([], dtype=int)
+        stops = np.append(starts[1:], len(dac))
+        keep = np.ones(len(starts), dtype=bool)
+        keep[1:] = (stops - starts)[1:] >= min_length
+        starts = starts[keep]
+        self.starts = starts.astype(np.intp)
+        self.stops = np.append(starts[1:], len(dac)).astype(np.intp)
+        self.n_samples = len(dac)
+
+    @classmethod
+    def from_capture(cls, data, column = 'DAC', **kwargs):
+        """
+        Build the index from the DAC column of a capture DataFrame (see utils.read_isens_txt).
+        """
+        return cls(data[column], **kwargs)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return "FrameIndex(frames=%d, frame_length=%d)" % (len(self), self.frame_length)
+
+    @property
+    def lengths(self):
+        return self.stops - self.starts
+
+    @property
+    def frame_length(self):
+        """
+        Most common frame length (282 for the iSENS firmware). Incomplete first/last frames are shorter.
+        """
+        if not len(self):
+            return 0
+        values, counts = np.unique(self.lengths, return_counts=True)
+        return int(values[np.argmax(counts)])
+
+    def complete(self):
+        """
+        Indices of the frames with the nominal length.
+        """
+        return np.flatnonzero(self.lengths >= self.frame_length)
+
+    def frame(self, values, i):
+        """
+        View of frame i of a column of the capture (no copy).
+        """
+        values = _as_array(values)
+        return values[self.starts[i]:self.stops[i]]
+
+    def frames(self, values):
+        """
+        List of the views of all the frames of a column of the capture.
+        """
+        values = _as_array(values)
+        return [values[start:stop] for start, stop in zip(self.starts, self.stops)]
+
+    def to_array(self, values, length = None, frames = None):
+        """
+        Reshape a column of the capture into a (frames x samples) array for vectorized per-step analysis.
+        When the selected frames are evenly spaced (the usual case) the result is a read-only view of values.
+
+        Parameters:
+        - values (array-like): column of the capture (e.g. data['Ch2']).
+        - length (int, optional): samples kept per frame. Default is frame_length.
+        - frames (array-like, optional): indices of the frames to keep. Default is the complete frames.
+
+        Returns:
+        - array (np.array): 2D array (frames x length).
+        """
+        values = _as_array(values)
+        if length is None:
+            length = self.frame_length
+        if frames is None:
+            frames = self.complete()
+        starts = self.starts[frames]
+        if np.any(self.stops[frames] - starts < length):
+            raise ValueError("Some of the selected frames are shorter than "+str(length)+" samples")
+        if len(starts) == 0:
+            return np.empty((0, length), dtype=values.dtype)
+        periods = np.diff(starts)
+        if len(periods) == 0 or np.all(periods == periods[0]):
+            period = periods[0] if len(periods) else length
+            view = as_strided(values[starts[0]:], shape=(len(starts), length),
+                              strides=(period*values.strides[0], values.strides[0]), writeable=False)
+            return view
+        return np.stack([values[start:start + length] for start in starts])
+
+
+def ramp_starts(dac, previous = None):
+    """
+    Offsets where a new DAC ramp (sweep frame) starts, i.e. where the DAC value drops.
+    Used both by FrameIndex and by the live stream (pcb_stream), which passes the last DAC value of
+    the previous block as previous.
+    """
+    dac = np.asarray(dac, dtype=float)
+    if previous is None:
+        return np.flatnonzero(np.diff(dac) < 0) + 1
+    return np.flatnonzero(np.diff(dac, prepend=previous) < 0)
+
+
+def frame_stats(frames, Nlastvalues = 5):
+    """
+    Per-frame statistics of a (frames x samples) array: max value and mean/std of the last Nlastvalues samples
+    (the same window utils.calculate_mean_std uses for the Keithley sweeps).
+
+    Parameters:
+    - frames (np.array): 2D array (frames x samples), e.g. FrameIndex.to_array(data['Ch2']).
+    - Nlastvalues (int, optional): number of last samples averaged. Default is 5.
+
+    Returns:
+    - stats (dict): 'max', 'last_mean', 'last_std' -> 1D arrays with one value per frame.
+    """
+    frames = np.atleast_2d(frames)
+    last = frames[:, -Nlastvalues:]
+    return {'max': frames.max(axis=1), 'last_mean': last.mean(axis=1), 'last_std': last.std(axis=1)}
+
+
+def _as_array(values):
+    # Series.to_numpy() of a float column returns the underlying buffer, so frames stay views
+    return values.to_numpy() if hasattr(values, 'to_numpy') else np.asarray(values)
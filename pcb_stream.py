@@ -0,0 +1,320 @@
+import socket
+import threading
+import time
+import numpy as np
+import pandas as pd
+from pcb_frames import FrameIndex, ramp_starts, frame_stats
+
+COLUMNS = ['time','DAC','Ch1','Ch2']
+
+
+class RingBuffer:
+    """
+    Fixed-size NumPy ring buffer of PCB samples (one row per sample, COLUMNS as columns).
+    Samples are addressed by their absolute position in the stream, so a frame can be read back
+    as long as it has not been overwritten.
+    """
+
+    def __init__(self, capacity, n_columns = len(COLUMNS)):
+        self.capacity = capacity
+        self._data = np.zeros((capacity, n_columns))
+        self.total = 0 # number of samples written since the start of the stream
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, block):
+        """
+        Append a (samples x columns) block. Only the last capacity samples of a bigger block are kept.
+        """
+        block = np.atleast_2d(block)
+        n = len(block)
+        if n > self.capacity:
+            block = block[-self.capacity:]
+            self.total += n - self.capacity
+            n = self.capacity
+        start = self.total % self.capacity
+        first = min(n, self.capacity - start)
+        self._data[start:start + first] = block[:first]
+        self._data[:n - first] = block[first:]
+        self.total += n
+
+    def get(self, start, stop):
+        """
+        Copy of the samples with absolute positions in [start, stop).
+        """
+        if start < self.total - self.capacity or stop > self.total:
+            raise IndexError("Samples "+str(start)+"-"+str(stop)+" are not in the buffer anymore")
+        return np.take(self._data, np.arange(start, stop) % self.capacity, axis=0)
+
+    def latest(self, n):
+        """
+        Copy of the last n samples.
+        """
+        n = min(n, len(self))
+        return self.get(self.total - n, self.total)
+
+
+class PCBStream:
+    """
+    Live ingestion of the PCB time/DAC/Ch1/Ch2 stream.
+    The samples are stored in a RingBuffer, segmented into frames on the DAC ramp (pcb_frames.ramp_starts)
+    and each completed frame is reduced with pcb_frames.frame_stats as soon as it ends.
+
+    Wire format: one sample per line, 'time,DAC,Ch1,Ch2\n' with Ch1/Ch2 in units of 1/scale V, as sent by
+    fake_emitter (encode_samples). This is the transposed layout of the saved iSENS .txt captures (one line
+    per column, see utils.read_isens_txt), so a board streaming the file layout needs a converter in front.
+    The frames are the ones of pcb_frames.FrameIndex (ramps shorter than min_length are merged in the previous
+    frame), and a frame is closed when the next one is confirmed, min_length samples after the DAC drop;
+    the last frame stays open. check_capture replays a recorded capture to verify both.
+
+    Usage:
+        stream = PCBStream(on_frame = print)
+        stream.run(socket_source('127.0.0.1', 5000))
+    """
+
+    def __init__(self, capacity = 65536, scale = 100, frame_length = None, Nlastvalues = 5, calibration = None, on_frame = None,
+                 min_length = 2):
+        """
+        Parameters:
+        - capacity (int, optional): samples kept in the ring buffer. Default is 65536.
+        - scale (float, optional): factor Ch1 and Ch2 are divided by to get Volts (as in utils.read_isens_txt). Default is 100.
+        - frame_length (int, optional): if given, a frame is closed as soon as it has frame_length samples instead of waiting for the next DAC drop
+          (its first frame_length samples; frames ending before are closed at the drop).
+        - Nlastvalues (int, optional): samples averaged by frame_stats. Default is 5.
+        - calibration (dict, optional): channel -> (gain, offset), e.g. from pcb_calibration.calibrate_capture, applied before the stats.
+        - on_frame (callable, optional): called with the result dict of every completed frame.
+        - min_length (int, optional): ramps shorter than this (glitches) are merged in the previous frame, as in FrameIndex. Default is 2.
+        """
+        self.buffer = RingBuffer(capacity)
+        self.scale = scale
+        self.frame_length = frame_length
+        self.Nlastvalues = Nlastvalues
+        self.calibration = calibration or {}
+        self.on_frame = on_frame
+        self.min_length = min_length
+        self.results = []
+        self._pending = b''
+        self._frame_start = None
+        self._starts = [] # DAC drops not handled yet (absolute positions)
+        self._last_dac = None
+        self._n_frames = 0
+
+    def feed(self, chunk, received = None):
+        """
+        Ingest a chunk of raw bytes (any size, lines can be split between chunks).
+
+        Parameters:
+        - chunk (bytes): raw data read from the source.
+        - received (float, optional): time.perf_counter() when the chunk was received, used for the latency. Default is now.
+
+        Returns:
+        - results (list): result dicts of the frames completed by this chunk.
+        """
+        if received is None:
+            received = time.perf_counter()
+        data = self._pending + chunk
+        end = data.rfind(b'\n')
+        if end < 0:
+            self._pending = data
+            return []
+        self._pending = data[end + 1:]
+        lines = data[:end].decode().replace('\r', '').split('\n')
+        values = [line.split(',') for line in lines if line.strip()]
+        if not values:
+            return []
+        block = np.array(values, dtype=float)
+        block[:, 2:] /= self.scale
+        return self.feed_samples(block, received)
+
+    def feed_samples(self, block, received = None):
+        """
+        Ingest a (samples x 4) array of already parsed samples.
+        """
+        if received is None:
+            received = time.perf_counter()
+        offset = self.buffer.total
+        self.buffer.append(block)
+        if self._frame_start is None:
+            self._frame_start = offset
+        self._starts.extend(int(start) for start in offset + ramp_starts(block[:, 1], self._last_dac))
+        self._last_dac = block[-1, 1]
+
+        # events in the order of the samples: frame_length reached, then the next DAC drop
+        completed = []
+        total = self.buffer.total
+        while True:
+            start = self._starts[0] if self._starts else None
+            if self.frame_length and self._frame_start + self.frame_length <= min(total, np.inf if start is None else start):
+                completed.append(self._close_frame(self._frame_start + self.frame_length, received))
+                # the rest of the ramp is ignored until the next DAC drop
+                self._frame_start = np.inf
+                continue
+            if start is None:
+                break
+            following = self._starts[1] if len(self._starts) > 1 else None
+            if following is None and total < start + self.min_length:
+                break # not known yet whether this ramp is a glitch
+            self._starts.pop(0)
+            if following is not None and following - start < self.min_length:
+                continue # glitch: merged in the current frame
+            if start > self._frame_start:
+                completed.append(self._close_frame(start, received))
+            self._frame_start = start
+        return completed
+
+    def _close_frame(self, stop, received):
+        # frames longer than the buffer keep only their most recent samples
+        start = max(int(self._frame_start), self.buffer.total - self.buffer.capacity)
+        frame = self.buffer.get(start, int(stop))
+        result = {'frame': self._n_frames, 'start': start, 'time': frame[-1, 0], 'samples': len(frame)}
+        for i, channel in enumerate(COLUMNS[2:]):
+            values = frame[:, 2 + i]
+            if channel in self.calibration:
+                gain, offset = self.calibration[channel]
+                values = values*gain + offset
+            for name, value in frame_stats(values, self.Nlastvalues).items():
+                result[channel+'_'+name] = value[0]
+        result['latency'] = time.perf_counter() - received
+        self._n_frames += 1
+        self.results.append(result)
+        if self.on_frame:
+            self.on_frame(result)
+        return result
+
+    def run(self, source, max_frames = None):
+        """
+        Ingest a source (iterable of byte chunks, see socket_source and serial_source) until it ends
+        or max_frames frames have been completed.
+
+        Returns:
+        - results (list): result dicts of all the completed frames.
+        """
+        for chunk in source:
+            self.feed(chunk)
+            if max_frames and self._n_frames >= max_frames:
+                break
+        return self.results
+
+
+def socket_source(host, port, chunk_size = 4096, timeout = None):
+    """
+    Yield the byte chunks received from a TCP socket until the connection is closed.
+    """
+    with socket.create_connection((host, port), timeout=timeout) as connection:
+        while True:
+            chunk = connection.recv(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def serial_source(port, baudrate = 115200, chunk_size = 4096, timeout = 1):
+    """
+    Yield the byte chunks read from a serial port (requires pyserial).
+    """
+    import serial
+    with serial.Serial(port, baudrate, timeout=timeout) as connection:
+        while True:
+            chunk = connection.read(max(1, min(chunk_size, connection.in_waiting)))
+            if chunk:
+                yield chunk
+
+
+def encode_samples(samples, scale = 100):
+    """
+    Encode (samples x 4) time/DAC/Ch1/Ch2 values [V] in the wire format of PCBStream (one sample per line).
+    """
+    samples = np.array(samples, dtype=float)
+    samples[:, 2:] *= scale
+    return ''.join('%.10g,%.10g,%.10g,%.10g\n' % tuple(row) for row in samples).encode()
+
+
+def check_capture(data, chunk_size = 4096, scale = 100, frame_length = None, Nlastvalues = 5, min_length = 2):
+    """
+    Replay a recorded capture through PCBStream in the wire format (chunks of chunk_size bytes, lines split between
+    chunks) and compare its frames with the offline segmentation (pcb_frames.FrameIndex) and stats.
+
+    Parameters:
+    - data (str or DataFrame): path of an iSENS .txt capture or capture read with utils.read_isens_txt.
+    - chunk_size (int, optional): bytes per chunk. Default is 4096.
+    - scale, frame_length, Nlastvalues, min_length: as in PCBStream.
+
+    Returns:
+    - frames (pd.DataFrame): one row per frame the stream closes with 'start', 'samples' (offline), 'stream_start',
+      'stream_samples' and 'match' (same boundaries and stats). The last frame of the capture is left open by the stream.
+    """
+    if isinstance(data, str):
+        import utils
+        data = utils.read_isens_txt(data, scale)
+    samples = np.column_stack([pd.to_numeric(data[column], errors='coerce').to_numpy(dtype=float) for column in COLUMNS])
+    stream = PCBStream(capacity = len(samples) + 1, scale = scale, frame_length = frame_length, Nlastvalues = Nlastvalues,
+                       min_length = min_length)
+    raw = encode_samples(samples, scale)
+    for i in range(0, len(raw), chunk_size):
+        stream.feed(raw[i:i + chunk_size])
+    index = FrameIndex(samples[:, 1], min_length = min_length)
+    rows = []
+    for i, (start, stop) in enumerate(zip(index.starts, index.stops)):
+        if i == len(index) - 1 and not (frame_length and stop - start >= frame_length):
+            break # still open at the end of the capture
+        if frame_length:
+            stop = min(stop, start + frame_length)
+        row = {'frame': i, 'start': int(start), 'samples': int(stop - start)}
+        result = stream.results[i] if i < len(stream.results) else {}
+        row['stream_start'] = result.get('start', -1)
+        row['stream_samples'] = result.get('samples', 0)
+        match = row['stream_start'] == row['start'] and row['stream_samples'] == row['samples']
+        for c, channel in enumerate(COLUMNS[2:]):
+            for name, value in frame_stats(samples[start:stop, 2 + c], Nlastvalues).items():
+                match = match and np.isclose(result.get(channel+'_'+name, np.nan), value[0], rtol=1e-8, atol=1e-12, equal_nan=True)
+        row['match'] = bool(match)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['frame', 'start', 'samples', 'stream_start', 'stream_samples', 'match'])
+
+
+def fake_emitter(data, host = '127.0.0.1', port = 0, rate = None, scale = 100):
+    """
+    Serve a PCB capture on a local TCP socket as the live board would, one sample per line.
+    Meant to test PCBStream without the board.
+
+    Parameters:
+    - data (DataFrame): capture to replay (see utils.read_isens_txt) with numeric 'time', 'DAC', 'Ch1', 'Ch2'.
+    - host (str, optional): interface to listen on. Default is '127.0.0.1'.
+    - port (int, optional): port to listen on. Default is 0 (any free port).
+    - rate (float, optional): samples per second. Default is None (as fast as possible).
+    - scale (float, optional): factor Ch1 and Ch2 are multiplied by (inverse of the reader scale). Default is 100.
+
+    Returns:
+    - port (int): port the emitter is listening on.
+    - thread (Thread): thread serving the first client that connects.
+    """
+    samples = np.asarray(data[COLUMNS], dtype=float)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+
+    def serve():
+        with server:
+            connection, _ = server.accept()
+            with connection:
+                block = 1 if rate else 256
+                for i in range(0, len(samples), block):
+                    connection.sendall(encode_samples(samples[i:i + block], scale))
+                    if rate:
+                        time.sleep(1/rate)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return server.getsockname()[1], thread
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Check the live segmentation of PCBStream against a recorded iSENS capture')
+    parser.add_argument('capture', help='iSENS .txt capture')
+    parser.add_argument('--frame-length', type=int, default=None)
+    args = parser.parse_args()
+    frames = check_capture(args.capture, frame_length=args.frame_length)
+    print(int(frames['match'].sum()), 'of', len(frames), 'frames match the offline FrameIndex')
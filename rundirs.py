@@ -0,0 +1,268 @@
+"""
+Race-free run directories and workbooks for concurrent acquisitions (several processes or threads saving for
+the same DUT/TOT on the same day).
+
+- run_folder() creates the mmddyyyy-device-TOT[-comment] folder atomically (shared by the runs of the day),
+  new_run_folder() allocates a folder of its own with a unique suffix.
+- every process has a unique run ID (run_id()) and every thread a claim ID (claim_id()); claim() takes a
+  workbook name for the thread with a lockfile (<workbook>.lock, created with O_EXCL). A name owned by another
+  live run or thread is not overwritten: the caller gets <workbook>-<claim id>.xlsx instead. The owner of a
+  lock is checked by its pid on the same host (os.kill, OpenProcess on Windows) and by the heartbeat of the
+  lock mtime on other hosts. The locks are released when the process exits.
+- atomic_write() writes a file through a temporary file in the same folder and os.replace, so readers (and
+  the other writers) never see a half written workbook.
+"""
+import atexit
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+
+LOCK_SUFFIX = '.lock'
+HEARTBEAT = 10.0 # seconds between two touches of the locks of the run (their mtime shows the run is alive)
+STALE_AFTER = 60.0 # seconds without heartbeat after which a lock of another host is considered stale
+EMPTY_STALE_AFTER = 2.0 # seconds after which a lock without a readable owner (torn by a crash) is considered stale
+CLAIM_ATTEMPTS = 200
+
+_run_id = None
+_claimed = {} # path -> claim ID of the thread that claimed it
+_thread = threading.local()
+_threads = itertools.count(1)
+_beating = False
+_locks = {}
+_guard = threading.Lock()
+
+
+def run_id():
+    """
+    Unique ID of the run of this process (date, time, pid and a random part), e.g. '20241019-101530-4242-1a2b'.
+    """
+    global _run_id
+    with _guard:
+        if _run_id is None:
+            _run_id = datetime.now().strftime('%Y%m%d-%H%M%S') + '-%d-%s' % (os.getpid(), uuid.uuid4().hex[:4])
+        return _run_id
+
+
+def folder_name(device_name, type_of_test, additional_comment = None, date = None):
+    """
+    Name of the folder of a run: mmddyyyy-device_name-type_of_test[-additional_comment] (utils.create_folder).
+    """
+    name = (date or datetime.now()).strftime('%m%d%Y')+'-'+device_name+'-'+type_of_test
+    return name+'-'+additional_comment if additional_comment else name
+
+
+def run_folder(device_name, type_of_test, additional_comment = None, root = None):
+    """
+    Create (if needed) the folder of the day for device_name/type_of_test, safely with other writers creating it at
+    the same time.
+
+    Returns:
+    - directory (str): name of the folder (relative to root).
+    - created (bool): True if this call created it.
+    """
+    directory = folder_name(device_name, type_of_test, additional_comment)
+    try:
+        os.mkdir(os.path.join(root or os.getcwd(), directory))
+        return directory, True
+    except FileExistsError:
+        return directory, False
+
+
+def new_run_folder(device_name, type_of_test, additional_comment = None, root = None):
+    """
+    Allocate a new folder for a run: the name of run_folder, or the first free one with the suffix -2, -3, ...
+    Each folder is created by exactly one caller (os.mkdir is atomic).
+
+    Returns:
+    - directory (str): name of the folder (relative to root).
+    """
+    base = folder_name(device_name, type_of_test, additional_comment)
+    n = 1
+    while True:
+        directory = base if n == 1 else base+'-'+str(n)
+        try:
+            os.mkdir(os.path.join(root or os.getcwd(), directory))
+            return directory
+        except FileExistsError:
+            n += 1
+
+
+def claim_id():
+    """
+    ID of the claims of the calling thread: run_id() in the main thread, run_id()-<n> in the other threads, so
+    threads of the same run saving the same workbook get different files.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return run_id()
+    if not hasattr(_thread, 'id'):
+        _thread.id = run_id()+'-'+str(next(_threads)) # itertools.count is thread safe
+    return _thread.id
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5 # access denied: the process exists
+        try:
+            code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+            return code.value == 259 # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _alive(owner, lock):
+    if owner.get('run') == run_id():
+        return True
+    if owner.get('host') == socket.gethostname():
+        try:
+            return _pid_alive(int(owner.get('pid', 0)))
+        except (ValueError, OSError):
+            return True
+    # another host: its live runs touch their locks every HEARTBEAT seconds
+    return _age(lock) < STALE_AFTER
+
+
+def _read_owner(lock):
+    try:
+        with open(lock) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {} # being written by its owner, or removed meanwhile
+
+
+def _write_owner(lock, exclusive = True):
+    owner = json.dumps({'run': run_id(), 'claim': claim_id(), 'pid': os.getpid(), 'host': socket.gethostname(), 'time': time.time()})
+    if exclusive:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        with os.fdopen(fd, 'w') as f:
+            f.write(owner)
+    else: # take over a stale lock
+        temporary = lock+'.'+claim_id()
+        with open(temporary, 'w') as f:
+            f.write(owner)
+        os.replace(temporary, lock)
+
+
+def _age(lock):
+    try:
+        return time.time() - os.path.getmtime(lock)
+    except OSError:
+        return 0.0 # removed meanwhile
+
+
+def _heartbeat():
+    while True:
+        time.sleep(HEARTBEAT)
+        with _guard:
+            paths = list(_claimed)
+        for path in paths:
+            try:
+                os.utime(path+LOCK_SUFFIX)
+            except OSError:
+                pass
+
+
+def claim(path):
+    """
+    Take the file path for the calling thread of this run.
+
+    Parameters:
+    - path (str): path of the file the run wants to write.
+
+    Returns:
+    - path (str): path the thread can write: path itself if it's free, already claimed by this thread or its owner is
+      dead, otherwise path with the claim ID (claim_id) before the extension. A lock without a readable owner is waited
+      for (its owner is writing it) up to EMPTY_STALE_AFTER seconds, then taken over.
+    """
+    global _beating
+    path = os.path.abspath(path)
+    for _ in range(CLAIM_ATTEMPTS):
+        if _claimed.get(path) == claim_id():
+            return path
+        lock = path+LOCK_SUFFIX
+        try:
+            _write_owner(lock)
+        except FileExistsError:
+            owner = _read_owner(lock)
+            if owner and _alive(owner, lock):
+                root, extension = os.path.splitext(path)
+                path = root+'-'+claim_id()+extension
+                continue
+            if not owner and _age(lock) < EMPTY_STALE_AFTER:
+                time.sleep(0.05) # the owner is writing it
+                continue
+            # stale lock of a dead run, or empty/torn lock left by a crash
+            _write_owner(lock, exclusive = False)
+            if _read_owner(lock).get('claim') != claim_id(): # another run took it over at the same time
+                continue
+        owner = claim_id()
+        with _guard:
+            _claimed[path] = owner
+            if not _beating:
+                threading.Thread(target=_heartbeat, daemon=True).start()
+                _beating = True
+        return path
+    raise TimeoutError("Couldn't claim "+path)
+
+
+def release(path = None):
+    """
+    Release the lock of a claimed file (default: all the files of this run).
+    """
+    paths = [os.path.abspath(path)] if path else list(_claimed)
+    for path in paths:
+        if _read_owner(path+LOCK_SUFFIX).get('run') == run_id():
+            try:
+                os.remove(path+LOCK_SUFFIX)
+            except OSError:
+                pass
+        with _guard:
+            _claimed.pop(path, None)
+
+
+atexit.register(release)
+
+
+def file_lock(path):
+    """
+    In-process lock of a file (threads of the same run writing the same file).
+    """
+    with _guard:
+        return _locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def atomic_write(path, write):
+    """
+    Write a file atomically: write(temporary_path) writes a temporary file in the same folder (same extension,
+    so that e.g. ExcelWriter picks the right engine), which then replaces path.
+
+    Parameters:
+    - path (str): final path.
+    - write (callable): function writing the file at the path it receives.
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    extension = os.path.splitext(name)[1]
+    temporary = os.path.join(folder, '.'+name+'.'+run_id()+'.'+str(threading.get_ident())+'.tmp'+extension)
+    with file_lock(path):
+        try:
+            write(temporary)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
@@ -0,0 +1,415 @@
+"""
+Curve-similarity search over the device library ("which previous devices looked like this one").
+
+Every sweep is resampled onto a canonical grid of `points` positions between its first and last point
+(so sweeps with a different number of points or step compare), normalized (zero mean, unit variance over
+all its channels, so the shape is compared and not the absolute level; normalize=False keeps the levels)
+and reduced to a compact embedding with a fixed random orthonormal projection. The projection only
+depends on the parameters of the index, so every process embeds the same way and the index can be
+built incrementally: each batch of new sweeps is appended as its own part file
+(part-<run id>-<n>.npz), the parts are concatenated on load and merged into one when there are more than
+MAX_PARTS. A sweep is identified by (file, sheet, step) and added once: a workbook saved again (sensing_test
+saves the growing workbook after every concentration) only adds its new sweeps. A query is a brute-force k-nearest-neighbour search on the
+float32 embeddings (one matrix product and a partial sort), a few milliseconds on tens of thousands
+of sweeps.
+
+Two kinds of curves are indexed, in separate folders of the library:
+- 'diode': VDL/VDR (or DrainVLeft/DrainVRight) of the diode connection sweeps.
+- 'transfer': |Ids| of the VgsIds sweeps.
+
+utils.save_xls adds every saved workbook to the library of the working directory (add_saved);
+build() back-fills it from the run folders.
+
+Usage:
+    neighbours = similarity.SimilarityIndex(kind='diode').query(sweep, k=10)
+    similarity.build('results/')
+"""
+import glob
+import itertools
+import os
+import numpy as np
+import pandas as pd
+import rundirs
+from features import LEFT, RIGHT, SHEET_PREFIX, split_sweeps
+
+# x column (first found) and channels (each a tuple of alternative names) of each kind of curve
+KINDS = {
+    'diode': {'x': ('IDL', 'DrainI'), 'channels': (LEFT, RIGHT)},
+    'transfer': {'x': ('Vgs',), 'channels': (('Ids',),)},
+}
+
+# metadata stored with every sweep
+TAGS = ('file', 'sheet', 'DUT', 'TOT', 'comment')
+
+# part files merged into one by refresh() above this number
+MAX_PARTS = 16
+
+_parts = itertools.count()
+
+
+def default_path(root = None):
+    """
+    Folder of the library: $WEARS_SIMILARITY if set, otherwise similarity/ in root (default: the working directory).
+    """
+    return os.environ.get('WEARS_SIMILARITY') or os.path.join(root or os.getcwd(), 'similarity')
+
+
+def _column(df, names):
+    for name in names:
+        if name in df.columns:
+            return name
+    return None
+
+
+def kind_of(df):
+    """
+    Return the kind of curve of a sweep ('diode', 'transfer') or None if it can't be indexed.
+    """
+    for kind, spec in KINDS.items():
+        if all(_column(df, names) for names in spec['channels']):
+            return kind
+    return None
+
+
+def resample_curve(df, kind, points = 64):
+    """
+    Resample the channels of a sweep onto the canonical grid of the index.
+
+    The position of each point along the sweep is taken from the x column if it is monotonic, otherwise from
+    the index (the grid position of the point, also for the adaptive sweeps), and scaled to [0, 1].
+
+    Parameters:
+    - df (pd.DataFrame): one sweep.
+    - kind (str): kind of curve (see KINDS).
+    - points (int, optional): points of the canonical grid per channel. Default is 64.
+
+    Returns:
+    - vector (np.array): channels resampled and concatenated (len = points*channels), or None if the sweep has
+      less than 2 valid points.
+    """
+    spec = KINDS[kind]
+    columns = [_column(df, names) for names in spec['channels']]
+    values = df[columns].to_numpy(dtype=float)
+    if kind == 'transfer':
+        values = np.abs(values)
+    x_column = _column(df, spec['x'])
+    x = df[x_column].to_numpy(dtype=float) if x_column else None
+    if x is None or not np.isfinite(x).all() or not (np.all(np.diff(x) > 0) or np.all(np.diff(x) < 0)):
+        x = np.asarray(df.index, dtype=float)
+    valid = np.isfinite(values).all(axis=1) & np.isfinite(x)
+    x, values = x[valid], values[valid]
+    if len(x) < 2 or x[-1] == x[0]:
+        return None
+    position = (x - x[0])/(x[-1] - x[0])
+    if np.any(np.diff(position) < 0):
+        order = np.argsort(position, kind='stable')
+        position, values = position[order], values[order]
+    grid = np.linspace(0, 1, points)
+    return np.concatenate([np.interp(grid, position, values[:, i]) for i in range(values.shape[1])])
+
+
+def normalize_vectors(vectors):
+    """
+    Normalize every row to zero mean and unit variance (rows with no variance become zeros).
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=float))
+    centered = vectors - vectors.mean(axis=1, keepdims=True)
+    std = centered.std(axis=1, keepdims=True)
+    return np.divide(centered, std, out=np.zeros_like(centered), where=std > 0)
+
+
+def projection(size, dim, seed = 0):
+    """
+    Random orthonormal projection (size x dim) used for the embeddings; deterministic in (size, dim, seed).
+    """
+    gaussian = np.random.default_rng(seed).standard_normal((size, dim))
+    q, _ = np.linalg.qr(gaussian)
+    return q
+
+
+class SimilarityIndex:
+
+    def __init__(self, path = None, kind = 'diode', points = 64, dim = 16, normalize = True, seed = 0):
+        """
+        Open the index of one kind of curves in the library at path (created on the first add).
+
+        Parameters:
+        - path (str, optional): folder of the library. Default is default_path().
+        - kind (str, optional): kind of curves ('diode', 'transfer'). Default is 'diode'.
+        - points (int, optional): points of the canonical grid per channel. Default is 64.
+        - dim (int, optional): size of the embeddings (None: no projection, the resampled curves are compared). Default is 16.
+        - normalize (bool, optional): compare the shapes (zero mean, unit variance) instead of the levels. Default is True.
+        - seed (int, optional): seed of the projection. Default is 0.
+        """
+        if kind not in KINDS:
+            raise ValueError("Unknown kind of curve "+repr(kind)+", expected one of "+str(sorted(KINDS)))
+        self.kind = kind
+        self.folder = os.path.join(path or default_path(), kind)
+        self.points = points
+        self.normalize = normalize
+        size = points*len(KINDS[kind]['channels'])
+        self.dim = min(dim, size) if dim else None
+        self._projection = projection(size, self.dim, seed) if self.dim else None
+        self.params = np.array([points, self.dim or 0, int(normalize), seed])
+        self._loaded = []
+        self._embeddings = np.zeros((0, self.dim or size), dtype=np.float32)
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._meta = {tag: np.zeros(0, dtype=str) for tag in TAGS}
+        self._meta['step'] = np.zeros(0, dtype=int)
+        self._meta['mtime'] = np.zeros(0, dtype=float)
+
+    def __len__(self):
+        self.refresh()
+        return len(self._embeddings)
+
+    def __repr__(self):
+        return 'SimilarityIndex(%r, kind=%r, sweeps=%d, dim=%r)' % (self.folder, self.kind, len(self), self.dim)
+
+    def embed(self, sweeps):
+        """
+        Return the embeddings of sweeps (float32, one row per sweep; NaN rows for the sweeps that can't be resampled).
+
+        Parameters:
+        - sweeps (pd.DataFrame or list): one sweep or a list of sweeps of the kind of the index.
+        """
+        if isinstance(sweeps, pd.DataFrame):
+            sweeps = [sweeps]
+        size = self.points*len(KINDS[self.kind]['channels'])
+        vectors = np.full((len(sweeps), size), np.nan)
+        for i, df in enumerate(sweeps):
+            vector = resample_curve(df, self.kind, self.points)
+            if vector is not None:
+                vectors[i] = vector
+        if self.normalize:
+            invalid = np.isnan(vectors).any(axis=1)
+            vectors = normalize_vectors(vectors)
+            vectors[invalid] = np.nan
+        if self._projection is not None:
+            vectors = vectors @ self._projection/np.sqrt(size)
+        return vectors.astype(np.float32)
+
+    def _keys(self, meta):
+        return pd.Index([file+'\0'+sheet+'\0'+str(step) for file, sheet, step in zip(meta['file'], meta['sheet'], meta['step'])])
+
+    def add(self, sweeps, **tags):
+        """
+        Append sweeps to the index (one new part file). The sweeps already in the index (same file, sheet and step)
+        and the ones that can't be resampled are skipped.
+
+        Parameters:
+        - sweeps (list): sweeps of the kind of the index.
+        - tags: metadata of the sweeps, scalars or one value per sweep ('file', 'sheet', 'step', 'DUT', 'TOT', 'comment', 'mtime').
+
+        Returns:
+        - added (int): number of sweeps added.
+        """
+        meta = {}
+        for tag in TAGS + ('step', 'mtime'):
+            value = tags.get(tag)
+            if value is None:
+                value = '' if tag in TAGS else 0
+            values = np.asarray(value if np.ndim(value) else [value]*len(sweeps))
+            meta[tag] = values.astype(str) if tag in TAGS else values
+        self.refresh()
+        new = ~self._keys(meta).isin(self._keys(self._meta))
+        if not new.any():
+            return 0
+        embeddings = self.embed([sweep for sweep, is_new in zip(sweeps, new) if is_new])
+        keep = np.isfinite(embeddings).all(axis=1)
+        if not keep.any():
+            return 0
+        meta = {tag: values[new][keep] for tag, values in meta.items()}
+        self._write(embeddings[keep], meta)
+        return int(keep.sum())
+
+    def _write(self, embeddings, meta):
+        os.makedirs(self.folder, exist_ok=True)
+        name = 'part-'+rundirs.run_id()+'-'+str(next(_parts))+'.npz'
+        # the metadata members are prefixed (a member named 'file' would clash with the first argument of np.savez)
+        members = {'meta_'+tag: values for tag, values in meta.items()}
+        rundirs.atomic_write(os.path.join(self.folder, name), lambda temporary: np.savez(
+            temporary, params=self.params, embeddings=embeddings, **members))
+        return name
+
+    def refresh(self):
+        """
+        Load the part files added since the last load (also by other processes), and merge all the parts into one
+        when there are more than MAX_PARTS.
+        """
+        names = sorted(os.path.basename(path) for path in glob.glob(os.path.join(self.folder, 'part-*.npz')))
+        new = [name for name in names if name not in self._loaded]
+        if new:
+            embeddings, meta = [self._embeddings], {tag: [values] for tag, values in self._meta.items()}
+            for name in new:
+                try:
+                    with np.load(os.path.join(self.folder, name)) as part:
+                        if not np.array_equal(part['params'], self.params):
+                            raise ValueError("Part "+name+" of "+self.folder+" was built with other parameters (points, dim, normalize, seed): "
+                                             + str(part['params'].tolist()))
+                        embeddings.append(part['embeddings'])
+                        for tag in meta:
+                            meta[tag].append(part['meta_'+tag])
+                except FileNotFoundError: # merged by another process meanwhile (its rows are in the merged part)
+                    continue
+                self._loaded.append(name)
+            embeddings = np.concatenate(embeddings)
+            meta = {tag: np.concatenate(values) for tag, values in meta.items()}
+            # the same sweep can be in two parts (added by two processes at once, or loaded before and after a merge)
+            unique = ~self._keys(meta).duplicated()
+            self._embeddings = embeddings[unique]
+            self._meta = {tag: values[unique] for tag, values in meta.items()}
+            self._norms = np.einsum('ij,ij->i', self._embeddings, self._embeddings)
+        if len(self._loaded) > MAX_PARTS:
+            self.compact()
+
+    def compact(self):
+        """
+        Merge the part files loaded into a single part.
+        """
+        merged = self._loaded
+        self._loaded = [self._write(self._embeddings, self._meta)]
+        for name in merged:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError: # merged by another process too
+                pass
+
+    def indexed(self):
+        """
+        Return {file: mtime of the last version} of the files in the index (used by build to skip the files already indexed).
+        """
+        self.refresh()
+        return pd.Series(self._meta['mtime']).groupby(self._meta['file']).max().to_dict()
+
+    def search(self, embeddings, k = 10, exclude = None):
+        """
+        k nearest neighbours of a batch of embeddings (Euclidean distance).
+
+        Parameters:
+        - embeddings (np.array): queries (n x dim), e.g. from embed().
+        - k (int, optional): number of neighbours. Default is 10.
+        - exclude (np.array, optional): boolean mask of the stored sweeps that can't be returned.
+
+        Returns:
+        - indices (np.array): n x k indices of the stored sweeps, nearest first (-1 where fewer than k).
+        - distances (np.array): n x k distances (inf where fewer than k).
+        """
+        self.refresh()
+        queries = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        # |a|^2 - 2ab + |b|^2 with one matrix product picks the candidates; their distances are then computed
+        # directly (the expansion loses the small distances to cancellation in float32)
+        distances = self._norms[None, :] - 2*queries @ self._embeddings.T + np.einsum('ij,ij->i', queries, queries)[:, None]
+        if exclude is not None:
+            distances[:, exclude] = np.inf
+        k_ = min(k, distances.shape[1])
+        indices = np.full((len(queries), k), -1)
+        nearest = np.full((len(queries), k), np.inf)
+        if k_:
+            candidates = min(max(4*k_, k_ + 32), distances.shape[1])
+            part = np.argpartition(distances, candidates - 1, axis=1)[:, :candidates]
+            exact = np.sqrt(np.sum((self._embeddings[part] - queries[:, None, :])**2, axis=2))
+            exact[~np.isfinite(np.take_along_axis(distances, part, axis=1))] = np.inf
+            order = np.argsort(exact, axis=1, kind='stable')[:, :k_]
+            indices[:, :k_] = np.take_along_axis(part, order, axis=1)
+            nearest[:, :k_] = np.take_along_axis(exact, order, axis=1)
+        indices[~np.isfinite(nearest)] = -1
+        return indices, nearest
+
+    def query(self, sweep, k = 10, exclude_file = None):
+        """
+        Return the k stored sweeps most similar to sweep.
+
+        Parameters:
+        - sweep (pd.DataFrame): sweep of the kind of the index.
+        - k (int, optional): number of neighbours. Default is 10.
+        - exclude_file (str, optional): don't return the sweeps of this file (e.g. the workbook of the sweep itself).
+
+        Returns:
+        - neighbours (pd.DataFrame): one row per neighbour, nearest first, with the metadata and 'distance'.
+        """
+        embedding = self.embed(sweep)
+        if not np.isfinite(embedding).all():
+            raise ValueError("The sweep can't be resampled (less than 2 valid points or missing columns)")
+        self.refresh()
+        exclude = None
+        if exclude_file is not None:
+            exclude = np.isin(self._meta['file'], [exclude_file, os.path.abspath(exclude_file)])
+        indices, distances = self.search(embedding, k, exclude)
+        found = indices[0] >= 0
+        neighbours = pd.DataFrame({tag: values[indices[0][found]] for tag, values in self._meta.items()})
+        neighbours['distance'] = distances[0][found]
+        return neighbours
+
+
+def _sweeps_by_kind(list_df):
+    items = list_df.items() if isinstance(list_df, dict) else enumerate(list_df)
+    by_kind = {}
+    for sheet, df in items:
+        for step, sweep in enumerate(split_sweeps(df)):
+            kind = kind_of(sweep)
+            if kind:
+                sweeps, sheets, steps = by_kind.setdefault(kind, ([], [], []))
+                sweeps.append(sweep)
+                sheets.append(str(sheet))
+                steps.append(step)
+    return by_kind
+
+
+def add_saved(path, list_df, root = None, **tags):
+    """
+    Add the sweeps of a workbook just written by utils.save_xls to the library.
+
+    Parameters:
+    - path (str): path of the workbook.
+    - list_df (list or dict): sheets of the workbook.
+    - root (str, optional): folder of the library. Default is default_path().
+    - tags: metadata of the sweeps (DUT, TOT, comment).
+
+    Returns:
+    - added (int): number of sweeps added.
+    """
+    path = os.path.abspath(path)
+    added = 0
+    for kind, (sweeps, sheets, steps) in _sweeps_by_kind(list_df).items():
+        index = SimilarityIndex(root, kind)
+        added += index.add(sweeps, file=path, sheet=sheets, step=steps, mtime=os.path.getmtime(path), **tags)
+    return added
+
+
+def build(root, path = None, pattern = '*.xlsx'):
+    """
+    Back-fill the library with the workbooks under root (recursively). Workbooks not modified since they were
+    indexed are skipped, and only the new sweeps of the others are added.
+
+    Parameters:
+    - root (str): folder to scan.
+    - path (str, optional): folder of the library. Default is default_path(root).
+    - pattern (str, optional): file name pattern of the workbooks. Default is '*.xlsx'.
+
+    Returns:
+    - added (int): number of sweeps added.
+    """
+    import catalog
+    path = path or default_path(root)
+    indexed = {}
+    for kind in KINDS:
+        indexed.update(SimilarityIndex(path, kind).indexed())
+    added = 0
+    for workbook in sorted(glob.glob(os.path.join(root, '**', pattern), recursive=True)):
+        workbook = os.path.abspath(workbook)
+        if os.path.basename(workbook).startswith(('~$', '.')) or indexed.get(workbook, -1) >= os.path.getmtime(workbook):
+            continue
+        sheets = pd.read_excel(workbook, sheet_name=None, index_col=0)
+        sheets = {name[len(SHEET_PREFIX):] if name.startswith(SHEET_PREFIX) else name: df for name, df in sheets.items()}
+        info = catalog.parse_folder(os.path.basename(os.path.dirname(workbook))) or {}
+        added += add_saved(workbook, sheets, path, DUT=info.get('device', ''), TOT=info.get('tot', ''))
+    return added
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Back-fill the curve-similarity library of a results folder')
+    parser.add_argument('root')
+    parser.add_argument('--library', help='folder of the library (default: <root>/similarity)')
+    args = parser.parse_args()
+    print(build(args.root, args.library), 'sweeps added to', args.library or default_path(args.root))
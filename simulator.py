@@ -0,0 +1,218 @@
+import re
+import time
+import numpy as np
+
+# models of the devices shared by the simulated instrument and the synthetic datasets
+
+def diode_voltage(current, vth = 0.8, k = 1e-7):
+    """
+    Voltage of a diode connected FET in saturation sourcing current: I = k*(V - Vth)^2.
+
+    Parameters:
+    - current (np.array): current [A].
+    - vth (float, optional): threshold voltage [V]. Default is 0.8.
+    - k (float, optional): transconductance factor [A/V^2]. Default is 1e-7.
+    """
+    return vth + np.sqrt(np.abs(current)/k)
+
+
+def transfer_current(vgs, vth = -0.3, k = 1e-4, vds = -0.5):
+    """
+    Drain current of a FET in saturation: Ids = k*(|Vgs| - |Vth|)^2 above threshold, with the sign of Vds.
+
+    Parameters:
+    - vgs (np.array): gate voltage [V].
+    - vth (float, optional): threshold voltage [V]. Default is -0.3.
+    - k (float, optional): transconductance factor [A/V^2]. Default is 1e-4.
+    - vds (float, optional): drain bias [V]. Default is -0.5.
+    """
+    overdrive = np.clip(np.abs(vgs) - abs(vth), 0, None)
+    return np.sign(vds or 1)*k*overdrive**2
+
+
+class SimulatedKeithley:
+    """
+    Stand-in for the pyvisa resource of the 4200-SCS that understands the KXCI commands used by
+    keithleyAPI (DE channel definitions, IR/VR sweeps, IC/VC constants, RT, NR, IN, ME, SP, DO) and
+    answers with synthetic device curves. DO responses are comma separated status+value tokens
+    terminated by a line feed, which is what keithleyAPI.parse_trace expects.
+
+    Each channel sourcing current behaves as a diode connected FET (simulator.diode_voltage), a
+    voltage swept gate drives the constant biased drains (simulator.transfer_current). The voltages
+    drift slowly from one measurement to the next, as a device stabilizing in solution.
+    """
+
+    def __init__(self, noise = 1e-4, drift = 2e-3, drift_sweeps = 10, point_time = 0.0, latency = 0.0, seed = 0, disconnected = (),
+                 compliance = 20.0):
+        """
+        Parameters:
+        - noise (float, optional): std of the voltage noise [V]. Default is 1e-4.
+        - drift (float, optional): total drift of the voltages [V], reached with time constant drift_sweeps. Default is 2e-3.
+        - drift_sweeps (float, optional): time constant of the drift in measurements. Default is 10.
+        - point_time (float, optional): seconds needed per measured point; SP answers 0 until the measurement is done. Default is 0.
+        - latency (float, optional): seconds added to every command (link latency). Default is 0.
+        - seed (int, optional): seed of the noise. Default is 0.
+        - disconnected (tuple, optional): numbers of the channels with no device: sourcing current, their voltage sits at the compliance with status C. Default is ().
+        - compliance (float, optional): voltage of the disconnected channels [V]. Default is 20.
+        """
+        self.noise = noise
+        self.drift = drift
+        self.drift_sweeps = drift_sweeps
+        self.point_time = point_time
+        self.latency = latency
+        self.timeout = None
+        self.write_termination = None
+        self.read_termination = None
+        self.send_end = None
+        self.closed = False
+        self.commands = [] # every command received, for inspection
+        self.disconnected = set(disconnected)
+        self.compliance = compliance
+        self._rng = np.random.default_rng(seed)
+        self._channels = {}
+        self._constants = {}
+        self._var1 = None
+        self._ratio = (1.0, 0.0)
+        self._readings = 1
+        self._interval = 0.0
+        self._traces = {}
+        self._status = {}
+        self._done_at = 0.0
+        self._measurements = 0
+
+    def close(self):
+        self.closed = True
+
+    def write(self, command):
+        self.query(command)
+
+    def read(self):
+        return "ACK"
+
+    def query(self, command):
+        if self.latency:
+            time.sleep(self.latency)
+        self.commands.append(command)
+        command = command.strip()
+
+        channel = re.match(r"CH(\d+)\s*,\s*'(\w*)'\s*,\s*'(\w*)'\s*,\s*(\d)\s*,\s*(\d)", command)
+        if channel:
+            number, vname, iname, mode, function = channel.groups()
+            self._channels[int(number)] = {'V': vname, 'I': iname, 'mode': int(mode), 'function': int(function)}
+            return "ACK"
+        sweep = re.match(r"([IV])R\d\s*,\s*([^,]+),\s*([^,]+),\s*([^,]+)", command)
+        if sweep:
+            kind, start, stop, step = sweep.groups()
+            start, stop, step = float(start), float(stop), float(step)
+            self._var1 = (kind, start + step*np.arange(int(round((stop - start)/step)) + 1))
+            return "ACK"
+        constant = re.match(r"([IV])C(\d+)\s*,\s*([^,]+)", command)
+        if constant:
+            kind, number, value = constant.groups()
+            self._constants[int(number)] = (kind, float(value))
+            return "ACK"
+        if command.startswith("RT"):
+            self._ratio = tuple(float(value) for value in command[2:].split(','))
+            return "ACK"
+        if command.startswith("IN"):
+            self._interval = float(command[2:])
+            return "ACK"
+        if command.startswith("NR"):
+            self._readings = int(command[2:])
+            return "ACK"
+        if command.startswith("ME"):
+            self._measure()
+            return "ACK"
+        if command == "SP":
+            return "1" if time.perf_counter() >= self._done_at else "0"
+        if command.startswith("DO"):
+            name = command[2:].strip().strip("'")
+            status = self._status.get(name) or "N"*len(self._traces[name])
+            return ",".join("%s%+.6E" % item for item in zip(status, self._traces[name])) + "\n"
+        if command == "BC":
+            self._traces, self._status = {}, {}
+        return "ACK"
+
+    def _measure(self):
+        swept = [n for n, channel in self._channels.items() if channel['function'] in (1, 4)]
+        n_points = len(self._var1[1]) if swept and self._var1 is not None else self._readings
+        drift = self.drift*(1 - np.exp(-self._measurements/self.drift_sweeps))
+        self._measurements += 1
+        voltages, currents = {}, {}
+
+        for number, channel in self._channels.items():
+            function = channel['function']
+            if function == 1:
+                values = self._var1[1]
+            elif function == 4:
+                values = self._var1[1]*self._ratio[0] + self._ratio[1]
+            elif function == 3 and number in self._constants:
+                values = np.full(n_points, self._constants[number][1])
+            else:
+                values = np.zeros(n_points)
+            if channel['mode'] == 2 and number in self.disconnected: # open circuit: the voltage goes to compliance
+                currents[number] = values
+                voltages[number] = np.full(n_points, self.compliance)
+            elif channel['mode'] == 2: # current source: diode connected FET
+                currents[number] = values
+                voltages[number] = diode_voltage(values, vth = 0.8 + 0.05*number) + drift*(1 + 0.1*number)
+                voltages[number] = voltages[number] + self._rng.normal(0, self.noise, n_points)
+            elif channel['mode'] == 1: # voltage source
+                voltages[number] = values
+            else: # common
+                voltages[number] = np.zeros(n_points)
+
+        gates = [n for n in voltages if self._channels[n]['mode'] == 1 and self._channels[n]['function'] == 1]
+        for number, channel in self._channels.items():
+            if number in currents or channel['mode'] == 3:
+                continue
+            if number in gates:
+                currents[number] = 1e-11*voltages[number]
+            elif gates and np.any(voltages[number]):
+                currents[number] = transfer_current(voltages[gates[0]] + drift, vds = voltages[number][0])
+                currents[number] = currents[number]*(1 + self._rng.normal(0, self.noise, n_points))
+        for number, channel in self._channels.items():
+            if number not in currents:
+                currents[number] = -sum(currents.values()) if currents else np.zeros(n_points)
+
+        self._traces, self._status = {}, {}
+        for number, channel in self._channels.items():
+            self._traces[channel['V']] = voltages[number]
+            self._traces[channel['I']] = currents[number]
+            letter = "C" if number in self.disconnected and channel['mode'] == 2 else "N"
+            self._status[channel['V']] = self._status[channel['I']] = letter*n_points
+        point_time = self.point_time if swept else max(self.point_time, self._interval) # sampling mode: one reading per interval
+        self._done_at = time.perf_counter() + point_time*n_points
+
+
+class SimulatedResourceManager:
+    """
+    Stand-in for pyvisa's ResourceManager opening SimulatedKeithley instruments.
+    Usage: Communications("SIM::4200", resource_manager = SimulatedResourceManager())
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Parameters:
+        - kwargs: passed to SimulatedKeithley.
+        """
+        self._kwargs = kwargs
+        self.instruments = []
+
+    def open_resource(self, resource_string):
+        instrument = SimulatedKeithley(**self._kwargs)
+        self.instruments.append(instrument)
+        return instrument
+
+
+def simulated_smu(**kwargs):
+    """
+    Return a connected keithleyAPI.Communications talking to a SimulatedKeithley.
+
+    Parameters:
+    - kwargs: passed to SimulatedKeithley.
+    """
+    from keithleyAPI import Communications
+    smu = Communications("SIM::4200", resource_manager = SimulatedResourceManager(**kwargs))
+    smu.connect()
+    return smu
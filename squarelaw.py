@@ -0,0 +1,201 @@
+"""
+Batched square-law fit of the saturation regime: sqrt(|Ids|) = slope*(Vgs - Vth), i.e. Ids = k/2*(Vgs - Vth)^2
+with k = 2*slope^2 = mobility*Cox*W/L. The diode connected sweeps are in saturation by construction
+(Vds = Vgs), so the same model fits VDL/IDL and VDR/IDR.
+
+All the curves are fitted at once: they are stacked in a (curves x points) array padded with NaN, the
+fit window of every curve is a mask (points with sqrt(|Ids|) between window[0] and window[1] of its
+maximum, i.e. above threshold and below the mobility degradation at the top), and the masked least
+squares, R^2 and residuals are computed with a few reductions along the points, with no loop over the
+curves. Unlike utils.calculate_vth (tangent at the max derivative) and utils.calculate_vth_secondder
+(argmax of the second derivative), the fit gives the slope (mobility factor) and its quality, and flags the
+curves it can't be trusted on.
+
+Usage:
+    table = squarelaw.fit_square_law(vgs, ids)          # 2D arrays, one row per curve (or a shared 1D vgs)
+    table = squarelaw.fit_sweeps([df1, df2, ...])       # VgsIds and diode connection sweeps
+    table = squarelaw.fit_folder('results/')            # all the workbooks under a folder
+"""
+import glob
+import os
+import numpy as np
+import pandas as pd
+from features import LEFT, RIGHT, SHEET_PREFIX, split_sweeps
+
+# flags of the fit of a curve (bit values)
+FIT_FEW_POINTS = 1
+FIT_LOW_R2 = 2
+FIT_NO_SLOPE = 4
+FIT_VTH_OUTSIDE = 8
+FIT_OUTLIER = 16
+FLAGS = {FIT_FEW_POINTS: 'few points', FIT_LOW_R2: 'low R2', FIT_NO_SLOPE: 'no slope',
+         FIT_VTH_OUTSIDE: 'Vth outside the sweep', FIT_OUTLIER: 'outlier'}
+
+# voltage and current columns of the sweeps: side -> (voltage names, current names)
+CURVES = {'': (('Vgs',), ('Ids',)), 'L': (LEFT, ('IDL', 'DrainI')), 'R': (RIGHT, ('IDR', 'DrainI'))}
+
+
+def stack_curves(curves):
+    """
+    Stack curves of different lengths in 2D arrays padded with NaN.
+
+    Parameters:
+    - curves (list): list of (x, y) arrays.
+
+    Returns:
+    - x, y (np.array): 2D arrays (curves x longest curve).
+    """
+    size = max((len(x) for x, _ in curves), default=0)
+    x_stack = np.full((len(curves), size), np.nan)
+    y_stack = np.full((len(curves), size), np.nan)
+    for i, (x, y) in enumerate(curves):
+        x_stack[i, :len(x)] = x
+        y_stack[i, :len(y)] = y
+    return x_stack, y_stack
+
+
+def fit_square_law(vgs, ids, window = (0.2, 0.9), min_points = 5, r2_min = 0.98, outlier = 4.0):
+    """
+    Fit sqrt(|Ids|) = slope*(Vgs - Vth) to a batch of curves.
+
+    Parameters:
+    - vgs (np.array): gate (diode: drain) voltages, 2D (curves x points) or 1D shared by all the curves. NaN points are ignored.
+    - ids (np.array): drain currents, 2D (curves x points) or 1D for a single curve.
+    - window (tuple, optional): fit window as fractions of the max sqrt(|Ids|) of each curve. Default is (0.2, 0.9).
+    - min_points (int, optional): minimum points in the window. Default is 5.
+    - r2_min (float, optional): R^2 below which FIT_LOW_R2 is set. Default is 0.98.
+    - outlier (float, optional): max |residual| (in rms of the residuals) above which FIT_OUTLIER is set. Default is 4.
+
+    Returns:
+    - fit (pd.DataFrame): one row per curve with 'vth' [V], 'slope' [sqrt(A)/V], 'k' (2*slope^2 = mobility*Cox*W/L) [A/V^2],
+      'r2', 'rms' (rms of the residuals) [sqrt(A)], 'points' (points in the window) and 'flags' (FIT_* bits).
+    """
+    ids = np.atleast_2d(np.asarray(ids, dtype=float))
+    vgs = np.broadcast_to(np.asarray(vgs, dtype=float), ids.shape)
+    root = np.sqrt(np.abs(ids))
+    finite = np.isfinite(vgs) & np.isfinite(root)
+    peak = np.max(np.where(finite, root, -np.inf), axis=1, initial=-np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = root/peak[:, None]
+        mask = finite & (ratio >= window[0]) & (ratio <= window[1])
+        points = mask.sum(axis=1)
+        mean_x = np.where(mask, vgs, 0).sum(axis=1)/points
+        mean_y = np.where(mask, root, 0).sum(axis=1)/points
+        # centered sums: better conditioned than the raw normal equations
+        dx = np.where(mask, vgs - mean_x[:, None], 0)
+        dy = np.where(mask, root - mean_y[:, None], 0)
+        sxx = np.einsum('ij,ij->i', dx, dx)
+        sxy = np.einsum('ij,ij->i', dx, dy)
+        syy = np.einsum('ij,ij->i', dy, dy)
+        slope = sxy/sxx
+        vth = mean_x - mean_y/slope
+        residuals = dy - slope[:, None]*dx
+        ss_res = np.einsum('ij,ij->i', residuals, residuals)
+        r2 = 1 - ss_res/syy
+        rms = np.sqrt(ss_res/points)
+        max_residual = np.max(np.abs(residuals), axis=1, initial=0)
+        low = np.min(np.where(finite, vgs, np.inf), axis=1, initial=np.inf)
+        high = np.max(np.where(finite, vgs, -np.inf), axis=1, initial=-np.inf)
+
+    flags = np.zeros(len(ids), dtype=np.uint8)
+    few = points < max(min_points, 2)
+    flags[few] |= FIT_FEW_POINTS
+    flags[~few & ~(r2 >= r2_min)] |= FIT_LOW_R2
+    flags[~few & ~(np.isfinite(slope) & (slope != 0))] |= FIT_NO_SLOPE
+    flags[~few & ~((vth >= low) & (vth <= high))] |= FIT_VTH_OUTSIDE
+    flags[~few & (max_residual > outlier*rms)] |= FIT_OUTLIER
+    for values in (slope, vth, r2, rms):
+        values[few] = np.nan
+    return pd.DataFrame({'vth': vth, 'slope': slope, 'k': 2*slope**2, 'r2': r2, 'rms': rms, 'points': points, 'flags': flags})
+
+
+def describe(flags):
+    """
+    Return the names of the FIT_* bits set in flags.
+    """
+    return [name for bit, name in FLAGS.items() if flags & bit]
+
+
+def mobility(k, W, L, Cox):
+    """
+    Mobility from the fitted k = mobility*Cox*W/L.
+
+    Parameters:
+    - k (float or np.array): k of the fit [A/V^2].
+    - W, L (float): channel width and length (same unit).
+    - Cox (float): gate capacitance per unit area [F/cm^2] (mobility in cm^2/Vs).
+    """
+    return np.asarray(k)*L/(W*Cox)
+
+
+def _column(df, names):
+    for name in names:
+        if name in df.columns:
+            return name
+    return None
+
+
+def sweep_curves(df):
+    """
+    Return the curves of a sweep that can be fitted: [(side, voltage, current)], side '' for a VgsIds sweep and
+    'L'/'R' for the two FETs of a diode connection sweep.
+    """
+    curves = []
+    for side, (voltages, currents) in CURVES.items():
+        voltage, current = _column(df, voltages), _column(df, currents)
+        if voltage and current:
+            curves.append((side, df[voltage].to_numpy(dtype=float), df[current].to_numpy(dtype=float)))
+    return curves
+
+
+def fit_sweeps(sweeps, **kwargs):
+    """
+    Fit all the curves of a list of sweeps in one batch.
+
+    Parameters:
+    - sweeps (list or dict): sweeps (VgsIds or diode connection DataFrames), e.g. the diode_df list of stability_test.
+    - kwargs: passed to fit_square_law (window, min_points, r2_min, outlier).
+
+    Returns:
+    - fit (pd.DataFrame): one row per curve with 'sweep' (position or key of the sweep), 'side' and the fit.
+    """
+    items = sweeps.items() if isinstance(sweeps, dict) else enumerate(sweeps)
+    keys, sides, curves = [], [], []
+    for key, df in items:
+        for side, voltage, current in sweep_curves(df):
+            keys.append(key)
+            sides.append(side)
+            curves.append((voltage, current))
+    fit = fit_square_law(*stack_curves(curves), **kwargs)
+    fit.insert(0, 'sweep', keys)
+    fit.insert(1, 'side', sides)
+    return fit
+
+
+def fit_folder(root, pattern = '*.xlsx', **kwargs):
+    """
+    Fit the curves of all the workbooks under root (recursively) in one batch.
+
+    Parameters:
+    - root (str): folder to scan.
+    - pattern (str, optional): file name pattern of the workbooks. Default is '*.xlsx'.
+    - kwargs: passed to fit_square_law.
+
+    Returns:
+    - fit (pd.DataFrame): one row per curve with 'folder', 'file', 'sheet', 'step' (sweep number in the sheet), 'side' and the fit.
+    """
+    sweeps, rows = [], []
+    for workbook in sorted(glob.glob(os.path.join(root, '**', pattern), recursive=True)):
+        if os.path.basename(workbook).startswith(('~$', '.')):
+            continue
+        for name, df in pd.read_excel(workbook, sheet_name=None, index_col=0).items():
+            sheet = name[len(SHEET_PREFIX):] if name.startswith(SHEET_PREFIX) else name
+            for step, sweep in enumerate(split_sweeps(df)):
+                sweeps.append(sweep)
+                rows.append({'folder': os.path.basename(os.path.dirname(workbook)), 'file': os.path.basename(workbook),
+                             'sheet': sheet, 'step': step})
+    if not sweeps:
+        return pd.DataFrame()
+    fit = fit_sweeps(sweeps, **kwargs)
+    info = pd.DataFrame(rows).iloc[fit['sweep'].to_numpy()].reset_index(drop=True)
+    return pd.concat([info, fit.drop(columns='sweep')], axis=1)
@@ -0,0 +1,151 @@
+import numpy as np
+
+class SweepGrid:
+    """
+    Canonical x-array of a sweep (Vgs or drain current) together with the range masks
+    and index lookups computed on it. Masks and lookups are computed once and cached.
+
+    A grid is defined either by start/stop/step (instrument sweeps, e.g. IR1 or VR ramps)
+    or by start/stop/num (np.linspace grids used in the notebooks).
+    """
+
+    def __init__(self, grid_id, start, stop, step = None, num = None):
+        self.grid_id = grid_id
+        self.start = start
+        self.stop = stop
+        if step is not None:
+            self.step = step
+            self.x = start + step*np.arange(int(round((stop - start)/step)) + 1)
+        else:
+            self.x = np.linspace(start, stop, num)
+            self.step = self.x[1] - self.x[0] if num > 1 else 0.0
+        self.x.flags.writeable = False
+        self._masks = {}
+        self._slices = {}
+
+    def __len__(self):
+        return len(self.x)
+
+    def __repr__(self):
+        return "SweepGrid(%r, start=%g, stop=%g, step=%g, n=%d)" % (self.grid_id, self.start, self.stop, self.step, len(self.x))
+
+    def mask(self, low, high):
+        """
+        Boolean mask of the grid points with low <= x <= high (cached).
+        """
+        key = (float(low), float(high))
+        if key not in self._masks:
+            tol = 1e-9*abs(self.step) if self.step else 0.0
+            mask = (self.x >= low - tol) & (self.x <= high + tol)
+            mask.flags.writeable = False
+            self._masks[key] = mask
+        return self._masks[key]
+
+    def range_slice(self, low, high):
+        """
+        Slice of the grid points with low <= x <= high (cached). Since the grid is monotonic the
+        range is contiguous, so the slice can be used to take views instead of boolean copies.
+        """
+        key = (float(low), float(high))
+        if key not in self._slices:
+            index = np.flatnonzero(self.mask(low, high))
+            self._slices[key] = slice(index[0], index[-1] + 1) if len(index) else slice(0, 0)
+        return self._slices[key]
+
+    def index_of(self, value, tol = None):
+        """
+        Index of the grid point nearest to value.
+        Raises ValueError if the nearest point is further than tol (default: half the grid step).
+        """
+        if self.step:
+            index = int(round((value - self.start)/self.step))
+            index = min(max(index, 0), len(self.x) - 1)
+        else:
+            index = 0
+        if tol is None:
+            tol = 0.5*abs(self.step)
+        if abs(self.x[index] - value) > tol:
+            raise ValueError("Value "+str(value)+" is not on grid "+str(self.grid_id))
+        return index
+
+    def last_indices(self, n):
+        """
+        Indices of the last n points of the grid (the ones used by utils.calculate_mean_std).
+        """
+        return np.arange(len(self.x) - n, len(self.x))
+
+
+class SweepGridRegistry:
+    """
+    Registry of the sweep grids, keyed by the sweep parameters. Sweeps acquired with the same
+    start/stop/step share the same SweepGrid and only carry its ID (see DataFrame.attrs['grid_id']).
+    """
+
+    def __init__(self):
+        self._grids = {}
+        self._ids = {}
+
+    def __len__(self):
+        return len(self._grids)
+
+    def __contains__(self, grid_id):
+        return grid_id in self._grids
+
+    def register(self, start, stop, step = None, num = None):
+        """
+        Return the ID of the grid with the given parameters, creating it if needed.
+
+        Parameters:
+        - start, stop (str or float): first and last value of the sweep. Strings are accepted as passed to the Keithley API (e.g. '300E-09').
+        - step (str or float, optional): step of the sweep.
+        - num (int, optional): number of points (np.linspace grid), used when step is None.
+
+        Returns:
+        - grid_id (str): ID of the grid.
+        """
+        if (step is None) == (num is None):
+            raise ValueError("Exactly one of step and num must be given")
+        start, stop = float(start), float(stop)
+        if step is not None:
+            step = float(step)
+            key = ('step', start, stop, step)
+        else:
+            num = int(num)
+            key = ('num', start, stop, num)
+        if key not in self._ids:
+            if step is not None:
+                grid_id = "%g:%g:%g" % (start, stop, step)
+            else:
+                grid_id = "%g:%g#%d" % (start, stop, num)
+            self._ids[key] = grid_id
+            self._grids[grid_id] = SweepGrid(grid_id, start, stop, step, num)
+        return self._ids[key]
+
+    def get(self, grid_id):
+        """
+        Return the SweepGrid with the given ID.
+        """
+        return self._grids[grid_id]
+
+    def grid(self, start, stop, step = None, num = None):
+        """
+        Return the SweepGrid with the given parameters, creating it if needed.
+        """
+        return self._grids[self.register(start, stop, step, num)]
+
+    def of(self, df):
+        """
+        Return the SweepGrid referenced by a sweep DataFrame (DataFrame.attrs['grid_id']).
+        """
+        return self._grids[df.attrs['grid_id']]
+
+
+# registry shared by the acquisition and the post-processing code
+registry = SweepGridRegistry()
+
+
+def get_grid(start, stop, step = None, num = None):
+    """
+    Return the shared SweepGrid with the given parameters (see SweepGridRegistry.grid).
+    """
+    return registry.grid(start, stop, step, num)
@@ -0,0 +1,110 @@
+"""
+Status of the readings of the 4200-SCS. Every value returned by DO is prefixed by a status letter:
+
+    N  normal reading
+    L  interval too short (sampling mode)
+    V  overflow reading
+    X  oscillation
+    C  this channel in compliance
+    T  other channel in compliance
+
+keithleyAPI decodes the letters into one byte of flags per point (bit values below) and stores them with
+the sweep in DataFrame.attrs['status'] ({column: bytes}). The validators work on those bytes and on the
+values with a few NumPy reductions, so a sweep can be checked (and rejected or measured again) as soon as
+it is acquired.
+"""
+import numpy as np
+
+NORMAL = 0
+INTERVAL_SHORT = 1
+OVERFLOW = 2
+OSCILLATION = 4
+COMPLIANCE = 8
+OTHER_COMPLIANCE = 16
+UNKNOWN = 128
+
+LETTERS = {'N': NORMAL, 'L': INTERVAL_SHORT, 'V': OVERFLOW, 'X': OSCILLATION, 'C': COMPLIANCE, 'T': OTHER_COMPLIANCE}
+
+# problems found by check()
+PROBLEM_COMPLIANCE = 1
+PROBLEM_OVERFLOW = 2
+PROBLEM_DISCONNECTED = 4
+PROBLEM_OSCILLATION = 8
+PROBLEMS = {PROBLEM_COMPLIANCE: 'compliance', PROBLEM_OVERFLOW: 'overflow', PROBLEM_DISCONNECTED: 'disconnected',
+            PROBLEM_OSCILLATION: 'oscillation'}
+
+_LOOKUP = np.full(256, UNKNOWN, dtype=np.uint8)
+for _letter, _flag in LETTERS.items():
+    _LOOKUP[ord(_letter)] = _flag
+
+
+def decode(letters):
+    """
+    Decode the status letters of a trace.
+
+    Parameters:
+    - letters (str or bytes): one status letter per point.
+
+    Returns:
+    - flags (bytes): one byte of flags per point.
+    """
+    if isinstance(letters, str):
+        letters = letters.encode('ascii', 'replace')
+    return _LOOKUP[np.frombuffer(letters, dtype=np.uint8)].tobytes()
+
+
+def flags(df, columns = None):
+    """
+    Return the flags of a sweep as an array (one uint8 per point), OR-ed over the columns.
+
+    Parameters:
+    - df (pd.DataFrame): sweep returned by keithleyAPI (DataFrame.attrs['status']).
+    - columns (list, optional): columns to consider. Default is all the columns with a status.
+
+    Returns:
+    - flags (np.array): uint8 flags per point; zeros if the sweep has no status (e.g. loaded from a workbook).
+    """
+    status = df.attrs.get('status', {})
+    columns = [column for column in (columns or status) if column in status]
+    if not columns:
+        return np.zeros(len(df), dtype=np.uint8)
+    return np.bitwise_or.reduce([np.frombuffer(status[column], dtype=np.uint8) for column in columns])
+
+
+def check(df, columns = None, limit = 20.0, rtol = 1e-3):
+    """
+    Check a sweep for compliance hits, overflow, oscillation and disconnection.
+
+    A disconnected device shows up as a reading at the compliance limit (the sentinel value 20 of the
+    diode connection sweeps), so a value with |value| >= limit*(1-rtol) counts as disconnection, also for
+    the sweeps without status (loaded from a workbook).
+
+    Parameters:
+    - df (pd.DataFrame): sweep.
+    - columns (list, optional): columns to check. Default is all the columns.
+    - limit (float, optional): compliance limit / sentinel value. Default is 20.
+    - rtol (float, optional): relative tolerance on limit. Default is 1e-3.
+
+    Returns:
+    - problems (int): OR of the PROBLEM_* bits found (0 if the sweep is good).
+    """
+    columns = list(columns) if columns is not None else list(df.columns)
+    values = df[columns].to_numpy(dtype=float)
+    point_flags = flags(df, columns)
+    problems = 0
+    if np.any(point_flags & (COMPLIANCE | OTHER_COMPLIANCE)):
+        problems |= PROBLEM_COMPLIANCE
+    if np.any(point_flags & OVERFLOW) or not np.isfinite(values).all():
+        problems |= PROBLEM_OVERFLOW
+    if np.any(point_flags & OSCILLATION):
+        problems |= PROBLEM_OSCILLATION
+    if np.any(np.abs(values) >= limit*(1 - rtol)):
+        problems |= PROBLEM_DISCONNECTED
+    return problems
+
+
+def describe(problems):
+    """
+    Return the names of the PROBLEM_* bits set in problems.
+    """
+    return [name for bit, name in PROBLEMS.items() if problems & bit]
@@ -0,0 +1,215 @@
+"""
+Synthetic datasets for load-testing the post-processing (loaders, stats, Vth and feature engines).
+The files are written in the same formats as the real acquisitions:
+
+- diode connection sensing tests: save_xls mode 1 workbooks, one "step #<conc>" sheet with the
+  n_sweeps sweeps (VDL, VDR, IDL, IDR, DIFFV) of each concentration, as tests_.sensing_test saves them
+- diode connection strain/temperature tests: save_xls mode 2 workbooks, one "step #<i>" sheet per sweep,
+  as tests_.stability_test saves them
+- VgsIds tests: save_xls mode 2 workbooks with Ids, Igs, Vgs, Vds sheets
+- PCB captures: iSENS .txt files (time, DAC, Ch1, Ch2 lines)
+
+Folders follow utils.create_folder (mmddyyyy-device-TOT), so the notebooks and utils loaders work on them.
+
+Usage:
+    manifest = synthetic.generate('synthetic_data', n_devices = 500, temperatures = [25, 40])
+"""
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import simulator
+import utils
+from catalog import concentration_value
+
+
+def diode_sweeps(n_sweeps, current, vth_L, vth_R, shift = 0.0, drift = 2e-3, noise = 1e-4, rng = None, sweep_offset = 0):
+    """
+    List of diode connection sweeps (VDL, VDR, IDL, IDR DataFrames, as keithleyAPI.diode_connection returns).
+
+    Parameters:
+    - n_sweeps (int): number of sweeps.
+    - current (np.array): sourced current of each point [A].
+    - vth_L, vth_R (float): threshold voltages of the left and right FET [V].
+    - shift (float, optional): response added to the left FET (e.g. concentration) [V]. Default is 0.
+    - drift (float, optional): drift reached after ~10 sweeps [V]. Default is 2e-3.
+    - noise (float, optional): std of the voltage noise [V]. Default is 1e-4.
+    - rng (Generator, optional): numpy random generator.
+    - sweep_offset (int, optional): sweeps already performed on the device (the drift continues from there). Default is 0.
+    """
+    rng = rng or np.random.default_rng()
+    n_points = len(current)
+    sweeps = []
+    for i in range(n_sweeps):
+        d = drift*(1 - np.exp(-(sweep_offset + i)/10))
+        sweeps.append(pd.DataFrame({
+            'VDL': simulator.diode_voltage(current, vth_L) + shift + d + rng.normal(0, noise, n_points),
+            'VDR': simulator.diode_voltage(current, vth_R) + 0.8*d + rng.normal(0, noise, n_points),
+            'IDL': current, 'IDR': current}))
+    return sweeps
+
+
+def vgsids_sweeps(n_sweeps, vgs, vth, vds = -0.5, drift = 2e-3, noise = 1e-2, rng = None):
+    """
+    List of VgsIds sweeps (Ids, Igs, Vgs, Vds DataFrames, as keithleyAPI.VgsIds returns).
+    noise is relative to Ids.
+    """
+    rng = rng or np.random.default_rng()
+    sweeps = []
+    for i in range(n_sweeps):
+        d = drift*(1 - np.exp(-i/10))
+        ids = simulator.transfer_current(vgs, vth - d, vds = vds)
+        sweeps.append(pd.DataFrame({'Ids': ids*(1 + rng.normal(0, noise, len(vgs))),
+                                    'Igs': 1e-11*vgs + rng.normal(0, 1e-12, len(vgs)),
+                                    'Vgs': vgs, 'Vds': np.full(len(vgs), vds)}))
+    return sweeps
+
+
+def isens_capture(n_frames, frame_length = 282, vth = 0.9, pcb_range = (10e-9, 500e-9), noise = 2e-3, start = None, rng = None):
+    """
+    Synthetic iSENS capture: a DAC ramp of frame_length samples repeated n_frames times.
+
+    Returns:
+    - data (DataFrame): 'time' (s), 'DAC', 'Ch1', 'Ch2' (V) columns, as utils.read_isens_txt returns them.
+    """
+    rng = rng or np.random.default_rng()
+    current = np.tile(np.linspace(pcb_range[0], pcb_range[1], frame_length), n_frames)
+    n = len(current)
+    return pd.DataFrame({'time': np.arange(n)*0.01 + (start or 0.0),
+                         'DAC': np.tile(np.arange(frame_length), n_frames),
+                         'Ch1': simulator.diode_voltage(current, vth) + rng.normal(0, noise, n),
+                         'Ch2': simulator.diode_voltage(current, vth + 0.05) + rng.normal(0, noise, n)})
+
+
+def write_isens_txt(path, data, scale = 100):
+    """
+    Write a capture in the iSENS txt format (one comma separated line per column), readable by utils.read_isens_txt.
+    """
+    with open(path, 'w') as f:
+        f.write(','.join('%.3f' % value for value in data['time'])+'\n')
+        f.write(','.join('%d' % value for value in data['DAC'])+'\n')
+        for column in ['Ch1', 'Ch2']:
+            f.write(','.join('%d' % value for value in np.round(data[column]*scale))+'\n')
+
+
+def _folder(root, date, device, tot):
+    directory = date.strftime('%m%d%Y')+'-'+device+'-'+tot
+    os.makedirs(os.path.join(root, directory), exist_ok=True)
+    return directory
+
+
+def generate(root, n_devices = 10, couples = ('r1c1',), concentrations = ('baseline','1pM','10pM','100pM','1nM'),
+             strains = (), temperatures = (), n_sweeps = 20, current_stop = 300e-9, current_step = 5e-9,
+             vgs = (0, -1, -0.01), vgsids = False, pcb_frames = 0, sensitivity = 0.01, drift = 2e-3, noise = 1e-4,
+             device_spread = 0.05, start_date = None, seed = 0):
+    """
+    Write a synthetic dataset.
+
+    Parameters:
+    - root (str): folder where the dataset is written.
+    - n_devices (int, optional): number of devices. Default is 10.
+    - couples (list, optional): FET couples of each device. Default is ('r1c1',).
+    - concentrations (list, optional): concentrations of the sensing tests (one workbook per device and couple). Empty to skip.
+    - strains (list, optional): strains [%] of the strain tests (one workbook per device, couple and strain).
+    - temperatures (list, optional): temperatures [C] of the temperature tests (one workbook per device, couple and temperature).
+    - n_sweeps (int, optional): sweeps per concentration/set-point. Default is 20.
+    - current_stop, current_step (float, optional): diode connection sweep (from 0) [A]. Default is 300e-9, 5e-9.
+    - vgs (tuple, optional): start, stop, step of the VgsIds sweeps [V]. Default is (0, -1, -0.01).
+    - vgsids (bool, optional): also write a VgsIds workbook per device and temperature (or one per device). Default is False.
+    - pcb_frames (int, optional): frames of the iSENS capture written per device (0 to skip). Default is 0.
+    - sensitivity (float, optional): response per decade of concentration [V]. Default is 0.01.
+    - drift (float, optional): drift of the sweeps [V]. Default is 2e-3.
+    - noise (float, optional): std of the voltage noise [V]. Default is 1e-4.
+    - device_spread (float, optional): std of the threshold voltage between devices [V]. Default is 0.05.
+    - start_date (datetime, optional): date of the first device; each device is measured one day later. Default is now.
+    - seed (int, optional): seed of the random generator. Default is 0.
+
+    Returns:
+    - manifest (DataFrame): one row per written file with 'path', 'kind', 'device', 'couple', 'setpoint', 'sweeps'.
+    """
+    rng = np.random.default_rng(seed)
+    start_date = start_date or datetime.now()
+    os.makedirs(root, exist_ok=True)
+    current = np.arange(0, current_stop + current_step/2, current_step)
+    vgs_grid = np.arange(vgs[0], vgs[1] + vgs[2]/2, vgs[2])
+    manifest = []
+
+    def add(path, kind, device, couple, setpoint, sweeps):
+        manifest.append({'path': path, 'kind': kind, 'device': device, 'couple': couple,
+                         'setpoint': setpoint, 'sweeps': sweeps})
+
+    for d in range(n_devices):
+        device = 'd%04d' % d
+        date = start_date + timedelta(days=d)
+        for couple in couples:
+            vth_L, vth_R = 0.85 + rng.normal(0, device_spread, 2)
+
+            if concentrations:
+                tot = 'DiodeConnected_SensingTest'
+                directory = _folder(root, date, device, tot)
+                values = np.array([concentration_value(c) for c in concentrations])
+                reference = values[values > 0].min() if np.any(values > 0) else 1.0
+                data = {}
+                for i, (conc, value) in enumerate(zip(concentrations, values)):
+                    shift = sensitivity*(np.log10(value/reference) + 1) if value > 0 else 0.0
+                    sweeps = diode_sweeps(n_sweeps, current, vth_L, vth_R, shift, drift, noise, rng, i*n_sweeps)
+                    data_save = pd.concat(sweeps)
+                    data_save['DIFFV'] = abs(data_save['VDL'] - data_save['VDR'])
+                    data[conc] = data_save
+                path = os.path.join(root, directory, directory+couple+concentrations[-1]+'.xlsx')
+                utils.write_workbook(path, data, mode = 1)
+                add(path, 'sensing', device, couple, ','.join(concentrations), n_sweeps*len(concentrations))
+
+            for kind, setpoints, unit, coefficient in [('strain', strains, '%', 0.02), ('temperature', temperatures, 'C', -2e-3)]:
+                for setpoint in setpoints:
+                    tot = 'DiodeConnected_'+kind.capitalize()+'-'+str(setpoint)+unit
+                    directory = _folder(root, date, device, tot)
+                    sweeps = diode_sweeps(n_sweeps, current, vth_L + coefficient*setpoint, vth_R + coefficient*setpoint,
+                                          0.0, drift, noise, rng)
+                    path = os.path.join(root, directory, directory+couple+'.xlsx')
+                    utils.write_workbook(path, sweeps, mode = 2)
+                    add(path, kind, device, couple, setpoint, n_sweeps)
+
+        if vgsids:
+            for temperature in (temperatures or [None]):
+                tot = 'VgsIds' + ('-'+str(temperature)+'C' if temperature is not None else '')
+                directory = _folder(root, date, device, tot)
+                vth = -0.3 + rng.normal(0, device_spread) + (-2e-3*temperature if temperature is not None else 0)
+                sweeps = vgsids_sweeps(n_sweeps, vgs_grid, vth, drift = drift, rng = rng)
+                path = os.path.join(root, directory, directory+'.xlsx')
+                utils.write_workbook(path, sweeps, mode = 2)
+                add(path, 'vgsids', device, None, temperature, n_sweeps)
+
+        if pcb_frames:
+            pcb = os.path.join(root, 'PCB')
+            os.makedirs(pcb, exist_ok=True)
+            path = os.path.join(pcb, 'iSENS_%d_%d_%d_%d_%d_%d-%s.txt' % (date.year, date.month, date.day, date.hour, date.minute, date.second, device))
+            write_isens_txt(path, isens_capture(pcb_frames, vth = 0.85 + rng.normal(0, device_spread), rng = rng))
+            add(path, 'pcb', device, None, None, pcb_frames)
+
+    return pd.DataFrame(manifest)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Write a synthetic dataset for load tests')
+    parser.add_argument('root')
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--couples', nargs='*', default=['r1c1'])
+    parser.add_argument('--concentrations', nargs='*', default=['baseline','1pM','10pM','100pM','1nM'])
+    parser.add_argument('--strains', nargs='*', type=float, default=[])
+    parser.add_argument('--temperatures', nargs='*', type=float, default=[])
+    parser.add_argument('--sweeps', type=int, default=20)
+    parser.add_argument('--vgsids', action='store_true')
+    parser.add_argument('--pcb-frames', type=int, default=0)
+    parser.add_argument('--drift', type=float, default=2e-3)
+    parser.add_argument('--noise', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    manifest = generate(args.root, args.devices, args.couples, args.concentrations, args.strains, args.temperatures,
+                        args.sweeps, vgsids = args.vgsids, pcb_frames = args.pcb_frames, drift = args.drift,
+                        noise = args.noise, seed = args.seed)
+    manifest.to_csv(os.path.join(args.root, 'manifest.csv'), index=False)
+    print(len(manifest), 'files,', manifest['sweeps'].sum(), 'sweeps written in', args.root)
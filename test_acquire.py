@@ -0,0 +1,32 @@
+import builtins
+
+import pytest
+
+import acquire
+
+
+def _spec(tmp_path, **sensing):
+    sensing = dict({'TOT': 'DiodeConnected_SensingTest-Na', 'concentrations': ['10mM', '20mM'], 'runs': 2}, **sensing)
+    return {'DUT': 'd1', 'couple': 'r1c1', 'channels': {'left': 'CH1', 'right': 'CH3', 'common': 'CH2'},
+            'resting_time': 0, 'output': str(tmp_path/'results'), 'sensing': sensing}
+
+
+@pytest.mark.parametrize('between', [0, 1.5, '2', None])
+def test_check_spec_unattended(tmp_path, between):
+    acquire.check_spec(_spec(tmp_path, between=between), interactive=False)
+
+
+def test_prompt_needs_a_terminal(tmp_path):
+    spec = _spec(tmp_path, between='prompt')
+    acquire.check_spec(spec, interactive=True)
+    with pytest.raises(ValueError):
+        acquire.run_spec(spec, simulate=True, interactive=False)
+    assert not (tmp_path/'results').exists() # rejected before the run starts
+
+
+def test_unattended_run_does_not_prompt(tmp_path, monkeypatch):
+    def no_input(*args):
+        raise AssertionError('input() called')
+    monkeypatch.setattr(builtins, 'input', no_input)
+    state = acquire.run_spec(_spec(tmp_path), simulate=True, interactive=False)
+    assert state['k'] == 2
@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+
+import catalog
+
+
+def _touch(path, mtime = None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('x')
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_couple_of():
+    assert catalog.couple_of('r1c11nM', ['baseline', '1nM']) == 'r1c1'
+    assert catalog.couple_of('r1c110nM', ['1nM', '10nM']) == 'r1c1'
+    assert catalog.couple_of('r1c11nM') == 'r1c1'
+    assert catalog.couple_of('r1c10') == 'r1c10'
+    assert catalog.couple_of('r2c3baseline', ['baseline']) == 'r2c3'
+    assert catalog.couple_of('') is None
+
+
+def test_parse_folder():
+    run = catalog.parse_folder('03082024-d030824-II-Stability-40C')
+    assert run['date'] == '2024-03-08' and run['device'] == 'd030824-II' and run['kind'] == 'stability'
+    assert run['setpoints'] == [('temperature', '40C', 40.0)]
+    assert catalog.parse_folder('notes') is None
+
+
+def test_concurrent_writers(tmp_path):
+    # threads with their own connection add files of the same device and couple at the same time
+    path = str(tmp_path/'catalog.sqlite')
+    files = [str(tmp_path/'03082024-d1-Sensing'/('03082024-d1-Sensingr1c1T%d.txt' % i)) for i in range(16)]
+    for name in files:
+        _touch(name)
+    errors, barrier = [], threading.Barrier(len(files))
+
+    def add(name):
+        try:
+            with catalog.Catalog(path) as cat:
+                barrier.wait()
+                cat.add_file(name)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=add, args=(name,)) for name in files]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    with catalog.Catalog(path) as cat:
+        found = cat.find(device='d1', couple='r1c1')
+        assert len(found) == len(files)
+        assert len(cat.query('SELECT * FROM devices')) == 1
+
+
+def test_find_stabilized_by_time(tmp_path):
+    noon = time.mktime((2024, 3, 8, 12, 0, 0, 0, 0, -1))
+    before = str(tmp_path/'03082024-d2-Sensing'/'03082024-d2-Sensingr1c11nM.txt')
+    stability = str(tmp_path/'03082024-d2-Stability'/'03082024-d2-Stabilityr1c1.txt')
+    after = str(tmp_path/'03082024-d2-Sensing'/'03082024-d2-Sensingr1c110nM.txt')
+    _touch(before, noon - 3600)
+    _touch(stability, noon)
+    _touch(after, noon + 3600)
+    path = str(tmp_path/'catalog.sqlite')
+    assert catalog.scan(str(tmp_path), path) == 3
+    with catalog.Catalog(path) as cat:
+        assert list(cat.find(stabilized=True)['path']) == [after]
+        assert list(cat.find(stabilized=False)['path']) == [before]
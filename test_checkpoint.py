@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from checkpoint import RunCheckpoint
+
+
+def _sweep(i):
+    return pd.DataFrame({'VDL': 0.5 + 0.01*i + np.arange(5)*1e-3, 'VDR': 0.4 + np.arange(5)*1e-3})
+
+
+def _write(path):
+    ckpt = RunCheckpoint(path, sync=False)
+    ckpt.add_sweep('stability', None, _sweep(0), diff=None)
+    ckpt.add_sweep('stability', None, _sweep(1), diff=0.1)
+    ckpt.set_state(stability_done=True)
+    for i, c in enumerate(['10mM', '20mM']):
+        ckpt.add_sweep('sensing', c, _sweep(i))
+    ckpt.set_state(k=1, mean_std=[[0.0, 0.001]], folder='run', baseline=0.1)
+    return ckpt
+
+
+def test_reopen(tmp_path):
+    path = str(tmp_path/'run.ckpt')
+    _write(path)
+    ckpt = RunCheckpoint(path)
+    diode_df, mean_diff, done = ckpt.stability_state()
+    assert len(diode_df) == 2 and mean_diff == [0.1] and done
+    pd.testing.assert_frame_equal(diode_df[1], _sweep(1))
+    assert ckpt.keys('sensing') == ['10mM', '20mM']
+    k, diode_df_dict, diode_dict_list, mean_std, _, _, folder, baseline = ckpt.sensing_state(['10mM', '20mM'])
+    assert k == 1 and list(diode_df_dict) == ['10mM'] and 'DIFFV' in diode_df_dict['10mM']
+    assert mean_std == [[0.0, 0.001]] and folder == 'run' and baseline == 0.1
+
+
+def test_clear(tmp_path):
+    path = str(tmp_path/'run.ckpt')
+    _write(path).clear('stability')
+    ckpt = RunCheckpoint(path)
+    assert ckpt.sweeps('stability') == [] and len(ckpt.sweeps('sensing', '10mM')) == 1
+
+
+@pytest.mark.parametrize('cut', [1, 3, 4, 5, 20, -1])
+def test_torn_tail(tmp_path, cut):
+    # a crash while writing the last record: its header or payload is cut at any byte
+    path = str(tmp_path/'run.ckpt')
+    ckpt = _write(path)
+    complete, size = dict(ckpt.state), os.path.getsize(path)
+    ckpt.set_state(extra=1)
+    with open(path, 'r+b') as f:
+        f.truncate(size + cut if cut > 0 else os.path.getsize(path) + cut)
+
+    ckpt = RunCheckpoint(path)
+    assert ckpt.state == complete
+    assert os.path.getsize(path) == size # the torn tail is dropped
+    ckpt.add_sweep('sensing', '20mM', _sweep(5))
+    reopened = RunCheckpoint(path)
+    assert len(reopened.sweeps('sensing', '20mM')) == 2
+    pd.testing.assert_frame_equal(reopened.sweeps('sensing', '20mM')[-1], _sweep(5))
@@ -0,0 +1,30 @@
+import numpy as np
+
+import downsample
+
+
+def test_lttb():
+    y = np.sin(np.linspace(0, 20, 10000))
+    indices = downsample.lttb(np.arange(len(y)), y, 500)
+    assert len(indices) == 500 and indices[0] == 0 and indices[-1] == len(y) - 1
+    assert np.all(np.diff(indices) > 0)
+    assert y[indices].max() > 0.999 and y[indices].min() < -0.999
+    np.testing.assert_array_equal(downsample.lttb(np.arange(10), np.arange(10), 20), np.arange(10))
+
+
+def test_pyramid_keeps_spikes():
+    y = np.zeros(100000)
+    y[12345], y[67890] = 5.0, -3.0
+    pyramid = downsample.Pyramid(np.arange(len(y)), y)
+    x, values = pyramid.view(points=1000)
+    assert len(x) <= 1100 and values.max() == 5.0 and values.min() == -3.0
+    x, values = pyramid.view(12000, 12500, points=1000) # zoomed in: the raw points
+    np.testing.assert_array_equal(x, np.arange(12000, 12501))
+
+
+def test_pyramid_sorts_scatter():
+    x = np.random.default_rng(0).permutation(5000).astype(float)
+    pyramid = downsample.Pyramid(x, x**2)
+    view_x, view_y = pyramid.view(100, 200)
+    np.testing.assert_array_equal(view_x, np.arange(100, 201))
+    np.testing.assert_array_equal(view_y, view_x**2)
@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import features
+
+
+def _sweep(offset = 0.0):
+    current = np.linspace(0, 300e-9, 61)
+    return pd.DataFrame({'VDL': 0.5 + offset + current*1e5, 'VDR': 0.4 + current*1e5, 'IDL': current, 'IDR': current})
+
+
+def test_split_sweeps():
+    sheet = pd.concat([_sweep(), _sweep(0.01), _sweep(0.02)])
+    sweeps = features.split_sweeps(sheet)
+    assert len(sweeps) == 3
+    pd.testing.assert_frame_equal(sweeps[2], _sweep(0.02))
+
+
+def test_feature_table():
+    table = features.feature_table({'10mM': pd.concat([_sweep(), _sweep(0.01)]), '20mM': _sweep()}, DUT='d1')
+    assert list(table['sheet']) == ['10mM', '10mM', '20mM'] and list(table['step']) == [0, 1, 0]
+    assert (table['DUT'] == 'd1').all()
+    np.testing.assert_allclose(table['max_L'], [0.53, 0.54, 0.53])
+    np.testing.assert_allclose(table['diff_last'], [0.1, 0.11, 0.1])
+
+
+def test_load_features_reads_the_saved_table(tmp_path):
+    import utils
+    workbook = str(tmp_path/'run.xlsx')
+    sheets = {'10mM': pd.concat([_sweep(), _sweep(0.01)])}
+    utils.write_workbook(workbook, sheets)
+    computed = features.load_features(workbook) # from the workbook, saved next to it
+    assert os.path.exists(features.features_path(workbook))
+    saved = features.load_features(workbook, compute=False)
+    pd.testing.assert_frame_equal(saved, computed, check_dtype=False)
+    assert len(saved) == 2
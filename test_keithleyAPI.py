@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+import sweep_status
+from keithleyAPI import assign_couples, parse_trace, parse_trace_status
+
+
+@pytest.mark.parametrize('raw', [
+    'N+1.000000E-09,N+2.000000E-09,C+2.000000E+01\n',   # line feed terminator
+    'N+1.000000E-09,N+2.000000E-09,C+2.000000E+01\r\n',
+    'N+1.000000E-09,N+2.000000E-09,C+2.000000E+01,',    # trailing comma
+    'N+1.000000E-09,N+2.000000E-09,C+2.000000E+01\x00',  # NUL terminator
+    'N+1.000000E-09, N+2.000000E-09 ,C+2.000000E+01;',
+])
+def test_parse_trace_terminators(raw):
+    values, status = parse_trace_status(raw)
+    assert np.allclose(values, [1e-9, 2e-9, 20])
+    assert list(status) == [sweep_status.NORMAL, sweep_status.NORMAL, sweep_status.COMPLIANCE]
+
+
+def test_parse_trace_empty():
+    assert len(parse_trace('')) == 0
+    assert len(parse_trace('\n')) == 0
+
+
+def test_parse_trace_values():
+    raw = ','.join('N%+.6E' % value for value in np.linspace(-1, 1, 61)) + '\n'
+    assert np.allclose(parse_trace(raw), np.linspace(-1, 1, 61))
+
+
+def test_assign_couples():
+    groups = assign_couples(['a', 'b', 'c', 'd'], channels=('CH1', 'CH2', 'CH3', 'CH4', 'CH5'))
+    assert groups == [{'a': ('CH2', 'CH3', 'CH1'), 'b': ('CH4', 'CH5', 'CH1')}, {'c': ('CH2', 'CH3', 'CH1'), 'd': ('CH4', 'CH5', 'CH1')}]
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+import kinetics
+
+
+def test_fit_batch():
+    t = 2.0*np.arange(60)
+    taus = np.array([5.0, 12.0, 30.0])
+    y = np.stack([kinetics.settling_curve(t, tau, 0.25, 0.01, 1e-6) for tau in taus])
+    fit = kinetics.fit_settling(t, y)
+    np.testing.assert_allclose(fit['tau'], taus, rtol=1e-2)
+    np.testing.assert_allclose(fit['y_inf'], 0.25, atol=1e-4) # 1 % of the amplitude (tau on a grid)
+    assert not fit['flags'].any()
+
+
+def test_flags():
+    t = np.arange(30.0)
+    flat = 0.25 + np.random.default_rng(0).normal(0, 1e-4, 30)
+    short = np.full(30, np.nan)
+    short[:3] = 0.25
+    fit = kinetics.fit_settling(t, np.stack([flat, short]))
+    assert fit['flags'].iloc[0] & kinetics.FIT_NO_SETTLING
+    assert kinetics.describe(fit['flags'].iloc[1]) == ['few points'] and np.isnan(fit['tau'].iloc[1])
@@ -0,0 +1,17 @@
+import os
+import subprocess
+import sys
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_import_from_outside(tmp_path):
+    # the package imported by its folder name from another working directory, as the notebooks do
+    name = os.path.basename(FOLDER)
+    code = ("import %s as package\n"
+            "for module in ('keithleyAPI', 'keythleyAPI', 'utils', 'tests_', 'catalog', 'trace_codec'):\n"
+            "    getattr(package, module)\n"
+            "assert package.utils.rundirs is package.rundirs\n" % name)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(FOLDER))
+    result = subprocess.run([sys.executable, '-c', code], cwd=str(tmp_path), env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
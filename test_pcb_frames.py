@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import pcb_frames
+
+
+def _capture(frames = 5, length = 10, first = 4):
+    # an incomplete first frame, then complete DAC ramps
+    dac = np.concatenate([np.arange(length - first, length)] + [np.arange(length)]*frames)
+    return dac, np.arange(len(dac), dtype=float)
+
+
+def test_frames():
+    dac, ch2 = _capture()
+    index = pcb_frames.FrameIndex(dac)
+    assert len(index) == 6 and index.frame_length == 10
+    np.testing.assert_array_equal(index.complete(), np.arange(1, 6))
+    np.testing.assert_array_equal(index.frame(ch2, 1), np.arange(4, 14))
+
+
+def test_to_array_is_a_view():
+    dac, ch2 = _capture()
+    array = pcb_frames.FrameIndex(dac).to_array(ch2)
+    assert array.shape == (5, 10) and np.shares_memory(array, ch2)
+    np.testing.assert_array_equal(array[:, 0], 4 + 10*np.arange(5))
+    stats = pcb_frames.frame_stats(array, 5)
+    np.testing.assert_array_equal(stats['max'], array[:, -1])
+    with pytest.raises(ValueError):
+        pcb_frames.FrameIndex(dac).to_array(ch2, length=11)
+
+
+def test_glitch_merged():
+    dac = np.array([0, 1, 2, 3, 0, 1, 2, 3, 1, 0, 1, 2, 3], dtype=float)
+    index = pcb_frames.FrameIndex(dac, min_length=2)
+    np.testing.assert_array_equal(index.starts, [0, 4, 9])
+
+
+def test_ramp_starts_across_blocks():
+    # the live stream (pcb_stream) finds the same starts block by block, passing the last DAC value of the previous block
+    dac, _ = _capture()
+    found = list(pcb_frames.ramp_starts(dac[:17]))
+    for start, stop in [(17, 40), (40, len(dac))]:
+        found += list(start + pcb_frames.ramp_starts(dac[start:stop], previous=dac[start - 1]))
+    np.testing.assert_array_equal(found, pcb_frames.ramp_starts(dac))
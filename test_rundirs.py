@@ -0,0 +1,81 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import rundirs
+
+
+def _lock(path, **owner):
+    with open(str(path)+rundirs.LOCK_SUFFIX, 'w') as f:
+        f.write(json.dumps(owner) if owner else '')
+
+
+def test_claim_free_and_again(tmp_path):
+    path = str(tmp_path/'a.xlsx')
+    assert rundirs.claim(path) == path
+    assert rundirs.claim(path) == path
+    rundirs.release(path)
+    assert not os.path.exists(path+rundirs.LOCK_SUFFIX)
+
+
+def test_threads_get_distinct_paths(tmp_path):
+    path = str(tmp_path/'a.xlsx')
+    claimed, barrier = [], threading.Barrier(8)
+
+    def worker():
+        barrier.wait()
+        claimed.append(rundirs.claim(path))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(claimed)) == 8
+    rundirs.release()
+
+
+def test_live_owner_is_not_overwritten(tmp_path):
+    path = str(tmp_path/'a.xlsx')
+    _lock(path, run='other', claim='other', pid=os.getpid(), host=socket.gethostname())
+    assert rundirs.claim(path) == str(tmp_path/('a-'+rundirs.claim_id()+'.xlsx'))
+    rundirs.release()
+
+
+def test_dead_owner_is_taken_over(tmp_path):
+    path = str(tmp_path/'a.xlsx')
+    _lock(path, run='other', claim='other', pid=2**22 + 12345, host=socket.gethostname())
+    assert rundirs.claim(path) == path
+    rundirs.release()
+
+
+def test_other_host_heartbeat(tmp_path):
+    path = str(tmp_path/'a.xlsx')
+    _lock(path, run='other', claim='other', pid=1, host='elsewhere')
+    assert rundirs.claim(path) != path
+    old = time.time() - 2*rundirs.STALE_AFTER
+    os.utime(path+rundirs.LOCK_SUFFIX, (old, old))
+    assert rundirs.claim(path) == path
+    rundirs.release()
+
+
+@pytest.mark.parametrize('content', ['', '{"run"'])
+def test_empty_or_torn_lock(tmp_path, content):
+    path = str(tmp_path/'a.xlsx')
+    with open(path+rundirs.LOCK_SUFFIX, 'w') as f:
+        f.write(content)
+    old = time.time() - 2*rundirs.EMPTY_STALE_AFTER
+    os.utime(path+rundirs.LOCK_SUFFIX, (old, old))
+    assert rundirs.claim(path) == path
+    rundirs.release()
+
+
+def test_atomic_write(tmp_path):
+    path = str(tmp_path/'a.txt')
+    rundirs.atomic_write(path, lambda temporary: open(temporary, 'w').write('x'))
+    assert open(path).read() == 'x'
+    assert os.listdir(str(tmp_path)) == ['a.txt']
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+import squarelaw
+
+
+def _curve(vgs, vth, k):
+    # p-type transfer curve in saturation: Ids = k/2*(Vgs - Vth)^2 below Vth
+    return np.where(vgs < vth, -k/2*(vgs - vth)**2, 0.0)
+
+
+def test_fit_batch():
+    vgs = np.linspace(0, -1, 101)
+    vths = np.array([-0.2, -0.3, -0.4])
+    ids = np.stack([_curve(vgs, vth, 2e-6) for vth in vths])
+    fit = squarelaw.fit_square_law(-vgs, ids) # sqrt(|Ids|) grows with -Vgs
+    np.testing.assert_allclose(-fit['vth'], vths, atol=1e-6)
+    np.testing.assert_allclose(fit['k'], 2e-6, rtol=1e-6)
+    assert (fit['r2'] > 0.999).all() and not fit['flags'].any()
+
+
+def test_ragged_and_flagged():
+    vgs = np.linspace(0, -1, 101)
+    curves = [(-vgs, _curve(vgs, -0.3, 2e-6)), (-vgs[:40], _curve(vgs[:40], -0.3, 2e-6)), (-vgs[:3], np.zeros(3))]
+    fit = squarelaw.fit_square_law(*squarelaw.stack_curves(curves))
+    assert fit['vth'].iloc[1] == pytest.approx(0.3, abs=1e-6) # padded with NaN
+    assert squarelaw.describe(fit['flags'].iloc[2]) == ['few points'] and np.isnan(fit['vth'].iloc[2])
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import sweep_grid
+
+
+def test_step_grid():
+    grid = sweep_grid.SweepGridRegistry().grid('0', '300E-09', '5E-09')
+    assert len(grid) == 61 and grid.x[-1] == pytest.approx(300e-9)
+    assert grid.index_of(150e-9) == 30
+    with pytest.raises(ValueError):
+        grid.index_of(400e-9)
+    np.testing.assert_array_equal(grid.last_indices(5), np.arange(56, 61))
+
+
+def test_mask_and_slice_agree():
+    grid = sweep_grid.SweepGrid('vgs', 0, -1, num=101) # the VR ramps go down
+    mask = grid.mask(-0.5, -0.2)
+    assert mask.sum() == 31
+    np.testing.assert_array_equal(grid.x[grid.range_slice(-0.5, -0.2)], grid.x[mask])
+    assert grid.mask(-0.5, -0.2) is mask # cached
+
+
+def test_registry_shares_grids():
+    registry = sweep_grid.SweepGridRegistry()
+    first = registry.register('0', '300E-09', '5E-09')
+    assert registry.register(0.0, 3e-7, 5e-9) == first and len(registry) == 1
+    df = pd.DataFrame({'IDL': registry.get(first).x})
+    df.attrs['grid_id'] = first
+    assert registry.of(df) is registry.get(first)
+    with pytest.raises(ValueError):
+        registry.register(0, 1)
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import trace_codec
+
+
+def _roundtrip(values, lengths = None, **kwargs):
+    encoding, data = trace_codec.encode_column(values, lengths, **kwargs)
+    return encoding['codec'], trace_codec.decode_column(encoding, data)
+
+
+def test_grid():
+    codec, values = _roundtrip(np.concatenate([np.arange(61)*5e-9]*3), [61]*3)
+    assert codec == 'grid'
+    np.testing.assert_allclose(values, np.concatenate([np.arange(61)*5e-9]*3))
+
+
+def test_readings_float32():
+    readings = np.round(0.4 + 0.1*np.sin(np.linspace(0, 3, 200)), 7)
+    codec, values = _roundtrip(readings)
+    assert codec == 'float32'
+    np.testing.assert_allclose(values, readings, rtol=6e-8)
+
+
+@pytest.mark.parametrize('t', [
+    1.7e9 + np.concatenate([np.arange(100), 130 + np.arange(100)])*0.1, # epoch seconds, a gap between two blocks
+    36000 + np.arange(200)*0.1, # relative seconds after ten hours
+    np.cumsum(np.random.default_rng(0).uniform(0.09, 0.11, 200)), # jittered sampling
+])
+def test_time_exact(t):
+    codec, values = _roundtrip(t, exact=True)
+    assert codec in ('grid', 'float64') # a regular sampling is a grid, within GRID_TOLERANCE of the step
+    np.testing.assert_allclose(values, t, rtol=0, atol=trace_codec.GRID_TOLERANCE*0.1)
+
+
+def test_large_offset_detected():
+    t = 1.7e9 + np.concatenate([np.arange(100), 130 + np.arange(100)])*0.1
+    codec, values = _roundtrip(t, [100, 100])
+    assert codec == 'float64'
+    np.testing.assert_array_equal(values, t)
+
+
+@pytest.mark.parametrize('values', [np.array([3, -2, 7, 7, 100000], dtype=np.int64), np.array([True, False, True])])
+def test_int(values):
+    codec, decoded = _roundtrip(values)
+    assert codec == 'int' and decoded.dtype == values.dtype
+    np.testing.assert_array_equal(decoded, values)
+
+
+def test_archive_roundtrip(tmp_path):
+    sweeps = []
+    for i in range(3):
+        sweep = pd.DataFrame({'IDL': np.arange(61)*5e-9, 'VDL': np.round(0.3 + 0.001*i + np.arange(61)*1e-3, 7)})
+        sweep.attrs['status'] = {'VDL': bytes([0]*60 + [2])}
+        sweeps.append(sweep)
+    status = {'VDL': b''.join(sweep.attrs['status']['VDL'] for sweep in sweeps)}
+    sheet = pd.concat(sweeps)
+    sheet.attrs['status'] = status
+    bias = pd.DataFrame({'t': 1.7e9 + np.arange(500)*0.1, 'block': np.repeat([0, 1], 250),
+                         'VDL': np.round(0.5 + 1e-4*np.random.default_rng(1).standard_normal(500), 7)})
+    path = trace_codec.save_archive(str(tmp_path/'run-traces.npz'), {'10mM': sheet, 'r1c1': bias})
+    with trace_codec.TraceArchive(path) as archive:
+        assert archive.sheet_names() == ['10mM', 'r1c1']
+        assert len(archive.sweeps('10mM')) == 3
+        last = archive['10mM', 2].to_frame()
+        np.testing.assert_allclose(last['VDL'], sweeps[2]['VDL'], rtol=6e-8)
+        assert last.attrs['status']['VDL'] == sweeps[2].attrs['status']['VDL']
+        decoded = archive.sheets()['r1c1']
+        np.testing.assert_array_equal(decoded['t'], bias['t'])
+        np.testing.assert_array_equal(decoded['block'], bias['block'])
+        np.testing.assert_allclose(decoded['VDL'], bias['VDL'], rtol=6e-8)
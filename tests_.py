@@ -1,10 +1,114 @@
+import os
 import utils
+import tracing
+import sweep_grid
+import sweep_status
+import catalog
 import time
 import numpy as np
 import pandas as pd
 from datetime import datetime
 
-def sensing_test(L, R, C, smu,k, conc, diode_df_dict, diode_dict_list, mean_std, mean_std_L, mean_std_R,DUT, TOT, couple, baseline):
+def measure_checked(measure, retries = 1):
+    """
+    Acquire a sweep and check it right away (sweep_status.check: compliance, overflow, oscillation, disconnection).
+    A bad sweep is measured again, up to retries times.
+
+    Parameters:
+    - measure (callable): function without arguments returning a sweep (e.g. lambda: smu.diode_connection(...)).
+    - retries (int, optional): number of new attempts after a bad sweep. Default is 1.
+
+    Returns:
+    - sweep (pd.DataFrame): last sweep acquired, with its problems in attrs['problems'].
+    - problems (int): sweep_status.PROBLEM_* bits of the returned sweep (0 if good).
+    """
+    for attempt in range(retries + 1):
+        sweep = measure()
+        problems = sweep_status.check(sweep)
+        if not problems:
+            break
+        print('Bad sweep:', ', '.join(sweep_status.describe(problems)), '(attempt', attempt+1, 'of', str(retries+1)+')')
+    sweep.attrs['problems'] = int(problems)
+    return sweep, problems
+
+
+def adaptive_schedule(diode_start, diode_stop, diode_step, n_runs, Nlastvalues = 5, coarse_factor = 4, margin = 3):
+    """
+    Sweep schedule of the adaptive acquisition: a coarse full sweep (one point every coarse_factor) for the
+    shape of the curve, then short sweeps with the full resolution over the last Nlastvalues points, the only
+    ones used by utils.calculate_mean_std. The points of every sweep are on the grid of the full sweep.
+    The dense sweeps step the current from 0 to their first point instead of ramping it from 0 like the full
+    sweep, so the bias history of the last points differs: margin points are measured (and discarded by the
+    statistics) before them to let the device settle after the step.
+
+    Parameters:
+    - diode_start, diode_stop, diode_step (str): full current sweep in [A].
+    - n_runs (int): number of sweeps.
+    - Nlastvalues (int, optional): points used by the statistics. Default is 5.
+    - coarse_factor (int, optional): the coarse sweep takes one point every coarse_factor. Default is 4.
+    - margin (int, optional): points measured before the region of the statistics (settling of the device after the current step). Default is 3.
+
+    Returns:
+    - schedule (pd.DataFrame): one row per run with 'kind' ('coarse' or 'dense'), 'start', 'stop', 'step' (str, as passed to
+      diode_connection), 'points' and 'first' (position of the first point on the full grid; the coarse sweep takes one every coarse_factor).
+    """
+    full = sweep_grid.get_grid(diode_start, diode_stop, diode_step)
+    n_full = len(full)
+    n_dense = min(Nlastvalues + margin, n_full)
+    coarse_factor = max(1, int(coarse_factor))
+    first_coarse = (n_full - 1) % coarse_factor # the coarse sweep ends on diode_stop
+    rows = [{'kind': 'coarse', 'start': '%.6E' % full.x[first_coarse], 'stop': diode_stop, 'step': '%.6E' % (full.step*coarse_factor),
+             'points': (n_full - 1)//coarse_factor + 1, 'first': first_coarse}]
+    for i in range(1, n_runs):
+        rows.append({'kind': 'dense', 'start': '%.6E' % full.x[n_full - n_dense], 'stop': diode_stop, 'step': diode_step,
+                     'points': n_dense, 'first': n_full - n_dense})
+    schedule = pd.DataFrame(rows)
+    schedule.attrs['full_points'] = n_full
+    schedule.attrs['coarse_factor'] = coarse_factor
+    return schedule
+
+
+def adaptive_report(schedule, seconds = None):
+    """
+    Print and return the time saved by an adaptive schedule with respect to n_runs full sweeps.
+    The measured sweep durations (if given) are fitted with overhead + time per point * points to estimate
+    the duration of the full sweeps; otherwise the saving is the fraction of points not measured.
+
+    Parameters:
+    - schedule (pd.DataFrame): as returned by adaptive_schedule.
+    - seconds (list, optional): measured duration of the sweeps of the schedule (NaN for the ones not measured, e.g. restored
+      from a checkpoint; without any, the report has no time keys).
+
+    Returns:
+    - report (dict): 'points', 'full_points', 'point_saving' and, if seconds is given, 'seconds', 'full_seconds', 'time_saving'.
+    """
+    n_full = schedule.attrs['full_points']
+    report = {'points': int(schedule['points'].sum()), 'full_points': n_full*len(schedule)}
+    report['point_saving'] = 1 - report['points']/report['full_points']
+    print(schedule.to_string(index=False))
+    print('Points measured: %d instead of %d (%.0f%% less)' % (report['points'], report['full_points'], 100*report['point_saving']))
+    if seconds is not None:
+        seconds = np.asarray(seconds, dtype=float)
+        valid = np.isfinite(seconds)
+        if not valid.any(): # all the sweeps restored from a checkpoint
+            print('Sweep time: no sweep timed')
+            return report
+        points = schedule['points'].to_numpy()[valid]
+        if len(np.unique(points)) >= 2:
+            per_point, overhead = np.polyfit(points, seconds[valid], 1)
+        else:
+            per_point, overhead = np.mean(seconds[valid]/points), 0.0
+        report['seconds'] = float(np.sum(seconds[valid]))
+        report['full_seconds'] = float((overhead + per_point*n_full)*valid.sum())
+        report['time_saving'] = 1 - report['seconds']/report['full_seconds'] if report['full_seconds'] > 0 else 0.0
+        print('Sweep time: %.1f s instead of ~%.1f s (%.0f%% less, resting time excluded)' % (report['seconds'], report['full_seconds'],
+                                                                                          100*report['time_saving']))
+    return report
+
+
+def sensing_test(L, R, C, smu,k, conc, diode_df_dict, diode_dict_list, mean_std, mean_std_L, mean_std_R,DUT, TOT, couple, baseline,
+                 diode_start = '0', diode_stop = '300E-09', diode_step = '5E-09', n_runs = 20, resting_time = 10, checkpoint = None,
+                 adaptive = False, coarse_factor = 4, retries = 1, ingest = None):
     """
     The function `sensing_test` conducts a series of diode sensing tests and analyzes the results.
     It iterates over 20 runs, acquiring data from a diode connection each time.
@@ -29,6 +133,22 @@ def sensing_test(L, R, C, smu,k, conc, diode_df_dict, diode_dict_list, mean_std,
     - TOT (str): Description of TOT parameter.
     - couple (str): Description of FET couple parameter.
     - baseline (float): Baseline value for calculations.
+    - diode_start, diode_stop, diode_step (str, optional): current sweep in [A]. Default is '0', '300E-09', '5E-09'.
+    - n_runs (int, optional): number of sweeps per concentration. Default is 20.
+    - resting_time (int, optional): seconds to wait after each sweep. Default is 10.
+    - checkpoint (checkpoint.RunCheckpoint, optional): every sweep and the state after each concentration are recorded in it;
+      the runs of conc[k] already recorded are not measured again. Restore the other variables with checkpoint.sensing_state(conc).
+    - adaptive (bool, optional): adaptive acquisition (see adaptive_schedule): a coarse full sweep, then sweeps over the last
+      Nlastvalues points only. The sweeps are indexed by their position on the full grid. The schedule and the time saved are
+      printed and saved as <workbook>-schedule.csv. Default is False.
+    - coarse_factor (int, optional): one point every coarse_factor in the coarse sweep of the adaptive acquisition. Default is 4.
+    - retries (int, optional): a sweep with compliance, overflow or disconnection is measured again up to retries times. Default is 1.
+      A sweep still disconnected raises an Exception; the other problems are kept in the attrs of the sweep ('problems') and in
+      the 'problems' column of the adaptive schedule.
+    - ingest (bool, optional): compute the feature table of the workbook and add it to the catalog and the similarity library
+      (the hooks of utils.save_xls). Default is None: only for the last concentration of conc, whose workbook holds the sweeps
+      of the whole run (each workbook repeats the concentrations before it). The partial workbooks of an interrupted run can
+      be added later with catalog.scan and similarity.build.
     
     Returns:
     - k (int): Updated index for data management.
@@ -45,17 +165,34 @@ def sensing_test(L, R, C, smu,k, conc, diode_df_dict, diode_dict_list, mean_std,
     tol = 0.001
     Nvalidsteps = 6
     Nlastvalues = 5
-    diode_df_list = []
+    diode_df_list = checkpoint.sweeps('sensing', conc[k]) if checkpoint is not None else []
+    if diode_df_list:
+        print('Resuming', conc[k], 'from run #:', len(diode_df_list)+1)
     
-    diode_start = '0' # value where to start sweeping from
-    diode_stop = '300E-09' # value where to stop sweeping
-    diode_step = '5E-09' # step of the sweeping
+    schedule = adaptive_schedule(diode_start, diode_stop, diode_step, n_runs, Nlastvalues, coarse_factor) if adaptive else None
+    seconds = [np.nan]*n_runs
+    problems = [0]*n_runs
     
-    # Loop for 20 runs
-    for i in range(20):
+    # Loop for n_runs runs
+    for i in range(len(diode_df_list), n_runs):
         print('Run #:',i+1)
-        diode_df_list.append(smu.diode_connection(L, R, C, diode_start, diode_stop, diode_step))
-        time.sleep(10) # Wait for 10 seconds before the next run
+        tracing.set_run(conc[k]+'#'+str(i+1))
+        start_time = time.perf_counter()
+        if adaptive:
+            run = schedule.iloc[i]
+            sweep, problems[i] = measure_checked(lambda: smu.diode_connection(L, R, C, run['start'], run['stop'], run['step']), retries)
+            sweep.index = run['first'] + np.arange(len(sweep))*(coarse_factor if run['kind'] == 'coarse' else 1)
+        else:
+            sweep, problems[i] = measure_checked(lambda: smu.diode_connection(L, R, C, diode_start, diode_stop, diode_step), retries)
+        if problems[i] & sweep_status.PROBLEM_DISCONNECTED:
+            raise Exception("Device not connected correctly")
+        diode_df_list.append(sweep)
+        seconds[i] = time.perf_counter() - start_time
+        if checkpoint is not None:
+            checkpoint.add_sweep('sensing', conc[k], diode_df_list[-1])
+        with tracing.span('sleep'):
+            time.sleep(resting_time) # Wait for resting_time seconds before the next run
+    tracing.set_run(conc[k])
 
     data_save = pd.concat(diode_df_list)  # saving the 20 sweeps in one df
     data_save['DIFFV'] = abs(data_save['VDL']- data_save['VDR']) # Calculate the difference between 'VDL' and 'VDR' and add it as a new column
@@ -73,16 +210,26 @@ def sensing_test(L, R, C, smu,k, conc, diode_df_dict, diode_dict_list, mean_std,
     mean_std_R.append(utils.calculate_mean_std(Nlastvalues,Nvalidsteps,diode_df_list,'VDR'))
 
     # Save dataframes to Excel files
-    folder = utils.save_xls(diode_df_dict, DUT,TOT,couple+conc[k])
+    if ingest is None:
+        ingest = k == len(conc)-1
+    folder = utils.save_xls(diode_df_dict, DUT,TOT,couple+conc[k], features = ingest, catalog = ingest, similarity = ingest, couple = couple)
+    if adaptive:
+        schedule['seconds'] = seconds
+        schedule['problems'] = problems
+        adaptive_report(schedule, seconds)
+        schedule.to_csv(os.path.join(folder, folder+couple+conc[k]+'-schedule.csv'), index=False)
     
     if k == 0: baseline = mean_std[0][0]
     mean_std[k][0] = mean_std[k][0]-baseline
     k = k+1
     print(mean_std)
+    if checkpoint is not None:
+        checkpoint.set_state(k=k, mean_std=mean_std, mean_std_L=mean_std_L, mean_std_R=mean_std_R, folder=folder, baseline=baseline)
     
     return k, diode_df_dict, diode_dict_list, mean_std, mean_std_L, mean_std_R, folder, baseline
 
-def stability_test(L, R, C, smu, diode_df, mean_diff, mode, couple, DUT, TOT, max_steps, resting_time):
+def stability_test(L, R, C, smu, diode_df, mean_diff, mode, couple, DUT, TOT, max_steps, resting_time, tol_std = 0.0005, tol_mean = 0.002,
+                   checkpoint = None, retries = 1):
     """
     Perform a stability test on a device using an SMU.
 
@@ -96,28 +243,42 @@ def stability_test(L, R, C, smu, diode_df, mean_diff, mode, couple, DUT, TOT, ma
     - TOT: Type of Test.
     - max_steps: The maximum number of steps allowed for the stability test.
     - L,R,C: 'CH1', 'CH2', or 'CH3'
+    - tol_std: max std of |VDL-VDR| over the last 8 sweeps to consider the device stable [V]. Default is 0.0005.
+    - tol_mean: max mean change of |VDL-VDR| between sweeps over the last 8 sweeps [V]. Default is 0.002.
+    - checkpoint: A checkpoint.RunCheckpoint recording every sweep; if it already holds sweeps of this test, diode_df and
+      mean_diff are restored from it and the test continues from the next sweep (or returns, if it was completed).
+    - retries: a sweep with compliance, overflow or disconnection is measured again up to retries times. Default is 1.
     """
     stop = False
     step = 0
     mean = []
-    tol_std = 0.0005
-    tol_mean = 0.002
-
-    # Perform initial diode connection
     current_stop = '300E-09' if mode == 'sensing' else '1E-06'
-    diode_df.append(smu.diode_connection(L, R, C, '0', current_stop, '5E-09'))
-    time.sleep(resting_time)
 
-    # Check diode connection status
-    if diode_df[0]['IDL'].max() == 20 or diode_df[0]['IDR'].max() == 20:
-        raise Exception("Device not connected correctly") 
+    if checkpoint is not None and checkpoint.sweeps('stability'):
+        diode_df[:] = checkpoint.sweeps('stability')
+        mean_diff[:] = checkpoint.meta('stability', name='diff')[1:]
+        mean = checkpoint.meta('stability', name='VDL_VDR')[1:]
+        step = len(diode_df)-1
+        if checkpoint.state.get('stability_done'):
+            return diode_df, mean_diff
+        print('Resuming stability test from sweep #:', step+1)
+    else:
+        # Perform initial diode connection and check the connection status
+        sweep, problems = measure_checked(lambda: smu.diode_connection(L, R, C, '0', current_stop, '5E-09'), retries)
+        if problems & sweep_status.PROBLEM_DISCONNECTED:
+            raise Exception("Device not connected correctly") 
+        diode_df.append(sweep)
+        if checkpoint is not None:
+            checkpoint.add_sweep('stability', None, diode_df[-1])
+        time.sleep(resting_time)
 
     while not stop:
         step += 1 
         print("Sweep #:", step)
+        tracing.set_run(step)
         
         if step > max_steps:
-            utils.save_xls(diode_df, DUT, TOT, couple, 2)
+            utils.save_xls(diode_df, DUT, TOT, couple, 2, couple = couple)
             raise Exception("Too many steps performed without stability")
 
         if step % 5 == 0:
@@ -125,13 +286,15 @@ def stability_test(L, R, C, smu, diode_df, mean_diff, mode, couple, DUT, TOT, ma
             utils.plot_max_values(diode_df, ['baseline'], couple, step, DUT, TOT, mode=3)
 
         # Perform diode connection and calculate mean differences
-        diode_df.append(smu.diode_connection(L, R, C, '0', current_stop, '5E-09'))
+        diode_df.append(measure_checked(lambda: smu.diode_connection(L, R, C, '0', current_stop, '5E-09'), retries)[0])
         diff = abs((diode_df[step-2]['VDL'].iloc[-10:] - diode_df[step-2]['VDR'].iloc[-10:]) - 
                    (diode_df[step-1]['VDL'].iloc[-10:] - diode_df[step-1]['VDR'].iloc[-10:])).mean() #mean (|VDL-VDR|_step(i)-|VDL-VDR|_step(i-1)) of the last 10 values
         VDL_VDR = abs((diode_df[step-1]['VDL'].iloc[-10:] - diode_df[step-1]['VDR'].iloc[-10:])).mean()  #mean |VDL-VDR| of the last 10 values
         
         mean_diff.append(diff)
         mean.append(VDL_VDR)
+        if checkpoint is not None:
+            checkpoint.add_sweep('stability', None, diode_df[-1], diff=diff, VDL_VDR=VDL_VDR)
 
         # Display calculated metrics
         print('|VDL-VDR|: ', round(VDL_VDR, 5))
@@ -148,10 +311,18 @@ def stability_test(L, R, C, smu, diode_df, mean_diff, mode, couple, DUT, TOT, ma
             print('Device correctly stabilized')
             stop = True   
 
-        time.sleep(resting_time)
+        with tracing.span('sleep'):
+            time.sleep(resting_time)
 
     # Save data to Excel and return results
-    utils.save_xls(diode_df, DUT, TOT, couple, 2)
+    utils.save_xls(diode_df, DUT, TOT, couple, 2, couple = couple)
+    if checkpoint is not None:
+        checkpoint.set_state(stability_done=True)
+    try:
+        with catalog.Catalog() as cat:
+            cat.mark_stabilized(DUT, couple)
+    except Exception as error:
+        print('Stabilization not recorded in the catalog:', error)
     return diode_df, mean_diff
 
 
@@ -193,9 +364,10 @@ def stability_test_egofet(gate, source, drain, smu, vgsids, mean_diff, couple, D
     while not stop:
         step += 1 
         print("Sweep #:", step)
+        tracing.set_run(step)
         
         if step > max_steps:
-            utils.save_xls(vgsids, DUT, TOT, couple, 2)
+            utils.save_xls(vgsids, DUT, TOT, couple, 2, couple = couple)
             raise Exception("Too many steps performed without stability")
 
         if step % 5 == 0:
@@ -222,10 +394,11 @@ def stability_test_egofet(gate, source, drain, smu, vgsids, mean_diff, couple, D
             print('Device correctly stabilized')
             stop = True   
 
-        time.sleep(resting_time)
+        with tracing.span('sleep'):
+            time.sleep(resting_time)
 
     # Save data to Excel and return results
-    utils.save_xls(diode_df, DUT, TOT, couple, 2)
+    utils.save_xls(diode_df, DUT, TOT, couple, 2, couple = couple)
     return diode_df, mean_diff
                     
                     
@@ -282,11 +455,14 @@ def sensing_test_egofet(G, S, D, smu,k, conc, egofet_df_list, egofet_dict_list,
     # Loop for 20 runs
     for i in range(20):
         print('Run #:',i+1)
+        tracing.set_run(conc[k]+'#'+str(i+1))
         egofet_df_list.append(smu.VgsIds(gate, source, drain, vds, compliance_vds, vg_start,vg_stop,vg_step, compliance_vg, speed))
-        time.sleep(resting_time) # Wait for resting_time seconds before the next run
+        with tracing.span('sleep'):
+            time.sleep(resting_time) # Wait for resting_time seconds before the next run
+    tracing.set_run(conc[k])
 
     data_save = pd.concat(egofet_df_list)  # saving the 20 sweeps in one df
-    calibrated_response.append(pd.Series([utils.calibrated_response_egofet(i,slope_point = slope_point) for i in egofet_df_list])) #calculate the 20 responses at the slope_point and append in a list
+    calibrated_response.append(pd.Series(utils.calibrated_response_egofet_batch(egofet_df_list[-20:], slope_point = slope_point))) #calculate the 20 responses at the slope_point and append in a list
     # Store dataframes and lists into dictionaries
     diode_df_dict[conc[k]] = data_save  
     diode_dict_list[conc[k]] = diode_df_list
@@ -295,11 +471,45 @@ def sensing_test_egofet(G, S, D, smu,k, conc, egofet_df_list, egofet_dict_list,
     mean_std.append([np.mean(calibrated_response[-1][-Nvalidsteps:]),np.std(calibrated_response[-1][-Nvalidsteps:])])
 
     # Save dataframes to Excel files
-    folder = utils.save_xls(diode_df_dict, DUT,TOT,couple+conc[k])
+    ingest = k == len(conc)-1 # the last workbook holds all the concentrations (see sensing_test)
+    folder = utils.save_xls(diode_df_dict, DUT,TOT,couple+conc[k], features = ingest, catalog = ingest, similarity = ingest, couple = couple)
     
     if k == 0: baseline = mean_std[0][0]
     mean_std[k][0] = mean_std[k][0]-baseline
     k = k+1
     print(mean_std)
     
-    return k, diode_df_dict, diode_dict_list, mean_std, calibrated_response, folder, baseline
\ No newline at end of file
+    return k, diode_df_dict, diode_dict_list, mean_std, calibrated_response, folder, baseline
+
+def constantbias_test(L, R, C, smu, DUT, TOT, couple, bias = '300E-09', interval = 0.1, duration = 60, block = 100):
+    """
+    Time series sensing at constant bias: both diode connected transistors are biased with the same current and
+    VDL/VDR are sampled every interval seconds (smu.constantbias_stream), instead of one current sweep per point.
+
+    Parameters:
+    - L, R, C (str): Left, Right and Common probes [CH1,CH2,CH3].
+    - smu (object): smu object.
+    - DUT (str): Description of DUT parameter.
+    - TOT (str): Description of TOT parameter.
+    - couple (str): Description of FET couple parameter.
+    - bias (str, optional): bias current in [A]. Default is '300E-09'.
+    - interval (float, optional): seconds between two samples. Default is 0.1.
+    - duration (float, optional): seconds of acquisition (rounded up to whole blocks). Default is 60.
+    - block (int, optional): samples fetched from the instrument at once. Default is 100.
+
+    Returns:
+    - data (pd.DataFrame): 't' (seconds from the first sample), 'block' (number of the block: no samples between two blocks),
+      'VDL', 'VDR', 'IDL', 'IDR' and 'DIFFV' columns.
+    - folder (str): Name of the directory where the Excel file is saved.
+    """
+    blocks = int(np.ceil(duration/(interval*block)))
+    data_list = []
+    for i, data_block in enumerate(smu.constantbias_stream(L, R, C, bias, interval, block, blocks)):
+        data_list.append(data_block)
+        print('Block #:', i+1, '/', blocks, ' |VDL-VDR|:', round(abs(data_block['VDL']-data_block['VDR']).mean(), 5))
+
+    data = pd.concat(data_list, ignore_index=True)
+    data['t'] = data['t'] - data['t'].iloc[0]
+    data['DIFFV'] = abs(data['VDL'] - data['VDR'])
+    folder = utils.save_xls({couple: data}, DUT, TOT, couple, couple = couple)
+    return data, folder
@@ -0,0 +1,391 @@
+"""
+Compact archive of the sweeps of a run (<workbook>-traces.npz), an order of magnitude smaller and faster to
+load than the xlsx workbooks.
+
+The sweeps of a run (all its sheets) with the same columns form a block, and every column of a block is
+encoded once, concatenated across its sweeps; the header lists the sweeps with their block, offset and
+number of points. The columns are encoded as:
+- 'grid': columns where every sweep is a linear grid (IDL/IDR of the IR1 ramps, Vgs of the VR ramps, the
+  index) are stored as (start, step) per sweep, a single one when all the sweeps share it.
+- 'float32': the measured channels, delta coded on the float32 bit patterns: relative error below 6e-8,
+  whatever the magnitude of the reading (the DO readings have 7 significant digits).
+- 'float64': the time columns ('t', 'time') and the columns that float32 cannot resolve (a large offset
+  compared with the changes between points, e.g. epoch seconds: float32 is 64 s off at 1.7e9 s, and 2 ms
+  off at 36000 s), delta coded on the float64 bit patterns: lossless.
+- 'int': integer columns, delta coded in the smallest integer type.
+The bytes of the encoded values are shuffled (all the first bytes, then all the second bytes, ...) and
+compressed with zlib, one npz member per column of a block (a run with one kind of sweep has a handful of
+members), so opening an archive only reads its header and a column is decompressed into NumPy the first
+time one of its sweeps is accessed. The status flags (keithleyAPI status letters) are stored per column of
+a block too, and only when some flag is set.
+
+Usage:
+    trace_codec.save_archive('run-traces.npz', diode_df_dict)
+    archive = trace_codec.TraceArchive('run-traces.npz')
+    vdl = archive['20mM', 3]['VDL']          # decodes the VDL column of the block of this sweep only
+    sheets = archive.sheets()                 # {sheet: DataFrame}, as pd.read_excel(sheet_name=None)
+    python trace_codec.py results/            # archive all the workbooks under a folder
+"""
+import glob
+import json
+import os
+import zlib
+import numpy as np
+import pandas as pd
+import rundirs
+from features import SHEET_PREFIX, split_sweeps
+
+# max deviation from an exact linear grid (relative to the step) for a sweep to be stored as a grid
+GRID_TOLERANCE = 1e-6
+# max float32 rounding error (relative to the median change between consecutive points) for a 'float32' column
+FLOAT32_TOLERANCE = 1e-3
+# columns always stored losslessly ('float64')
+TIME_COLUMNS = ('t', 'time')
+
+_INT_TYPES = (np.int8, np.int16, np.int32, np.int64)
+
+
+def archive_path(workbook):
+    """
+    Path of the archive of a workbook (<workbook>-traces.npz).
+    """
+    return os.path.splitext(workbook)[0] + '-traces.npz'
+
+
+def _pack(values, level):
+    values = np.ascontiguousarray(values)
+    shuffled = values.view(np.uint8).reshape(-1, values.itemsize).T.tobytes()
+    return np.frombuffer(zlib.compress(shuffled, level), dtype=np.uint8)
+
+
+def _unpack(member, dtype, n):
+    dtype = np.dtype(dtype)
+    raw = np.frombuffer(zlib.decompress(member.tobytes()), dtype=np.uint8)
+    return raw.reshape(dtype.itemsize, n).T.copy().view(dtype).ravel()
+
+
+def _int_type(values):
+    low, high = (int(values.min()), int(values.max())) if len(values) else (0, 0)
+    for dtype in _INT_TYPES:
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def _grids(values, lengths):
+    # (start, step) of every sweep if all of them are linear grids, else None
+    grids, offset = [], 0
+    for n in lengths:
+        sweep = values[offset:offset + n]
+        offset += n
+        if n == 0:
+            grids.append([0, 0])
+            continue
+        start = sweep[0]
+        step = (sweep[-1] - start)/(n - 1) if n > 1 else 0
+        if values.dtype.kind in 'iub':
+            start, step = int(start), int(sweep[1] - start) if n > 1 else 0
+            if np.any(sweep != start + step*np.arange(n)):
+                return None
+        else:
+            start, step = float(start), float(step)
+            if not np.isfinite(sweep).all() or (n > 1 and (step == 0 or np.max(np.abs(sweep - (start + step*np.arange(n)))) > GRID_TOLERANCE*abs(step))):
+                return None
+        grids.append([start, step])
+    return grids
+
+
+def _float32_resolves(values, lengths):
+    # the float32 rounding error is negligible compared with the changes between the points of the sweeps
+    error = np.nanmax(np.abs(values - values.astype(np.float32)), initial=0)
+    if error == 0:
+        return True
+    changes = np.abs(np.diff(values))
+    ends = np.cumsum(lengths)[:-1] - 1
+    changes[ends[(ends >= 0) & (ends < len(changes))]] = 0 # between two sweeps
+    changes = changes[np.isfinite(changes) & (changes > 0)]
+    return len(changes) > 0 and error <= FLOAT32_TOLERANCE*np.median(changes)
+
+
+def encode_column(values, lengths = None, level = 6, exact = False):
+    """
+    Encode one column, made of consecutive sweeps.
+
+    Parameters:
+    - values (array like): values of the column (the sweeps concatenated).
+    - lengths (list, optional): number of points of every sweep. Default is None (a single sweep).
+    - level (int, optional): zlib level. Default is 6.
+    - exact (bool, optional): store floats that are not a grid losslessly ('float64'), even when float32 resolves them. Default is False.
+
+    Returns:
+    - encoding (dict): codec and parameters (JSON serializable).
+    - data (np.array or None): compressed bytes (uint8) of the values, None for the grids.
+    """
+    values = np.asarray(values)
+    n = len(values)
+    lengths = [n] if lengths is None else [int(length) for length in lengths]
+    if values.dtype.kind not in 'iufb':
+        return {'codec': 'json', 'n': n, 'values': values.astype(str).tolist()}, None
+    integers = values.dtype.kind in 'iub'
+    grids = _grids(values.astype(np.int64) if integers else values.astype(float), lengths)
+    if grids is not None:
+        shared = len(set(map(tuple, grids))) == 1
+        return {'codec': 'grid', 'n': n, 'lengths': lengths, 'grids': grids[:1] if shared else grids,
+                'dtype': values.dtype.str if integers else '<f8'}, None
+    if integers:
+        delta = np.diff(values.astype(np.int64), prepend=0)
+        dtype = _int_type(delta)
+        return {'codec': 'int', 'n': n, 'dtype': np.dtype(dtype).str, 'original': values.dtype.str}, _pack(delta.astype(dtype), level)
+    values = values.astype(float)
+    if exact or not _float32_resolves(values, lengths):
+        bits = values.view(np.uint64)
+        return {'codec': 'float64', 'n': n}, _pack(np.diff(bits, prepend=np.uint64(0)), level)
+    bits = values.astype(np.float32).view(np.uint32)
+    return {'codec': 'float32', 'n': n}, _pack(np.diff(bits, prepend=np.uint32(0)), level)
+
+
+def decode_column(encoding, data = None):
+    """
+    Decode a column encoded with encode_column.
+
+    Returns:
+    - values (np.array): decoded values (the sweeps concatenated).
+    """
+    codec, n = encoding['codec'], encoding['n']
+    if codec == 'grid':
+        lengths, grids = encoding['lengths'], encoding['grids']
+        grids = grids*len(lengths) if len(grids) == 1 else grids
+        values = [start + step*np.arange(length) for length, (start, step) in zip(lengths, grids)]
+        return np.concatenate(values).astype(encoding['dtype']) if values else np.zeros(0, dtype=encoding['dtype'])
+    if codec == 'json':
+        return np.array(encoding['values'], dtype=object)
+    if codec == 'int':
+        return np.cumsum(_unpack(data, encoding['dtype'], n).astype(np.int64)).astype(encoding['original'])
+    if codec == 'float32':
+        return np.cumsum(_unpack(data, np.uint32, n), dtype=np.uint32).view(np.float32).astype(float)
+    if codec == 'float64':
+        return np.cumsum(_unpack(data, np.uint64, n), dtype=np.uint64).view(np.float64)
+    raise ValueError("Unknown codec "+repr(codec))
+
+
+def _attrs(df):
+    # JSON serializable attrs (grid_id, couple) of a sweep
+    return {key: value for key, value in df.attrs.items() if isinstance(value, (str, int, float, bool))}
+
+
+def _encode_block(number, sweeps, statuses, members, level):
+    # one encoding (and npz member) per column of the block, the sweeps concatenated
+    lengths = [len(sweep) for sweep in sweeps]
+    block = {'columns': {}, 'status': {}}
+
+    def add(name, values, exact = False):
+        encoding, data = encode_column(values, lengths, level, exact)
+        if data is not None:
+            encoding['member'] = 'b%d_%s' % (number, name)
+            members[encoding['member']] = data
+        return encoding
+
+    block['index'] = add('index', np.concatenate([np.asarray(sweep.index) for sweep in sweeps]))
+    for i, column in enumerate(sweeps[0].columns):
+        block['columns'][str(column)] = add('c%d' % i, np.concatenate([sweep[column].to_numpy() for sweep in sweeps]),
+                                            str(column) in TIME_COLUMNS)
+    for i, column in enumerate(sweeps[0].columns):
+        flags = b''.join(bytes(status.get(column, bytes(len(sweep)))) for status, sweep in zip(statuses, sweeps))
+        if not any(flags):
+            continue  # all zero: nothing to store, to_frame leaves the attrs without status
+        block['status'][str(column)] = 'b%d_s%d' % (number, i)
+        members[block['status'][str(column)]] = np.frombuffer(zlib.compress(flags, level), dtype=np.uint8)
+    return block
+
+
+def save_archive(path, list_df, level = 6):
+    """
+    Save sweeps in a compact archive (written atomically).
+
+    Parameters:
+    - path (str): path of the archive (.npz).
+    - list_df (list or dict): sheets as passed to utils.save_xls (dict key -> DataFrame, or list); every sheet may hold
+      several consecutive sweeps (split with features.split_sweeps).
+    - level (int, optional): zlib level. Default is 6.
+
+    Returns:
+    - path (str): path of the archive.
+    """
+    items = list_df.items() if isinstance(list_df, dict) else enumerate(list_df)
+    layouts, blocks, statuses, entries = {}, [], [], []
+    for sheet, df in items:
+        # status flags (bytes, one per point) of the sheet, split with its sweeps
+        status = {column: flags for column, flags in df.attrs.get('status', {}).items() if len(flags) == len(df)}
+        offset = 0
+        for step, sweep in enumerate(split_sweeps(df)):
+            layout = tuple((str(column), sweep[column].dtype.str) for column in sweep.columns) + (('', np.asarray(sweep.index).dtype.str),)
+            if layout not in layouts:
+                layouts[layout] = len(blocks)
+                blocks.append([])
+                statuses.append([])
+            number = layouts[layout]
+            entries.append({'sheet': str(sheet), 'step': step, 'block': number, 'offset': sum(map(len, blocks[number])),
+                            'n': len(sweep), 'attrs': _attrs(sweep)})
+            blocks[number].append(sweep)
+            statuses[number].append({column: flags[offset:offset + len(sweep)] for column, flags in status.items()})
+            offset += len(sweep)
+    members = {}
+    header = {'version': 2, 'blocks': [_encode_block(number, blocks[number], statuses[number], members, level) for number in range(len(blocks))],
+              'sweeps': entries}
+    header = np.frombuffer(zlib.compress(json.dumps(header).encode(), level), dtype=np.uint8)
+    rundirs.atomic_write(path, lambda temporary: np.savez(temporary, header=header, **members))
+    return path
+
+
+class LazySweep:
+    """
+    One sweep of a TraceArchive; a column is decoded (for all the sweeps of its block) on first access.
+    """
+
+    def __init__(self, archive, entry):
+        self._archive = archive
+        self._entry = entry
+        self._rows = slice(entry['offset'], entry['offset'] + entry['n'])
+        self.sheet = entry['sheet']
+        self.step = entry['step']
+
+    def __len__(self):
+        return self._entry['n']
+
+    def __repr__(self):
+        return 'LazySweep(sheet=%r, step=%d, points=%d, columns=%r)' % (self.sheet, self.step, len(self), self.columns)
+
+    @property
+    def _block(self):
+        return self._archive._blocks[self._entry['block']]
+
+    @property
+    def columns(self):
+        return list(self._block['columns'])
+
+    def __getitem__(self, column):
+        return self._archive._column(self._entry['block'], column)[self._rows]
+
+    @property
+    def index(self):
+        return self._archive._column(self._entry['block'], None)[self._rows]
+
+    def to_frame(self, columns = None):
+        """
+        Decode the sweep (or some of its columns) into a DataFrame with its attrs (grid_id, couple, status).
+        """
+        columns = self.columns if columns is None else columns
+        df = pd.DataFrame({column: self[column] for column in columns}, index=self.index)
+        df.attrs.update(self._entry['attrs'])
+        if self._block['status']:
+            df.attrs['status'] = {column: self._archive._status(self._entry['block'], column)[self._rows]
+                                  for column in self._block['status']}
+        return df
+
+
+class TraceArchive:
+
+    def __init__(self, path):
+        """
+        Open an archive written by save_archive (only the header is read).
+        """
+        self.path = path
+        self._npz = np.load(path)
+        header = json.loads(zlib.decompress(self._npz['header'].tobytes()))
+        self._blocks = header['blocks']
+        self._cache = {}
+        self._sweeps = [LazySweep(self, entry) for entry in header['sweeps']]
+        self._keys = {(sweep.sheet, sweep.step): sweep for sweep in self._sweeps}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._npz.close()
+
+    def __len__(self):
+        return len(self._sweeps)
+
+    def __iter__(self):
+        return iter(self._sweeps)
+
+    def __repr__(self):
+        return 'TraceArchive(%r, sweeps=%d, sheets=%d)' % (self.path, len(self._sweeps), len(self.sheet_names()))
+
+    def _column(self, block, column):
+        # decoded column of a block (None: the index), cached
+        if (block, column) not in self._cache:
+            encoding = self._blocks[block]['index'] if column is None else self._blocks[block]['columns'][column]
+            member = encoding.get('member')
+            self._cache[(block, column)] = decode_column(encoding, self._npz[member] if member else None)
+        return self._cache[(block, column)]
+
+    def _status(self, block, column):
+        if (block, column, 'status') not in self._cache:
+            self._cache[(block, column, 'status')] = zlib.decompress(self._npz[self._blocks[block]['status'][column]].tobytes())
+        return self._cache[(block, column, 'status')]
+
+    def __getitem__(self, key):
+        """
+        Sweep by (sheet, step) or by sheet name (its first sweep).
+        """
+        if not isinstance(key, tuple):
+            key = (str(key), 0)
+        return self._keys[(str(key[0]), key[1])]
+
+    def sheet_names(self):
+        return list(dict.fromkeys(sweep.sheet for sweep in self._sweeps))
+
+    def sweeps(self, sheet):
+        """
+        Return the sweeps of a sheet as DataFrames, in order.
+        """
+        return [sweep.to_frame() for sweep in self._sweeps if sweep.sheet == str(sheet)]
+
+    def sheets(self, columns = None):
+        """
+        Return {sheet: DataFrame} with the sweeps of every sheet concatenated, as saved by utils.save_xls.
+        """
+        frames = {}
+        for sweep in self._sweeps:
+            frames.setdefault(sweep.sheet, []).append(sweep.to_frame(columns))
+        return {sheet: pd.concat(sweeps) if len(sweeps) > 1 else sweeps[0] for sheet, sweeps in frames.items()}
+
+
+def archive_folder(root, pattern = '*.xlsx', **kwargs):
+    """
+    Write the archive of every workbook under root (recursively) that doesn't have an up to date one.
+
+    Parameters:
+    - root (str): folder to scan.
+    - pattern (str, optional): file name pattern of the workbooks. Default is '*.xlsx'.
+    - kwargs: passed to save_archive (level).
+
+    Returns:
+    - sizes (pd.DataFrame): one row per archived workbook with 'workbook', 'xlsx_bytes' and 'archive_bytes'.
+    """
+    rows = []
+    for workbook in sorted(glob.glob(os.path.join(root, '**', pattern), recursive=True)):
+        path = archive_path(workbook)
+        if os.path.basename(workbook).startswith(('~$', '.')) or (os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(workbook)):
+            continue
+        sheets = pd.read_excel(workbook, sheet_name=None, index_col=0)
+        sheets = {name[len(SHEET_PREFIX):] if name.startswith(SHEET_PREFIX) else name: df for name, df in sheets.items()}
+        save_archive(path, sheets, **kwargs)
+        rows.append({'workbook': workbook, 'xlsx_bytes': os.path.getsize(workbook), 'archive_bytes': os.path.getsize(path)})
+    return pd.DataFrame(rows, columns=['workbook', 'xlsx_bytes', 'archive_bytes'])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Write the compact trace archives of the workbooks of a results folder')
+    parser.add_argument('root')
+    parser.add_argument('--level', type=int, default=6, help='zlib level (default: 6)')
+    args = parser.parse_args()
+    sizes = archive_folder(args.root, level=args.level)
+    print(len(sizes), 'workbooks archived')
+    if len(sizes):
+        print('%.1f MB -> %.1f MB' % (sizes['xlsx_bytes'].sum()/1e6, sizes['archive_bytes'].sum()/1e6))
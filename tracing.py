@@ -0,0 +1,178 @@
+import json
+import threading
+import time
+from functools import wraps
+
+class _NullSpan:
+    """
+    Span returned when tracing is disabled: entering and leaving it does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def tag(self, **tags):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('_tracer', 'name', 'tags', 'start')
+
+    def __init__(self, tracer, name, tags):
+        self._tracer = tracer
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        self._tracer.record(self.name, self.start, duration, self.tags)
+        return False
+
+    def tag(self, **tags):
+        """
+        Add tags to the span while it is running (e.g. the number of points parsed).
+        """
+        self.tags.update(tags)
+
+
+class Tracer:
+    """
+    Lightweight tracer of the hot paths (VISA commands, sweeps, parsing, Excel saving, plots, stats).
+    Spans are kept in memory (records) and optionally appended to a JSONL file.
+    When the tracer is disabled span() returns a shared no-op object, so instrumented code pays
+    only an attribute lookup and a function call.
+
+    The phase of a span is the part of its name before the first '.' (e.g. 'visa.query' -> 'visa'),
+    the run is the one set with set_run() when the span ended.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.run = None
+        self._sink = None
+        self._lock = threading.Lock()
+
+    def enable(self, sink = None):
+        """
+        Start recording spans.
+
+        Parameters:
+        - sink (str, optional): path of a JSONL file the spans are appended to. Default is None (memory only).
+        """
+        self.disable()
+        if sink:
+            self._sink = open(sink, 'a')
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stop recording spans and close the JSONL sink. The records in memory are kept.
+        """
+        self.enabled = False
+        if self._sink:
+            self._sink.close()
+            self._sink = None
+
+    def clear(self):
+        self.records = []
+
+    def set_run(self, run):
+        """
+        Set the run the next spans belong to (e.g. the sweep number of a sensing test).
+        """
+        self.run = run
+
+    def span(self, name, **tags):
+        """
+        Context manager timing the code it wraps.
+
+        Usage:
+            with tracer.span('parse', column = 'VDL'):
+                ...
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, tags)
+
+    def record(self, name, start, duration, tags):
+        record = {'name': name, 'phase': name.split('.', 1)[0], 'run': self.run,
+                  'start': start, 'duration': duration}
+        record.update(tags)
+        with self._lock:
+            self.records.append(record)
+            if self._sink:
+                self._sink.write(json.dumps(record, default=str)+'\n')
+                self._sink.flush()
+
+    def summary(self):
+        """
+        Time spent per phase in each run.
+
+        Returns:
+        - summary (DataFrame): one row per run, one column per phase, total seconds (NaN if the phase did not run).
+        """
+        import pandas as pd
+        if not self.records:
+            return pd.DataFrame()
+        records = pd.DataFrame(self.records)
+        records['run'] = records['run'].fillna('-')
+        # nested spans (e.g. visa.query inside sweep) are reported in their own phase too
+        return records.pivot_table(index='run', columns='phase', values='duration', aggfunc='sum')
+
+
+# tracer shared by all the modules
+tracer = Tracer()
+
+
+def enable(sink = None):
+    tracer.enable(sink)
+
+
+def disable():
+    tracer.disable()
+
+
+def span(name, **tags):
+    return tracer.span(name, **tags)
+
+
+def set_run(run):
+    tracer.set_run(run)
+
+
+def summary():
+    return tracer.summary()
+
+
+def traced(name):
+    """
+    Decorator wrapping every call of a function in a span named name.function_name.
+
+    Usage:
+        @tracing.traced('plot')
+        def plot_max_values(...):
+    """
+    def decorator(func):
+        span_name = name+'.'+func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with _Span(tracer, span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,21 +1,22 @@
 import os
 from pandas import ExcelWriter
-import matplotlib.pyplot as plt
 import time
-import seaborn as sns
 import pandas as pd
-from datetime import datetime
 import numpy as np
-from scipy.signal import butter, filtfilt
-from scipy.signal import savgol_filter, medfilt
+import rundirs
+import sweep_grid
+import tracing
 
 col_L = '#1E5986'
 col_R = '#BF8F00'
 col_diff = "#FF8080"
 #os.chdir(r"C:\Users\Chuanzhen Zhao\Desktop\Results")
 path =  os.getcwd()
+# matplotlib, seaborn and scipy are imported inside the plotting and Vth functions, so that
+# acquisition scripts importing utils (through tests_) don't pay for them at start-up
 
-def plot_max_values(list_df, conc, couple,step,DUT,TOT, mode = 1, folder = None):
+@tracing.traced('plot')
+def plot_max_values(list_df, conc, couple,step,DUT,TOT, mode = 1, folder = None, max_points = 10000):
     """
     Plot the change of max values over time.
     
@@ -29,10 +30,15 @@ def plot_max_values(list_df, conc, couple,step,DUT,TOT, mode = 1, folder = None)
     - mode (int): Mode for plotting. Default is 1. if mode = 2 -> VDL and VDR are plotted. If mode = 2: VDL, VDR, VDL-VDR are plotted (diode-connection test)
                                      If mode is 4 -> egofet test
     - folder (str, optional): Folder to save the plot image. Default is None.
+    - max_points (int, optional): max points drawn per series; longer series are downsampled (min/max pyramid) and refined
+      on zoom (downsample.scatter). None draws all the points. Default is 10000.
 
     Returns:
     - None
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import downsample
     colors_L = sns.color_palette("Blues",25)
     colors_R = sns.color_palette("YlOrBr",25)
     colors_diff = sns.light_palette("seagreen",25)
@@ -58,22 +64,22 @@ def plot_max_values(list_df, conc, couple,step,DUT,TOT, mode = 1, folder = None)
     fig, ax = plt.subplots(figsize = (15,5))
     for i in range(numberoftests):
         if mode == 1 or mode == 3:
-            ax.scatter(range(i*int(len(diff_in_time_max[0])/numberoftests),(1+i)*int(len(diff_in_time_max[0])/numberoftests)),
+            downsample.scatter(ax, range(i*int(len(diff_in_time_max[0])/numberoftests),(1+i)*int(len(diff_in_time_max[0])/numberoftests)),
             (abs(diff_in_time_max[0][i*int(len(diff_in_time_max[0])/numberoftests):(1+i)*int(len(diff_in_time_max[0])/numberoftests)]['VDL']
             -diff_in_time_max[0][i*int(len(diff_in_time_max[0])/numberoftests):(1+i)*int(len(diff_in_time_max[0])/numberoftests)]['VDR'])
-            -abs(diff_in_time_max[0].iloc[0]['VDL']-diff_in_time_max[0].iloc[0]['VDR']))*1000, label = conc[i], color = colors_diff[10+i] )
+            -abs(diff_in_time_max[0].iloc[0]['VDL']-diff_in_time_max[0].iloc[0]['VDR']))*1000, label = conc[i], color = colors_diff[10+i], max_points = max_points)
             plt.title('Change of Max values in time')
         if mode == 2 or mode == 3:
-            ax.scatter(range(i*int(len(diff_in_time_max[0])/numberoftests),(1+i)*int(len(diff_in_time_max[0])/numberoftests)), (diff_in_time_max[0]
+            downsample.scatter(ax, range(i*int(len(diff_in_time_max[0])/numberoftests),(1+i)*int(len(diff_in_time_max[0])/numberoftests)), (diff_in_time_max[0]
             [i*int(len(diff_in_time_max[0])/numberoftests):(1+i)*int(len(diff_in_time_max[0])/numberoftests)]['VDL']-diff_in_time_max[0].iloc[0]['VDL'])*1000,
-            label = 'Left-'+conc[i], color = colors_L[10+i])
-            ax.scatter(range(i*int(len(diff_in_time_max[0])/numberoftests),(1+i)*int(len(diff_in_time_max[0])/numberoftests)), (diff_in_time_max[0]
+            label = 'Left-'+conc[i], color = colors_L[10+i], max_points = max_points)
+            downsample.scatter(ax, range(i*int(len(diff_in_time_max[0])/numberoftests),(1+i)*int(len(diff_in_time_max[0])/numberoftests)), (diff_in_time_max[0]
             [i*int(len(diff_in_time_max[0])/numberoftests):(1+i)*int(len(diff_in_time_max[0])/numberoftests)]['VDR']-diff_in_time_max[0].iloc[0]['VDR'])*1000,
-            label = 'Right-'+conc[i], color = colors_R[10+i])
+            label = 'Right-'+conc[i], color = colors_R[10+i], max_points = max_points)
             plt.title('Change of Max values in time')
         if mode == 4:
             plt.title('Calibrated response in time')
-            ax.scatter(range(len(diff_in_time)),diff_in_time, color = colors_R[10+i])
+            downsample.scatter(ax, range(len(diff_in_time)),diff_in_time, color = colors_R[10+i], max_points = max_points)
 
     
     ax.set_xlabel('Index')
@@ -92,22 +98,20 @@ def create_folder(device_name,type_of_test,additional_comment= None):
     """
     create a new folder of the type mmddyyyy-devicename-type_of_test-additional_comment
     return path of the folder
+    If the folder already exists (e.g. created by another acquisition) a new one with the suffix -2, -3, ... is created
+    (rundirs.new_run_folder, atomic).
     
     Parameters:
     - device_name (str): name of the DUT
     - type_of_test (str): TOT
     - additional_comment (str): remark you might want to add in the folder name
     """
-    today = datetime.now()
-    if additional_comment:
-        os.mkdir(today.strftime('%m%d%Y')+'-'+device_name+'-'+type_of_test+'-'+additional_comment)
-        return today.strftime('%m%d%Y')+'-'+device_name+'-'+type_of_test+'-'+additional_comment
-    else:
-        os.mkdir(today.strftime('%m%d%Y')+'-'+device_name+'-'+type_of_test)
-        return today.strftime('%m%d%Y')+'-'+device_name+'-'+type_of_test
+    return rundirs.new_run_folder(device_name, type_of_test, additional_comment)
 
                  
-def save_xls(list_df, device_name,type_of_test,additional_comment= None, mode = 1):
+@tracing.traced('excel')
+def save_xls(list_df, device_name,type_of_test,additional_comment= None, mode = 1, features = True, catalog = True, similarity = True, archive = False,
+             couple = None):
     """
     Save a list of DataFrames to an Excel file, with each DataFrame as a separate sheet.
 
@@ -117,36 +121,79 @@ def save_xls(list_df, device_name,type_of_test,additional_comment= None, mode =
     - type_of_test (str): Type of test performed.
     - additional_comment (str, optional): Additional comment to include in the file name. Default is None.
     - mode (int, optional): Mode for saving the Excel file. Default is 1.
+    - features (bool, optional): also save the per-sweep feature table next to the workbook (features.save_features). Default is True.
+    - catalog (bool, optional): add the workbook to the catalog of the working directory (catalog.register_saved). Default is True.
+    - similarity (bool, optional): add the sweeps to the curve-similarity library of the working directory (similarity.add_saved). Default is True.
+    - archive (bool, optional): also save the sweeps in the compact archive <workbook>-traces.npz (trace_codec.save_archive). Default is False.
+    - couple (str, optional): FET couple of the workbook, recorded in the catalog. Default is None (parsed from additional_comment).
 
     Returns:
     - directory (str): Name of the directory where the Excel file is saved.
     """  
-    today = datetime.now()
     path = os.getcwd()
-    if os.path.isdir(today.strftime('%m%d%Y')+'-'+device_name+'-'+type_of_test)!=1:
-        directory = create_folder(device_name,type_of_test)
+    # created atomically, also when other acquisitions save for the same DUT/TOT at the same time
+    directory, created = rundirs.run_folder(device_name, type_of_test)
+    if created:
         print('The directory doesn\'t exist')
     else:
-        directory = today.strftime('%m%d%Y')+'-'+device_name+'-'+type_of_test
         print('The directory exists')
         
     path_ = os.path.join(path, directory) 
     print(path_)
     if additional_comment:
-        writer = ExcelWriter(path_+'/'+directory+additional_comment+'.xlsx')
+        file_path = path_+'/'+directory+additional_comment+'.xlsx'
     else:
-        writer = ExcelWriter(path_+'/'+directory+'.xlsx')
+        file_path = path_+'/'+directory+'.xlsx'
+    # a workbook of another running acquisition is not overwritten (this run gets its own file name)
+    file_path = rundirs.claim(file_path)
+    rundirs.atomic_write(file_path, lambda temporary: write_workbook(temporary, list_df, mode))
+    if features:
+        import features as features_
+        try:
+            features_.save_features(file_path, list_df, DUT=device_name, TOT=type_of_test, comment=additional_comment)
+        except Exception as error: # the workbook is saved anyway
+            print('Feature table not saved:', error)
+    if catalog:
+        import catalog as catalog_
+        try:
+            catalog_.register_saved(file_path, list_df, additional_comment, couple = couple)
+        except Exception as error: # the workbook is saved anyway
+            print('Workbook not added to the catalog:', error)
+    if similarity:
+        import similarity as similarity_
+        try:
+            similarity_.add_saved(file_path, list_df, DUT=device_name, TOT=type_of_test, comment=additional_comment)
+        except Exception as error: # the workbook is saved anyway
+            print('Sweeps not added to the similarity library:', error)
+    if archive:
+        import trace_codec
+        try:
+            trace_codec.save_archive(trace_codec.archive_path(file_path), list_df)
+        except Exception as error: # the workbook is saved anyway
+            print('Trace archive not saved:', error)
+    return directory
+
+
+def write_workbook(file_path, list_df, mode = 1):
+    """
+    Write DataFrames to an Excel file, one sheet per DataFrame named "step #<key>" (the layout of save_xls).
 
+    Parameters:
+    - file_path (str): path of the xlsx file.
+    - list_df (list or dict): List (mode 2) or dictionary (mode 1) containing DataFrame objects.
+    - mode (int, optional): 1 for a dict, sheets named after the keys; otherwise a list, sheets named after the positions. Default is 1.
+    """
+    writer = ExcelWriter(file_path)
     if mode == 1:
         for key in list_df.keys():
-            list_df[str(key)].to_excel(writer, sheet_name="step #" + str(key))   
-        
+            list_df[str(key)].to_excel(writer, sheet_name="step #" + str(key))
+
     else:
         for key, df in enumerate(list_df):
             list_df[key].to_excel(writer, sheet_name="step #" + str(key))
     writer.close()
-    return directory
     
+@tracing.traced('plot')
 def plot_mean_std(k, mean_std_L,mean_std_R, mean_std, conc, couple, folder = None):
     """
     Plot mean and standard deviation for left and right sides.
@@ -163,6 +210,7 @@ def plot_mean_std(k, mean_std_L,mean_std_R, mean_std, conc, couple, folder = Non
     Returns:
     - None
     """ 
+    import matplotlib.pyplot as plt
     col_L = '#1E5986'
     col_R = '#BF8F00'
     col_diff = "#FF8080"
@@ -190,6 +238,7 @@ def plot_mean_std(k, mean_std_L,mean_std_R, mean_std, conc, couple, folder = Non
     #plt.grid()
     if folder : plt.savefig(folder+"\meanL_R_diff_last5-"+couple+".png",bbox_inches='tight')
     
+@tracing.traced('stats')
 def calculate_mean_std(Nlastvalues,Nvalidsteps,df_list, column):
     """
     Calculate the mean and standard deviation of the specified column from the last Nlastvalues values
@@ -211,6 +260,7 @@ def calculate_mean_std(Nlastvalues,Nvalidsteps,df_list, column):
     return [mean, std]
    
     
+@tracing.traced('stats')
 def calculate_vth(datax,datay, plot = None):
     """
     Compute the Vth starting from a VGS-IDS curve in the saturation regime with linear extrapolation
@@ -220,6 +270,7 @@ def calculate_vth(datax,datay, plot = None):
         datay = Y axis data (IDS) -> non squared! 
         
     """
+    from scipy.signal import butter, filtfilt
     
     IdS_sqrt = np.sqrt(datay)
     vgs = datax
@@ -249,6 +300,7 @@ def calculate_vth(datax,datay, plot = None):
 
     
     if plot:
+        import matplotlib.pyplot as plt
         fig, ax1 = plt.subplots(figsize=(8, 5))
         plt.plot(vgs, tangent_equation, '--',color = '#BEB8DC', label='Tangent Line', linewidth = 2)
         plt.plot(vgs, IdS_sqrt, color = '#FA7F6F', label='$\sqrt{I_{DS}}$)', linewidth = 2)
@@ -270,6 +322,7 @@ def calculate_vth(datax,datay, plot = None):
         
     return Vth
 
+@tracing.traced('stats')
 def calculate_vth_secondder(datax,datay, plot = None):
     """
     Compute the Vth starting from a VGS-IDS curve in the saturation regime with linear extrapolation
@@ -279,6 +332,7 @@ def calculate_vth_secondder(datax,datay, plot = None):
         datay = Y axis data (IDS) -> non squared! 
         
     """
+    from scipy.signal import butter, filtfilt
 
 
     IdS_sqrt = np.sqrt(datay)
@@ -308,6 +362,7 @@ def calculate_vth_secondder(datax,datay, plot = None):
     Vth = vgs[index_max_derivative]
     
     if plot:
+        import matplotlib.pyplot as plt
 
         fig, ax1 = plt.subplots(figsize=(11.69, 8.26))
         ax2 = ax1.twinx()
@@ -353,6 +408,7 @@ def calculate_vth_secondder(datax,datay, plot = None):
         
     return Vth
     
+@tracing.traced('excel')
 def save_table_xlsx(data, TOT, name_file):
     """
     save the data in an xlsx file of the type 'mmddyyyy-name_file' in the main path
@@ -368,16 +424,111 @@ def save_table_xlsx(data, TOT, name_file):
     return
 
 
-def calibrated_response_egofet(data, slope_point = None):
-    if slope_point:
-        slope =  np.gradient(data['Ids'],data['Vgs'])[data[data['Vgs']==slope_point].index][0]
-        ids = data[data['Vgs']==slope_point]['Ids']
+def read_isens_txt(path, scale = 100):
+    """
+    Read an iSENS PCB capture (.txt with one comma separated line per column: time, DAC, Ch1, Ch2).
+
+    Parameters:
+    - path (str): path of the txt file.
+    - scale (float, optional): factor Ch1 and Ch2 are divided by to get Volts. Default is 100.
+
+    Returns:
+    - data (DataFrame): 'time', 'DAC', 'Ch1', 'Ch2' columns.
+    """
+    columns = ['time','DAC','Ch1','Ch2']
+    with open(path, "r") as f:
+        lines = [line.rstrip().rstrip(',').split(',') for line in f if line.strip()]
+    data = pd.DataFrame({column: line for column, line in zip(columns, lines)})
+    data['DAC'] = pd.to_numeric(data['DAC'])
+    data['Ch1'] = pd.to_numeric(data['Ch1'])/scale
+    data['Ch2'] = pd.to_numeric(data['Ch2'])/scale
+    return data
+
+
+def calibrated_response_egofet(data, slope_point = None, tol = None):
+    """
+    Compute the calibrated response Ids/(dIds/dVgs) of a single VgsIds sweep.
+    Wrapper around calibrated_response_egofet_batch for one sweep.
+
+    Parameters:
+    - data (DataFrame): VgsIds sweep with 'Vgs' and 'Ids' columns.
+    - slope_point (float, optional): Vgs at which the response is computed. Default is None (point of max Ids).
+    - tol (float, optional): Max distance between slope_point and the nearest Vgs grid point. Default is half the grid step.
+
+    Returns:
+    - response (float): calibrated response of the sweep.
+    """
+    return calibrated_response_egofet_batch([data], slope_point = slope_point, tol = tol)[0]
+
+
+def _grid_index(grid, point, tol = None):
+    """
+    Return the index of the grid point nearest to point.
+    Raises ValueError if the nearest point is further than tol (default: half the grid step).
+    """
+    index = int(np.argmin(np.abs(grid - point)))
+    if tol is None:
+        tol = 0.5*np.max(np.abs(np.diff(grid))) if len(grid) > 1 else 0
+    if abs(grid[index] - point) > tol:
+        raise ValueError("Point "+str(point)+" is not on the grid (nearest: "+str(grid[index])+")")
+    return index
+
+
+def _local_gradient(y, x, index):
+    """
+    Derivative dy/dx of each row of y evaluated only at the given column index,
+    with the same finite differences used by np.gradient (second order inside, first order at the edges).
+
+    Parameters:
+    - y (np.array): 2D array (sweeps x points).
+    - x (np.array): 1D grid shared by all the sweeps.
+    - index (int or np.array): column index, one for all the rows or one per row.
+
+    Returns:
+    - gradient (np.array): 1D array with one derivative per row.
+    """
+    rows = np.arange(y.shape[0])
+    index = np.broadcast_to(index, rows.shape)
+    last = len(x) - 1
+    # edges are forced to the interior formula's neighbours and fixed below
+    i = np.clip(index, 1, last - 1)
+    hd = x[i] - x[i-1]
+    hs = x[i+1] - x[i]
+    gradient = (hd**2*y[rows, i+1] + (hs**2 - hd**2)*y[rows, i] - hs**2*y[rows, i-1])/(hs*hd*(hd + hs))
+    first = index == 0
+    gradient[first] = (y[first, 1] - y[first, 0])/(x[1] - x[0])
+    end = index == last
+    gradient[end] = (y[end, last] - y[end, last-1])/(x[last] - x[last-1])
+    return gradient
+
+
+@tracing.traced('stats')
+def calibrated_response_egofet_batch(data_list, slope_point = None, tol = None):
+    """
+    Compute the calibrated response Ids/(dIds/dVgs) of many VgsIds sweeps sharing the same Vgs grid.
+    The slope point is looked up once on the common grid and only the local derivative is computed.
+
+    Parameters:
+    - data_list (list): List of VgsIds DataFrames ('Vgs' and 'Ids' columns) acquired with the same sweep parameters.
+    - slope_point (float, optional): Vgs at which the responses are computed. Default is None (point of max Ids of each sweep).
+    - tol (float, optional): Max distance between slope_point and the nearest Vgs grid point. Default is half the grid step.
+
+    Returns:
+    - responses (np.array): 1D array with one calibrated response per sweep.
+    """
+    vgs = np.asarray(data_list[0]['Vgs'], dtype=float)
+    if len(vgs) < 2:
+        raise ValueError("At least 2 points per sweep are needed to compute the slope")
+    ids = np.array([np.asarray(data['Ids'], dtype=float) for data in data_list])
+    if ids.ndim != 2 or ids.shape[1] != len(vgs):
+        raise ValueError("All the sweeps must have the same number of points")
+
+    if slope_point is not None and 'grid_id' in data_list[0].attrs:
+        index = sweep_grid.registry.of(data_list[0]).index_of(slope_point, tol)
+    elif slope_point is not None:
+        index = _grid_index(vgs, slope_point, tol)
     else:
-        slope =  np.gradient(data['Ids'],data['Vgs'])[np.max(data['Ids'])]
-        ids = np.max(data['Ids'])
-    
-    return ids/slope
+        index = np.argmax(ids, axis=1)
 
-    
-    
-    
\ No newline at end of file
+    slope = _local_gradient(ids, vgs, index)
+    return ids[np.arange(len(ids)), index]/slope